@@ -0,0 +1,16 @@
+"""
+Configuración de gunicorn. Se lee automáticamente desde la raíz del proyecto
+al ejecutar `gunicorn wsgi --chdir ./src/` (ver Procfile).
+"""
+import os
+
+# Cargar la aplicación (y el índice RAG, ver src/wsgi.py) en el proceso maestro
+# antes de crear los workers, para que compartan la memoria en lugar de que
+# cada uno lea el índice por su cuenta
+preload_app = os.getenv("RAG_PRELOAD") == "1"
+
+
+def post_worker_init(worker):
+    # Retomar los trabajos de ingesta que dejó a medias un worker que murió
+    from api.rag.ingest_jobs import ingest_queue
+    ingest_queue.start()
@@ -0,0 +1,733 @@
+"""
+Versión asíncrona (Quart) de los endpoints que esperan a la API de OpenAI.
+
+Se sirve con src/asgi.py. Mientras una consulta espera el embedding, la
+respuesta del modelo o el audio, el mismo proceso sigue atendiendo otras,
+así que la concurrencia ya no está limitada por el número de workers.
+"""
+import os
+import json
+import time
+import base64
+import asyncio
+import secrets
+
+import httpx
+import numpy as np
+from openai import AsyncOpenAI
+from quart import Blueprint, request, jsonify, Response, url_for, send_file, stream_with_context, g
+
+from api.utils import sse_event
+from api.metrics import stage_timer, observe_stage, observe_request, add_tokens, add_usage, add_audio_bytes
+from api.speech import SentenceSplitter, AUDIO_FORMATS, AUDIO_PUBLIC_URL
+from api.rag import embeddings_manager
+from api.rag.embeddings_manager import SEARCH_BATCH_MAX_QUERIES
+from api.rag.ingest_jobs import ingest_queue
+from api.routes import (
+    OPENAI_API_KEY, OPENAI_BASE_URL, SYSTEM_MESSAGE, VOICE_SYSTEM_MESSAGE, RAG_TOP_K,
+    TTS_MODEL, TTS_VOICE, TTS_MAX_WORKERS, AUDIO_CHUNK_SIZE,
+    audio_store, tts_cache, answer_cache,
+    format_rag_context, add_rag_context, report_prompt_tokens, get_sources, get_audio_options, remember_answer
+)
+
+async_api = Blueprint('async_api', __name__)
+
+# Conexiones simultáneas y conexiones keep-alive reutilizables hacia la API de OpenAI, por proceso
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "50"))
+
+async_client = None
+async_client_pid = None
+
+
+def get_async_client() -> AsyncOpenAI:
+    """
+    Devuelve el cliente asíncrono de OpenAI de este proceso
+
+    Se crea al primer uso (después del fork de gunicorn) con un pool de
+    conexiones keep-alive compartido por todas las peticiones del worker.
+    """
+    global async_client, async_client_pid
+    if async_client is None or async_client_pid != os.getpid():
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE
+            ),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+        async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, http_client=http_client)
+        async_client_pid = os.getpid()
+    return async_client
+
+
+async def close_async_client():
+    """
+    Cierra las conexiones del cliente asíncrono al apagar el servidor
+    """
+    global async_client
+    if async_client is not None and async_client_pid == os.getpid():
+        await async_client.close()
+    async_client = None
+
+
+@async_api.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@async_api.after_request
+async def record_request_metrics(response):
+    # En streaming se mide hasta enviar las cabeceras; el resto queda en api_stage_seconds
+    if hasattr(g, "request_start"):
+        observe_request(request.endpoint or "unknown", response.status_code,
+                        time.perf_counter() - g.request_start)
+    return response
+
+
+async def get_query_embedding(query):
+    """
+    Devuelve el embedding de una consulta, usando la misma caché que la versión síncrona
+
+    Con OpenAI se usa el cliente asíncrono; un modelo local se ejecuta en un hilo.
+    """
+    embedder = embeddings_manager.embedder
+    with stage_timer("query_embedding"):
+        embedding = embeddings_manager.query_cache.get(query, embedder.cache_name)
+        if embedding is None:
+            if embedder.name == "openai":
+                response = await get_async_client().embeddings.create(model=embedder.model, input=[query],
+                                                                      **embedder.request_options)
+                add_tokens("embedding", getattr(response.usage, "total_tokens", 0))
+                vector = response.data[0].embedding
+            else:
+                vector = (await asyncio.to_thread(embedder.embed, [query]))[0]
+            embedding = embeddings_manager.query_cache.put(query, embedder.cache_name, vector)
+    return embedding
+
+
+async def get_query_embeddings(queries):
+    """
+    Devuelve los embeddings de varias consultas, pidiendo en una sola llamada los que no están en la caché
+    """
+    embedder = embeddings_manager.embedder
+    with stage_timer("query_embedding"):
+        embeddings = [embeddings_manager.query_cache.get(query, embedder.cache_name) for query in queries]
+        missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+        if missing:
+            if embedder.name == "openai":
+                response = await get_async_client().embeddings.create(model=embedder.model, input=missing,
+                                                                      **embedder.request_options)
+                add_tokens("embedding", getattr(response.usage, "total_tokens", 0))
+                vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            else:
+                vectors = await asyncio.to_thread(embedder.embed, missing)
+            generated = {query: embeddings_manager.query_cache.put(query, embedder.cache_name, vector)
+                         for query, vector in zip(missing, vectors)}
+            embeddings = [generated[query] if embedding is None else embedding
+                          for query, embedding in zip(queries, embeddings)]
+    return embeddings
+
+
+async def prepare_answer(kind, system_message, user_message):
+    """
+    Busca la respuesta en la caché semántica o arma los mensajes con el contexto RAG
+
+    El embedding de la consulta se calcula una sola vez y sirve para las dos
+    cosas. Si la búsqueda léxica basta, no se pide y la respuesta no pasa por
+    la caché. Las búsquedas locales se hacen en un hilo para no bloquear el bucle.
+
+    Returns:
+        Tuple: Respuesta en caché (o None), clave de caché, mensajes, si se usó
+        contexto RAG y resultados de la búsqueda
+    """
+    embedding, cache_key = None, None
+    search_results = None
+    if embeddings_manager.get_chunk_count() > 0:
+        try:
+            search_results = await asyncio.to_thread(
+                embeddings_manager.fast_path_search, user_message, RAG_TOP_K
+            )
+        except Exception as rag_error:
+            print(f"Error al buscar en la base RAG: {str(rag_error)}")
+
+    if search_results is None:
+        try:
+            embedding = await get_query_embedding(user_message)
+            cache_key = (kind, embedding, embeddings_manager.get_generation())
+        except Exception as e:
+            print(f"No se pudo calcular el embedding de la consulta: {str(e)}")
+
+    if cache_key is not None and answer_cache.enabled:
+        cached_answer = answer_cache.get(*cache_key)
+        if cached_answer is not None:
+            print(f"Respuesta encontrada en la caché (similitud {cached_answer['similarity']})")
+            return cached_answer, cache_key, [], False, []
+
+    relevant_context = ""
+    context_tokens = 0
+    try:
+        if search_results is None and embeddings_manager.get_chunk_count() > 0:
+            search_results = await asyncio.to_thread(
+                embeddings_manager.hybrid_search, user_message, embedding, RAG_TOP_K
+            )
+        if search_results:
+            relevant_context, search_results, context_tokens = format_rag_context(search_results)
+            print(f"Se encontraron {len(search_results)} fragmentos relevantes")
+    except Exception as rag_error:
+        print(f"Error al buscar en la base RAG: {str(rag_error)}")
+    search_results = search_results or []
+
+    with stage_timer("context_assembly"):
+        messages = [
+            {"role": "system", "content": add_rag_context(system_message, relevant_context)},
+            {"role": "user", "content": user_message}
+        ]
+    report_prompt_tokens(system_message, context_tokens, user_message)
+    return None, cache_key, messages, relevant_context != "", search_results
+
+
+async def complete_chat(messages):
+    """
+    Pide la respuesta completa al modelo
+    """
+    with stage_timer("completion"):
+        response = await get_async_client().chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            temperature=0.2,
+            max_tokens=1000
+        )
+    add_usage(getattr(response, "usage", None))
+    return response.choices[0].message.content
+
+
+async def stream_chat_text(messages):
+    """
+    Pide la respuesta al modelo en streaming y devuelve sus fragmentos de texto
+    """
+    start = time.perf_counter()
+    first_token = True
+    stream = await get_async_client().chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=messages,
+        temperature=0.2,
+        max_tokens=1000,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    async for chunk in stream:
+        add_usage(getattr(chunk, "usage", None))
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token:
+                observe_stage("completion_first_token", time.perf_counter() - start)
+                first_token = False
+            yield chunk.choices[0].delta.content
+    observe_stage("completion", time.perf_counter() - start)
+
+
+async def cached_text(text):
+    """
+    Entrega una respuesta de la caché como un único fragmento
+    """
+    yield text
+
+
+async def synthesize_speech(text, audio_format="mp3"):
+    """
+    Convierte un texto en audio, pasando por la caché de audio compartida
+    """
+    audio = tts_cache.get(text, TTS_VOICE, TTS_MODEL, audio_format)
+    if audio is not None:
+        add_audio_bytes("tts_cache", len(audio))
+        return audio
+    with stage_timer("tts"):
+        audio_response = await get_async_client().audio.speech.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
+            input=text,
+            response_format=audio_format
+        )
+    tts_cache.put(text, TTS_VOICE, TTS_MODEL, audio_format, audio_response.content)
+    add_audio_bytes("tts", len(audio_response.content))
+    return audio_response.content
+
+
+def audio_payload(audio, audio_format, audio_delivery):
+    """
+    Campos de la respuesta JSON con el audio, incrustado en base64 o como URL
+
+    La URL es absoluta: la app móvil no se sirve desde el mismo origen que la API.
+    """
+    with stage_timer("audio_encoding"):
+        if audio_delivery == "url":
+            name = audio_store.save(audio, audio_format)
+            url = AUDIO_PUBLIC_URL + url_for('async_api.get_audio', name=name, _external=not AUDIO_PUBLIC_URL)
+            return {"audio_url": url, "audio_format": audio_format}
+        return {"audio": base64.b64encode(audio).decode("utf-8"), "audio_format": audio_format}
+
+
+async def speech_segments(fragments, audio_format, parts):
+    """
+    Sintetiza cada oración en cuanto está completa y entrega los audios en orden
+
+    Equivalente asíncrono de SpeechPipeline: una tarea lee los fragmentos del
+    modelo y lanza una síntesis por oración (como mucho TTS_MAX_WORKERS a la
+    vez); los audios se entregan en el orden de las oraciones.
+    """
+    semaphore = asyncio.Semaphore(TTS_MAX_WORKERS)
+    pending = asyncio.Queue()
+    tasks = []
+
+    async def synthesize(sentence):
+        async with semaphore:
+            return await synthesize_speech(sentence, audio_format)
+
+    def start(sentence):
+        task = asyncio.create_task(synthesize(sentence))
+        tasks.append(task)
+        return sentence, task
+
+    async def produce():
+        splitter = SentenceSplitter()
+        try:
+            async for fragment in fragments:
+                parts.append(fragment)
+                for sentence in splitter.feed(fragment):
+                    await pending.put(start(sentence))
+            for sentence in splitter.flush():
+                await pending.put(start(sentence))
+            await pending.put(None)
+        except Exception as e:
+            await pending.put(e)
+
+    producer = asyncio.create_task(produce())
+    try:
+        index = 0
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            sentence, task = item
+            try:
+                yield index, sentence, await task, None
+            except Exception as e:
+                yield index, sentence, None, e
+            index += 1
+    finally:
+        # Si el cliente se desconectó, no se pagan las síntesis pendientes
+        producer.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+def event_stream(generator):
+    """
+    Respuesta SSE a partir de un generador asíncrono de eventos
+    """
+    return Response(
+        generator,
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def wants_event_stream(data):
+    """
+    Indica si el cliente pidió la respuesta en streaming (SSE)
+    """
+    return data.get('stream') is True or 'text/event-stream' in request.headers.get('Accept', '')
+
+
+@async_api.route('/chat', methods=['POST'])
+async def handle_chat():
+    data = await request.get_json()
+
+    if not data or not data.get('message'):
+        return jsonify({"error": "No message provided"}), 400
+
+    user_message = data.get('message')
+    request_start = time.perf_counter()
+
+    try:
+        cached_answer, cache_key, messages, rag_used, search_results = await prepare_answer(
+            "chat", SYSTEM_MESSAGE, user_message
+        )
+
+        if wants_event_stream(data):
+            @stream_with_context
+            async def generate():
+                parts = []
+                ttft_ms = None
+                try:
+                    if cached_answer is not None:
+                        fragments = cached_text(cached_answer["response"])
+                        used, sources = cached_answer["rag_used"], cached_answer["sources"]
+                    else:
+                        fragments = stream_chat_text(messages)
+                        used, sources = rag_used, get_sources(search_results)
+                    async for content in fragments:
+                        if ttft_ms is None:
+                            ttft_ms = (time.perf_counter() - request_start) * 1000
+                        parts.append(content)
+                        yield sse_event("token", {"content": content})
+
+                    ai_response = "".join(parts)
+                    total_ms = (time.perf_counter() - request_start) * 1000
+                    if cached_answer is None:
+                        remember_answer(cache_key, ai_response, used, sources, request_start)
+                    yield sse_event("done", {
+                        "response": ai_response,
+                        "rag_used": used,
+                        "sources": sources,
+                        "cached": cached_answer is not None,
+                        "ttft_ms": round(ttft_ms, 1) if ttft_ms is not None else None,
+                        "total_ms": round(total_ms, 1)
+                    })
+                except Exception as e:
+                    print(f"Error streaming from OpenAI API: {str(e)}")
+                    yield sse_event("error", {
+                        "error": "Failed to get response from AI service",
+                        "details": str(e)
+                    })
+
+            return event_stream(generate())
+
+        if cached_answer is not None:
+            return jsonify({
+                "response": cached_answer["response"],
+                "rag_used": cached_answer["rag_used"],
+                "cached": True
+            }), 200
+
+        ai_response = await complete_chat(messages)
+        remember_answer(cache_key, ai_response, rag_used, get_sources(search_results), request_start)
+        return jsonify({
+            "response": ai_response,
+            "rag_used": rag_used
+        }), 200
+
+    except Exception as e:
+        print(f"Error calling OpenAI API: {str(e)}")
+        return jsonify({
+            "error": "Failed to get response from AI service",
+            "details": str(e)
+        }), 500
+
+
+@async_api.route('/realtime-chat', methods=['POST'])
+async def handle_realtime_chat():
+    data = await request.get_json()
+
+    if not data or not data.get('message'):
+        return jsonify({"error": "No message provided"}), 400
+
+    user_message = data.get('message')
+    audio_format, audio_delivery = get_audio_options(data)
+    request_start = time.perf_counter()
+
+    try:
+        cached_answer, cache_key, messages, rag_used, search_results = await prepare_answer(
+            "chat", SYSTEM_MESSAGE, user_message
+        )
+
+        if wants_event_stream(data):
+            @stream_with_context
+            async def generate():
+                parts = []
+                first_audio_ms = None
+                try:
+                    if cached_answer is not None:
+                        fragments = cached_text(cached_answer["response"])
+                        used, sources = cached_answer["rag_used"], cached_answer["sources"]
+                    else:
+                        fragments = stream_chat_text(messages)
+                        used, sources = rag_used, get_sources(search_results)
+                    async for index, sentence, audio, tts_error in speech_segments(fragments, audio_format, parts):
+                        if tts_error is not None:
+                            print(f"Error in TTS conversion of sentence {index}: {str(tts_error)}")
+                            yield sse_event("audio", {
+                                "index": index,
+                                "text": sentence,
+                                "audio": None,
+                                "tts_error": str(tts_error)
+                            })
+                            continue
+                        if first_audio_ms is None:
+                            first_audio_ms = (time.perf_counter() - request_start) * 1000
+                        yield sse_event("audio", {
+                            "index": index,
+                            "text": sentence,
+                            **audio_payload(audio, audio_format, audio_delivery)
+                        })
+
+                    ai_response = "".join(parts)
+                    total_ms = (time.perf_counter() - request_start) * 1000
+                    if cached_answer is None:
+                        remember_answer(cache_key, ai_response, used, sources, request_start)
+                    yield sse_event("done", {
+                        "response": ai_response,
+                        "rag_used": used,
+                        "sources": sources,
+                        "cached": cached_answer is not None,
+                        "first_audio_ms": round(first_audio_ms, 1) if first_audio_ms is not None else None,
+                        "total_ms": round(total_ms, 1)
+                    })
+                except Exception as e:
+                    print(f"Error streaming real-time response: {str(e)}")
+                    yield sse_event("error", {
+                        "error": "Failed to process real-time request",
+                        "details": str(e)
+                    })
+
+            return event_stream(generate())
+
+        if cached_answer is not None:
+            ai_response_text, rag_used = cached_answer["response"], cached_answer["rag_used"]
+        else:
+            ai_response_text = await complete_chat(messages)
+            remember_answer(cache_key, ai_response_text, rag_used, get_sources(search_results), request_start)
+
+        # Truncate response for TTS if too long (OpenAI TTS has a 4096 character limit)
+        tts_text = ai_response_text
+        if len(ai_response_text) > 4000:
+            tts_text = ai_response_text[:3900] + "... Consulta la respuesta completa en pantalla."
+
+        if audio_delivery == "multipart":
+            return multipart_speech_response({
+                "response": ai_response_text,
+                "rag_used": rag_used
+            }, tts_text, audio_format)
+
+        try:
+            audio_content = await synthesize_speech(tts_text, audio_format)
+            return jsonify({
+                "response": ai_response_text,
+                **audio_payload(audio_content, audio_format, audio_delivery),
+                "rag_used": rag_used
+            }), 200
+        except Exception as tts_error:
+            print(f"Error in TTS conversion: {str(tts_error)}")
+            return jsonify({
+                "response": ai_response_text,
+                "audio": None,
+                "rag_used": rag_used,
+                "tts_error": str(tts_error)
+            }), 200
+
+    except Exception as e:
+        print(f"Error processing real-time chat: {str(e)}")
+        return jsonify({
+            "error": "Failed to process real-time request",
+            "details": str(e)
+        }), 500
+
+
+@async_api.route('/voice-chat', methods=['POST'])
+async def handle_voice_chat():
+    data = await request.get_json()
+
+    if not data or not data.get('message'):
+        return jsonify({"error": "No message provided"}), 400
+
+    user_message = data.get('message')
+    audio_format, audio_delivery = get_audio_options(data)
+    request_start = time.perf_counter()
+
+    try:
+        cached_answer, cache_key, messages, rag_used, search_results = await prepare_answer(
+            "voice", VOICE_SYSTEM_MESSAGE, user_message
+        )
+        if cached_answer is not None:
+            ai_response_text, rag_used = cached_answer["response"], cached_answer["rag_used"]
+        else:
+            ai_response_text = await complete_chat(messages)
+            remember_answer(cache_key, ai_response_text, rag_used, get_sources(search_results), request_start)
+
+        if audio_delivery == "multipart":
+            return multipart_speech_response({
+                "response": ai_response_text,
+                "rag_used": rag_used
+            }, ai_response_text, audio_format)
+
+        audio_content = await synthesize_speech(ai_response_text, audio_format)
+        return jsonify({
+            "response": ai_response_text,
+            **audio_payload(audio_content, audio_format, audio_delivery),
+            "rag_used": rag_used
+        }), 200
+
+    except Exception as e:
+        print(f"Error processing voice chat: {str(e)}")
+        return jsonify({
+            "error": "Failed to process voice request",
+            "details": str(e)
+        }), 500
+
+
+def multipart_speech_response(payload, text, audio_format):
+    """
+    Respuesta multipart/mixed: primero el JSON y después el audio en binario
+    """
+    boundary = secrets.token_hex(16)
+
+    async def generate():
+        yield (f"--{boundary}\r\nContent-Type: application/json; charset=utf-8\r\n\r\n"
+               f"{json.dumps(payload, ensure_ascii=False)}\r\n").encode("utf-8")
+        audio_header = f"--{boundary}\r\nContent-Type: {AUDIO_FORMATS[audio_format]}\r\n\r\n".encode("utf-8")
+        cached = tts_cache.get(text, TTS_VOICE, TTS_MODEL, audio_format)
+        if cached is not None:
+            add_audio_bytes("tts_cache", len(cached))
+            yield audio_header + cached + b"\r\n"
+            yield f"--{boundary}--\r\n".encode("utf-8")
+            return
+        try:
+            start = time.perf_counter()
+            async with get_async_client().audio.speech.with_streaming_response.create(
+                model=TTS_MODEL,
+                voice=TTS_VOICE,
+                input=text,
+                response_format=audio_format
+            ) as audio_response:
+                yield audio_header
+                chunks = []
+                async for chunk in audio_response.iter_bytes(AUDIO_CHUNK_SIZE):
+                    chunks.append(chunk)
+                    yield chunk
+                yield b"\r\n"
+            observe_stage("tts", time.perf_counter() - start)
+            audio = b"".join(chunks)
+            add_audio_bytes("tts", len(audio))
+            tts_cache.put(text, TTS_VOICE, TTS_MODEL, audio_format, audio)
+        except Exception as tts_error:
+            print(f"Error in TTS conversion: {str(tts_error)}")
+            yield (f"--{boundary}\r\nContent-Type: application/json; charset=utf-8\r\n\r\n"
+                   f"{json.dumps({'tts_error': str(tts_error)})}\r\n").encode("utf-8")
+        yield f"--{boundary}--\r\n".encode("utf-8")
+
+    return Response(generate(), mimetype=f"multipart/mixed; boundary={boundary}")
+
+
+@async_api.route('/audio/<name>', methods=['GET'])
+async def get_audio(name):
+    """
+    Sirve un audio de respuesta guardado con audio_delivery="url"
+    """
+    clip = audio_store.get_path(name)
+    if clip is None:
+        return jsonify({"error": "Audio not found or expired"}), 404
+    path, audio_format = clip
+    return await send_file(path, mimetype=AUDIO_FORMATS[audio_format], cache_timeout=audio_store.ttl)
+
+
+@async_api.route('/rag/search', methods=['POST'])
+async def rag_search():
+    """
+    Endpoint para buscar en la base de datos RAG
+
+    Igual que EmbeddingsManager.search: la búsqueda léxica si basta y, si no,
+    la búsqueda híbrida con el embedding pedido con el cliente asíncrono.
+    """
+    try:
+        data = await request.get_json()
+
+        if not data or not data.get('query'):
+            return jsonify({"error": "No se proporcionó ninguna consulta"}), 400
+
+        query = data.get('query')
+        top_k = data.get('top_k', 5)
+
+        results = []
+        if embeddings_manager.get_chunk_count() > 0:
+            results = await asyncio.to_thread(embeddings_manager.fast_path_search, query, top_k)
+            if results is None:
+                embedding = await get_query_embedding(query)
+                results = await asyncio.to_thread(embeddings_manager.hybrid_search, query, embedding, top_k)
+
+        return jsonify({
+            "query": query,
+            "results": results
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@async_api.route('/rag/search/batch', methods=['POST'])
+async def rag_search_batch():
+    """
+    Endpoint para buscar varias consultas en una sola petición
+
+    Igual que en la versión síncrona; los embeddings que faltan se piden con
+    el cliente asíncrono en una sola llamada.
+    """
+    try:
+        data = await request.get_json()
+        queries = (data or {}).get('queries')
+
+        if not isinstance(queries, list) or not queries:
+            return jsonify({"error": "No se proporcionó ninguna consulta"}), 400
+        if not all(isinstance(query, str) and query.strip() for query in queries):
+            return jsonify({"error": "Todas las consultas deben ser textos no vacíos"}), 400
+
+        top_k = data.get('top_k', 5)
+
+        try:
+            if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+                raise ValueError(f"Se admiten como máximo {SEARCH_BATCH_MAX_QUERIES} consultas por petición")
+            embeddings = None
+            if embeddings_manager.get_chunk_count() > 0:
+                embeddings = np.array(await get_query_embeddings(queries), dtype=np.float32)
+            results = await asyncio.to_thread(embeddings_manager.search_batch, queries, top_k, embeddings)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        return jsonify({
+            "results": [{"query": query, "results": query_results}
+                        for query, query_results in zip(queries, results)]
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@async_api.route('/rag/upload', methods=['POST'])
+async def rag_upload():
+    """
+    Endpoint para subir un archivo JSON y encolar su procesamiento
+
+    Igual que en la versión síncrona: la ingesta la hace la cola de trabajos
+    y el progreso se consulta en /api/rag/jobs/<job_id>.
+    """
+    try:
+        files = await request.files
+        if 'file' not in files:
+            return jsonify({"error": "No se proporcionó ningún archivo"}), 400
+
+        file = files['file']
+        if file.filename == '':
+            return jsonify({"error": "Nombre de archivo vacío"}), 400
+        if not file.filename.lower().endswith('.json'):
+            return jsonify({"error": "Solo se permiten archivos JSON"}), 400
+
+        try:
+            json_data = json.loads(file.read().decode('utf-8'))
+        except json.JSONDecodeError:
+            return jsonify({"error": "El archivo no contiene JSON válido"}), 400
+
+        try:
+            job = await asyncio.to_thread(ingest_queue.submit, json_data, file.filename)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        return jsonify({
+            "message": "Documento en cola para procesarse",
+            "job_id": job["id"],
+            "document_id": job["document_id"],
+            "job": job
+        }), 202
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -1,4 +1,5 @@
 
+import os
 import click
 from api.models import db, User
 
@@ -31,4 +32,81 @@ def setup_commands(app):
 
     @app.cli.command("insert-test-data")
     def insert_test_data():
-        pass
\ No newline at end of file
+        pass
+
+    """
+    Importa el metadata.json de versiones anteriores al almacén de chunks
+    (también ocurre automáticamente al cargar el sistema RAG):
+    $ flask rag-migrate-metadata
+    """
+    @app.cli.command("rag-migrate-metadata")
+    def rag_migrate_metadata():
+        from api.rag import embeddings_manager
+
+        embeddings_manager.migrate_legacy_metadata()
+        print(f"Almacén de chunks: {embeddings_manager.get_document_count()} documentos, "
+              f"{embeddings_manager.get_chunk_count()} chunks")
+
+    """
+    Reconstruye el índice FAISS del sistema RAG con el tipo indicado
+    (flat, ivf, hnsw o ivfpq) y la precisión de los vectores (float32,
+    float16, sq8 o pq). Por defecto usa RAG_INDEX_TYPE y RAG_INDEX_STORAGE:
+    $ flask rag-rebuild-index --type hnsw --storage sq8
+    """
+    @app.cli.command("rag-rebuild-index")
+    @click.option("--type", "index_type", default=None, help="Tipo de índice: flat, ivf, hnsw o ivfpq")
+    @click.option("--storage", default=None, help="Precisión de los vectores: float32, float16, sq8 o pq")
+    def rag_rebuild_index(index_type, storage):
+        from api.rag import embeddings_manager
+        from api.rag.index_factory import make_config, index_storage
+
+        configured = embeddings_manager.index_config
+        config = None
+        if (index_type and index_type != configured["type"]) or (storage and storage != index_storage(configured)):
+            config = make_config(index_type or configured["type"], **({"storage": storage} if storage else {}))
+        embeddings_manager.rebuild_index(config)
+        print("Índice reconstruido:", embeddings_manager.get_index_info())
+    """
+    Compacta el índice del sistema RAG: absorbe los segmentos delta en un
+    índice base nuevo y quita los vectores de documentos borrados o
+    reemplazados (también ocurre en segundo plano tras las ingestas):
+    $ flask rag-compact
+    """
+    @app.cli.command("rag-compact")
+    def rag_compact():
+        from api.rag import embeddings_manager
+
+        before = embeddings_manager.get_index_info()["segments"]
+        embeddings_manager.compact(wait=True)
+        print("Antes:", before)
+        print("Después:", embeddings_manager.get_index_info()["segments"])
+
+    """
+    Ingresa en el sistema RAG todos los documentos ({title, content, source})
+    de una carpeta (.json y .jsonl), de un archivo JSONL o de la entrada
+    estándar ("-"). Divide y genera los embeddings en paralelo y escribe el
+    índice una vez al final; si se interrumpe, volver a lanzarlo retoma desde
+    el último lote de embeddings generado:
+    $ flask rag-ingest ./protocolos --workers 8
+    $ cat documentos.jsonl | flask rag-ingest -
+    """
+    @app.cli.command("rag-ingest")
+    @click.argument("path")
+    @click.option("--workers", type=int, default=None, help="Hilos de división y lotes de embeddings simultáneos")
+    @click.option("--checkpoint-dir", default=None, help="Carpeta del checkpoint de embeddings")
+    @click.option("--restart", is_flag=True, help="Descartar el checkpoint y generar todos los embeddings")
+    def rag_ingest(path, workers, checkpoint_dir, restart):
+        from api.rag.bulk_ingest import bulk_ingest
+
+        if path != "-" and not os.path.exists(path):
+            raise click.BadParameter(f"No existe {path}", param_hint="PATH")
+        stats = bulk_ingest(path, workers=workers, checkpoint_dir=checkpoint_dir, restart=restart)
+        for error in stats["errors"]:
+            print(f"Registro inválido: {error}")
+        print(f"{stats['documents']} documentos ({stats['replaced']} reemplazados), {stats['chunks']} chunks y "
+              f"{stats['tokens']} tokens en {stats['seconds']:.2f}s; {stats['unchanged']} sin cambios, "
+              f"{stats['invalid']} inválidos, {stats['resumed_chunks']} chunks retomados del checkpoint, "
+              f"{stats['reused_chunks']} chunks reutilizados de filas ya indexadas")
+        print(f"Rendimiento: {stats['docs_per_second']} docs/s, {stats['chunks_per_second']} chunks/s, "
+              f"{stats['tokens_per_second']} tokens/s")
+        print("Tiempos por etapa (s):", stats["timings"])
@@ -0,0 +1,342 @@
+"""
+Prueba de carga de la API: compara despliegues (wsgi o asgi, con distinto
+número de workers) bajo la misma carga y busca su punto de saturación.
+
+La carga puede ser un solo endpoint (--path) o una mezcla ponderada de chat,
+chat por SSE, tiempo real, voz, búsqueda y subida de documentos (--mix).
+Con varias concurrencias (--concurrency 10,50,100) se informa, para cada
+despliegue, el throughput y la latencia de cola en cada nivel y el nivel a
+partir del cual el throughput deja de crecer o aparecen errores.
+
+Uso (desde la carpeta src/), con OpenAI simulado (ver benchmarks/mock_openai.py):
+    python -m benchmarks.mock_openai --port 8100
+    export OPENAI_BASE_URL=http://localhost:8100/v1 OPENAI_API_KEY=sk-mock
+    gunicorn wsgi -b :3001 -w 4
+    gunicorn asgi:application -b :3002 -w 4 -k uvicorn_worker.UvicornWorker
+    python -m api.load_test --target sync=http://localhost:3001 --target async=http://localhost:3002 \\
+        --mix chat=5,chat_stream=2,voice=1,search=2,upload=0.2 --concurrency 10,50,100 --requests 1000
+
+Los despliegues también se pueden levantar desde la prueba, uno por vez:
+    python -m api.load_test --server "sync-w4=gunicorn wsgi -b :{port} -w 4" \\
+        --server "async-w2=gunicorn asgi:application -b :{port} -w 2 -k uvicorn_worker.UvicornWorker" \\
+        --mix chat=1,search=1 --concurrency 10,50,100
+"""
+import argparse
+import asyncio
+import json
+import random
+import shlex
+import subprocess
+import time
+from typing import List, Dict, Any, Tuple, Optional
+
+import httpx
+import numpy as np
+
+DEFAULT_MESSAGES = [
+    "¿Cómo se realiza la RCP en un adulto?",
+    "Paciente con obstrucción de la vía aérea, ¿qué hago?",
+    "Síntomas de una reacción alérgica severa",
+    "¿Cómo controlo una hemorragia externa?",
+]
+
+UPLOAD_TEXT = ("Ante una hemorragia externa, aplicar presión directa sobre la herida con un apósito limpio "
+               "y elevar el miembro si no hay fractura. Si el sangrado no se detiene, colocar un torniquete "
+               "por encima de la lesión y registrar la hora. ")
+
+# Tipos de tráfico que admite --mix
+TRAFFIC_KINDS = ("chat", "chat_stream", "realtime", "voice", "search", "upload")
+
+# Un nivel de concurrencia satura cuando el throughput crece menos que esto respecto al anterior...
+SATURATION_MIN_GAIN = 0.10
+# ...o cuando falla más de esta fracción de las peticiones
+SATURATION_MAX_ERROR_RATE = 0.01
+
+
+def build_request(kind: str, i: int, messages: List[str], path: str = "/api/chat",
+                  stream: bool = False) -> Tuple[str, Dict[str, Any]]:
+    """
+    Endpoint y cuerpo de la petición número `i` de un tipo de tráfico
+
+    Returns:
+        Tuple[str, Dict[str, Any]]: Ruta y argumentos de httpx (json o files)
+    """
+    message = messages[i % len(messages)]
+    if kind == "path":
+        return path, {"json": {"message": message, "stream": stream}}
+    if kind == "chat":
+        return "/api/chat", {"json": {"message": message}}
+    if kind == "chat_stream":
+        return "/api/chat", {"json": {"message": message, "stream": True}}
+    if kind == "realtime":
+        return "/api/realtime-chat", {"json": {"message": message}}
+    if kind == "voice":
+        return "/api/voice-chat", {"json": {"message": message}}
+    if kind == "search":
+        return "/api/rag/search", {"json": {"query": message, "top_k": 3}}
+    # Cada subida es un documento distinto, para que se procese entero
+    document = {
+        "title": f"Prueba de carga {i} ({time.time_ns()})",
+        "source": f"load_test/{i}.json",
+        "content": UPLOAD_TEXT * 8,
+    }
+    return "/api/rag/upload", {"files": {"file": (f"load_test_{i}.json", json.dumps(document), "application/json")}}
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """
+    Convierte "chat=6,search=3,upload=1" en pesos por tipo de tráfico
+    """
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.strip().partition("=")
+        if kind not in TRAFFIC_KINDS:
+            raise ValueError(f"Tipo de tráfico desconocido: {kind}. Opciones: {', '.join(TRAFFIC_KINDS)}")
+        mix[kind] = float(weight) if weight else 1.0
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError("La mezcla de tráfico necesita al menos un peso positivo")
+    return mix
+
+
+def plan_requests(mix: Dict[str, float], total: int, seed: int) -> List[str]:
+    """
+    Tipos de las `total` peticiones, sorteados según sus pesos (siempre igual para la misma semilla)
+    """
+    rng = random.Random(seed)
+    return rng.choices(list(mix), weights=list(mix.values()), k=total)
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, Optional[float]]:
+    """
+    p50, p90 y p99 en milisegundos
+    """
+    summary = {}
+    for p in (50, 90, 99):
+        summary[f"p{p}_ms"] = round(float(np.percentile(latencies, p)), 1) if latencies else None
+    return summary
+
+
+async def run_load(base_url: str, plan: List[str], messages: List[str], concurrency: int, timeout: float,
+                   path: str = "/api/chat", stream: bool = False) -> Dict[str, Any]:
+    """
+    Envía las peticiones de `plan` con como mucho `concurrency` en vuelo
+
+    Returns:
+        Dict[str, Any]: Rendimiento, latencias y errores, en total y por tipo de tráfico
+    """
+    latencies = []
+    first_byte = []
+    errors: Dict[str, int] = {}
+    by_kind: Dict[str, Dict[str, Any]] = {kind: {"latencies": [], "errors": 0} for kind in set(plan)}
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        async def one(i: int, kind: str):
+            url, body = build_request(kind, i, messages, path, stream)
+            async with semaphore:
+                start = time.perf_counter()
+                first = None
+                try:
+                    async with client.stream("POST", url, **body) as response:
+                        async for _ in response.aiter_bytes():
+                            if first is None:
+                                first = (time.perf_counter() - start) * 1000
+                        if response.status_code != 200:
+                            key = f"HTTP {response.status_code}"
+                            errors[key] = errors.get(key, 0) + 1
+                            by_kind[kind]["errors"] += 1
+                            return
+                    elapsed_ms = (time.perf_counter() - start) * 1000
+                    latencies.append(elapsed_ms)
+                    by_kind[kind]["latencies"].append(elapsed_ms)
+                    if first is not None:
+                        first_byte.append(first)
+                except httpx.HTTPError as e:
+                    key = type(e).__name__
+                    errors[key] = errors.get(key, 0) + 1
+                    by_kind[kind]["errors"] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i, kind) for i, kind in enumerate(plan)))
+        elapsed = time.perf_counter() - started
+
+    total = len(plan)
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "ok": len(latencies),
+        "errors": errors,
+        "error_rate": round((total - len(latencies)) / total, 4) if total else 0.0,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        **latency_summary(latencies),
+        "first_byte_p50_ms": round(float(np.percentile(first_byte, 50)), 1) if first_byte else None,
+        "by_kind": {
+            kind: {"ok": len(stats["latencies"]), "errors": stats["errors"], **latency_summary(stats["latencies"])}
+            for kind, stats in sorted(by_kind.items())
+        },
+    }
+
+
+def find_saturation(levels: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Primer nivel de concurrencia en el que el despliegue deja de escalar
+
+    Returns:
+        Optional[Dict[str, Any]]: Concurrencia, motivo y la mejor concurrencia
+        anterior, o None si escaló en todos los niveles probados
+    """
+    previous = None
+    for level in levels:
+        if level["error_rate"] > SATURATION_MAX_ERROR_RATE:
+            reason = f"errores {level['error_rate']:.1%}"
+        elif previous and previous["throughput_rps"] and \
+                level["throughput_rps"] < previous["throughput_rps"] * (1 + SATURATION_MIN_GAIN):
+            reason = f"throughput {level['throughput_rps'] / previous['throughput_rps'] - 1:+.0%}"
+        else:
+            previous = level
+            continue
+        return {
+            "concurrency": level["concurrency"],
+            "reason": reason,
+            "best_concurrency": previous["concurrency"] if previous else None,
+            "max_throughput_rps": max(row["throughput_rps"] for row in levels),
+        }
+    return None
+
+
+def run_target(name: str, url: str, args, plan: List[str]) -> Dict[str, Any]:
+    """
+    Recorre los niveles de concurrencia contra un despliegue
+    """
+    levels = []
+    for concurrency in args.concurrency:
+        print(f"Probando {name} ({url}): {len(plan)} peticiones, concurrencia {concurrency}")
+        levels.append(asyncio.run(run_load(url, plan, DEFAULT_MESSAGES, concurrency, args.timeout,
+                                           args.path, args.stream)))
+    return {"url": url, "levels": levels, "saturation": find_saturation(levels)}
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float):
+    """
+    Espera a que el servidor recién levantado responda en /api/hello
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"El servidor terminó con código {process.returncode} antes de estar listo")
+        try:
+            if httpx.get(f"{url}/api/hello", timeout=2.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"El servidor no respondió en {timeout:.0f} s")
+
+
+def run_server(name: str, command: str, args, plan: List[str]) -> Dict[str, Any]:
+    """
+    Levanta un despliegue con `command` (con {port} como puerto), lo prueba y lo detiene
+    """
+    url = f"http://127.0.0.1:{args.port}"
+    print(f"Levantando {name}: {command.format(port=args.port)}")
+    process = subprocess.Popen(shlex.split(command.format(port=args.port)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(url, process, args.startup_timeout)
+        result = run_target(name, url, args, plan)
+        result["command"] = command
+        return result
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def print_report(results: Dict[str, Dict[str, Any]]):
+    """
+    Muestra los resultados de cada despliegue y nivel de concurrencia como tabla
+    """
+    print(f"{'destino':<12} {'conc':>5} {'ok':>6} {'errores':>8} {'req/s':>8} {'p50 ms':>9} {'p90 ms':>9} "
+          f"{'p99 ms':>9} {'1er byte':>9}")
+    for name, result in results.items():
+        for row in result["levels"]:
+            print(f"{name:<12} {row['concurrency']:>5} {row['ok']:>6} {sum(row['errors'].values()):>8} "
+                  f"{row['throughput_rps']:>8.2f} {row['p50_ms'] or 0:>9.1f} {row['p90_ms'] or 0:>9.1f} "
+                  f"{row['p99_ms'] or 0:>9.1f} {row['first_byte_p50_ms'] or 0:>9.1f}")
+
+    kinds = sorted({kind for result in results.values() for row in result["levels"] for kind in row["by_kind"]})
+    if len(kinds) > 1:
+        print(f"\n{'destino':<12} {'conc':>5} {'tipo':<12} {'ok':>6} {'errores':>8} {'p50 ms':>9} {'p99 ms':>9}")
+        for name, result in results.items():
+            for row in result["levels"]:
+                for kind, stats in row["by_kind"].items():
+                    print(f"{name:<12} {row['concurrency']:>5} {kind:<12} {stats['ok']:>6} {stats['errors']:>8} "
+                          f"{stats['p50_ms'] or 0:>9.1f} {stats['p99_ms'] or 0:>9.1f}")
+
+    print()
+    for name, result in results.items():
+        saturation = result["saturation"]
+        if saturation is None:
+            print(f"{name}: escala hasta la concurrencia máxima probada")
+        else:
+            print(f"{name}: satura en concurrencia {saturation['concurrency']} ({saturation['reason']}), "
+                  f"máximo {saturation['max_throughput_rps']:.2f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de la API")
+    parser.add_argument("--target", action="append", default=[],
+                        help="Servidor a probar, como nombre=url (se puede repetir)")
+    parser.add_argument("--server", action="append", default=[],
+                        help="Despliegue a levantar, como nombre=comando con {port} (se puede repetir)")
+    parser.add_argument("--port", type=int, default=3100, help="Puerto para los despliegues de --server")
+    parser.add_argument("--startup-timeout", type=float, default=120.0,
+                        help="Segundos de espera a que arranque cada despliegue de --server")
+    parser.add_argument("--path", default="/api/chat", help="Endpoint a probar si no se indica --mix")
+    parser.add_argument("--mix", default=None,
+                        help=f"Mezcla de tráfico como tipo=peso, separados por comas ({', '.join(TRAFFIC_KINDS)})")
+    parser.add_argument("--requests", type=int, default=200, help="Número de peticiones por nivel de concurrencia")
+    parser.add_argument("--concurrency", default="50", help="Peticiones simultáneas, o varios niveles separados por comas")
+    parser.add_argument("--stream", action="store_true", help="Pedir las respuestas de --path por SSE")
+    parser.add_argument("--seed", type=int, default=42, help="Semilla del sorteo de la mezcla de tráfico")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Tiempo máximo por petición en segundos")
+    parser.add_argument("--json", dest="json_path", default=None, help="Guardar los resultados en un archivo JSON")
+    args = parser.parse_args()
+
+    if not args.target and not args.server:
+        parser.error("Hay que indicar al menos un --target o un --server")
+    try:
+        args.concurrency = [int(level) for level in args.concurrency.split(",")]
+        mix = parse_mix(args.mix) if args.mix else None
+    except ValueError as e:
+        parser.error(str(e))
+    plan = plan_requests(mix, args.requests, args.seed) if mix else ["path"] * args.requests
+
+    results = {}
+    for target in args.target:
+        name, _, url = target.partition("=")
+        if not url:
+            name, url = target, target
+        results[name] = run_target(name, url, args, plan)
+    for server in args.server:
+        name, _, command = server.partition("=")
+        results[name] = run_server(name, command, args, plan)
+    print_report(results)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "mix": mix or {"path": args.path, "stream": args.stream},
+                "requests": args.requests,
+                "results": results
+            }, f, indent=2)
+        print(f"Resultados guardados en {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""
+Métricas de latencia por etapa, tokens y bytes, en formato de texto de Prometheus.
+
+Cada worker acumula sus métricas en memoria y las vuelca cada pocos segundos
+(y al terminar) a un archivo en METRICS_DIR; /api/metrics suma los archivos de
+todos los workers, así que no importa qué worker atienda la petición. Los
+archivos de los workers que ya terminaron se suman a dead_workers.json antes
+de borrarlos, para que los contadores nunca bajen cuando gunicorn recicla un
+worker.
+"""
+import os
+import json
+import time
+import atexit
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Tuple, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+METRICS_DIR = os.getenv(
+    "METRICS_DIR",
+    "/dev/shm/api-metrics" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "api-metrics")
+)
+# Segundos entre volcados de las métricas de un worker a disco
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+
+# Límites de los buckets de latencia, en segundos
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Límites de los buckets de tamaño de prompt, en tokens
+TOKEN_BUCKETS = (250, 500, 750, 1000, 1500, 2000, 3000, 4000, 8000, 16000)
+# Métricas acumuladas de los workers que ya terminaron
+DEAD_WORKERS_FILE = "dead_workers.json"
+
+
+class MetricsRegistry:
+    """
+    Contadores e histogramas con etiquetas de un proceso
+    """
+    def __init__(self, directory: str = METRICS_DIR, flush_seconds: float = METRICS_FLUSH_SECONDS):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.definitions: Dict[str, Dict[str, Any]] = {}
+        self.counters: Dict[str, Dict[str, float]] = {}
+        self.histograms: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.pid = os.getpid()
+        self.last_flush = 0.0
+        # Sin esto se perderían las observaciones posteriores al último volcado
+        atexit.register(self.flush)
+
+    def define(self, name: str, kind: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        """
+        Declara una métrica ("counter" o "histogram")
+        """
+        self.definitions[name] = {"kind": kind, "help": help_text, "buckets": list(buckets)}
+        (self.counters if kind == "counter" else self.histograms).setdefault(name, {})
+
+    @staticmethod
+    def label_key(labels: Dict[str, str]) -> str:
+        return json.dumps(sorted(labels.items()))
+
+    def check_fork(self):
+        """
+        Empieza de cero en un proceso hijo, para no contar dos veces lo heredado
+
+        Debe llamarse con `self.lock` tomado.
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.last_flush = 0.0
+            for values in list(self.counters.values()) + list(self.histograms.values()):
+                values.clear()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Suma `value` a un contador
+        """
+        key = self.label_key(labels)
+        with self.lock:
+            self.check_fork()
+            values = self.counters[name]
+            values[key] = values.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Registra una observación en un histograma
+        """
+        key = self.label_key(labels)
+        buckets = self.definitions[name]["buckets"]
+        with self.lock:
+            self.check_fork()
+            series = self.histograms[name].setdefault(
+                key, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            )
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+        self.maybe_flush()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            self.check_fork()
+            return json.loads(json.dumps({"counters": self.counters, "histograms": self.histograms}))
+
+    def maybe_flush(self):
+        """
+        Vuelca las métricas a disco si pasaron `flush_seconds` desde el último volcado
+        """
+        if time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Escribe las métricas de este proceso en METRICS_DIR/<pid>.json
+        """
+        self.last_flush = time.time()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{os.getpid()}.json")
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"No se pudieron guardar las métricas: {str(e)}")
+
+    @contextmanager
+    def directory_lock(self):
+        """
+        Bloqueo exclusivo entre procesos para modificar dead_workers.json
+        """
+        with open(os.path.join(self.directory, ".lock"), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def absorb_dead_workers(self):
+        """
+        Suma a dead_workers.json las métricas de los procesos que ya no existen y borra sus archivos
+        """
+        dead = [entry.path for entry in os.scandir(self.directory)
+                if entry.name.endswith(".json") and entry.name[:-len(".json")].isdigit()
+                and not process_alive(int(entry.name[:-len(".json")]))]
+        if not dead:
+            return
+        dead_path = os.path.join(self.directory, DEAD_WORKERS_FILE)
+        with self.directory_lock():
+            totals = read_metrics(dead_path) or {"counters": {}, "histograms": {}}
+            absorbed = []
+            for path in dead:
+                # Otro worker pudo haberlo sumado mientras se esperaba el bloqueo
+                data = read_metrics(path)
+                if data is not None:
+                    merge_metrics(totals, data)
+                    absorbed.append(path)
+            if not absorbed:
+                return
+            tmp_path = f"{dead_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(totals, f)
+            os.replace(tmp_path, dead_path)
+            for path in absorbed:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def collect(self) -> Dict[str, Any]:
+        """
+        Suma las métricas de todos los workers, incluidos los que ya terminaron
+        """
+        self.flush()
+        merged = {"counters": {name: {} for name in self.counters},
+                  "histograms": {name: {} for name in self.histograms}}
+        try:
+            self.absorb_dead_workers()
+        except OSError as e:
+            print(f"No se pudieron acumular las métricas de workers terminados: {str(e)}")
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            data = read_metrics(entry.path)
+            if data is not None:
+                merge_metrics(merged, data)
+        return merged
+
+    def render(self) -> str:
+        """
+        Devuelve las métricas de todos los workers en formato de texto de Prometheus
+        """
+        merged = self.collect()
+        lines = []
+        for name, definition in self.definitions.items():
+            lines.append(f"# HELP {name} {definition['help']}")
+            lines.append(f"# TYPE {name} {definition['kind']}")
+            if definition["kind"] == "counter":
+                for key, value in sorted(merged["counters"].get(name, {}).items()):
+                    lines.append(f"{name}{format_labels(key)} {format_value(value)}")
+                continue
+            for key, series in sorted(merged["histograms"].get(name, {}).items()):
+                for bound, count in zip(definition["buckets"], series["buckets"]):
+                    lines.append(f"{name}_bucket{format_labels(key, le=format_value(bound))} {count}")
+                lines.append(f"{name}_bucket{format_labels(key, le='+Inf')} {series['count']}")
+                lines.append(f"{name}_sum{format_labels(key)} {format_value(series['sum'])}")
+                lines.append(f"{name}_count{format_labels(key)} {series['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def read_metrics(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Lee un archivo de métricas (None si no existe o está incompleto)
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def merge_metrics(merged: Dict[str, Any], data: Dict[str, Any]):
+    """
+    Suma los contadores e histogramas de `data` a `merged`
+    """
+    for name, values in data.get("counters", {}).items():
+        target = merged["counters"].setdefault(name, {})
+        for key, value in values.items():
+            target[key] = target.get(key, 0) + value
+    for name, values in data.get("histograms", {}).items():
+        target = merged["histograms"].setdefault(name, {})
+        for key, series in values.items():
+            current = target.setdefault(key, {"buckets": [0] * len(series["buckets"]), "sum": 0.0, "count": 0})
+            current["buckets"] = [a + b for a, b in zip(current["buckets"], series["buckets"])]
+            current["sum"] += series["sum"]
+            current["count"] += series["count"]
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_labels(key: str, le: Optional[str] = None) -> str:
+    labels = json.loads(key)
+    if le is not None:
+        labels.append(["le", le])
+    if not labels:
+        return ""
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+registry = MetricsRegistry()
+registry.define("api_request_seconds", "histogram", "Tiempo de cada petición hasta enviar la respuesta (o sus cabeceras, en streaming)")
+registry.define("api_requests_total", "counter", "Peticiones atendidas por endpoint y código de estado")
+registry.define("api_stage_seconds", "histogram", "Tiempo de cada etapa del pipeline (embedding, FAISS, modelo, TTS...)")
+registry.define("api_tokens_total", "counter", "Tokens consumidos por tipo (prompt, completion, embedding)")
+registry.define("api_audio_bytes_total", "counter", "Bytes de audio entregados por origen (tts o caché)")
+registry.define("api_retrievals_total", "counter", "Búsquedas RAG por modo (lexical, vector o hybrid)")
+registry.define("api_prompt_tokens", "histogram", "Tokens de entrada de cada petición al modelo (sistema, contexto RAG y usuario)",
+                buckets=TOKEN_BUCKETS)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """
+    Mide el tiempo de una etapa y lo registra en api_stage_seconds
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe("api_stage_seconds", time.perf_counter() - start, stage=stage)
+
+
+def observe_stage(stage: str, seconds: float):
+    """
+    Registra el tiempo de una etapa medida por fuera (p. ej. el primer token)
+    """
+    registry.observe("api_stage_seconds", seconds, stage=stage)
+
+
+def add_tokens(kind: str, count: int):
+    """
+    Suma tokens consumidos de un tipo
+    """
+    if count:
+        registry.inc("api_tokens_total", count, kind=kind)
+
+
+def add_usage(usage):
+    """
+    Suma los tokens del campo `usage` de una respuesta de chat de OpenAI
+    """
+    if usage is not None:
+        add_tokens("prompt", getattr(usage, "prompt_tokens", 0) or 0)
+        add_tokens("completion", getattr(usage, "completion_tokens", 0) or 0)
+
+
+def add_audio_bytes(source: str, count: int):
+    """
+    Suma bytes de audio entregados
+    """
+    if count:
+        registry.inc("api_audio_bytes_total", count, source=source)
+
+
+def observe_request(endpoint: str, status: int, seconds: float):
+    """
+    Registra una petición atendida
+    """
+    registry.observe("api_request_seconds", seconds, endpoint=endpoint)
+    registry.inc("api_requests_total", endpoint=endpoint, status=str(status))
+
+
+def observe_prompt_tokens(tokens: int):
+    """
+    Registra el tamaño del prompt de una petición
+    """
+    registry.observe("api_prompt_tokens", tokens)
+
+
+def count_retrieval(mode: str):
+    """
+    Cuenta una búsqueda RAG resuelta en un modo
+    """
+    registry.inc("api_retrievals_total", mode=mode)
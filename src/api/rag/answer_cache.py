@@ -0,0 +1,154 @@
+"""
+Caché semántica de respuestas: reutiliza la respuesta de una consulta casi idéntica.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+# Número máximo de respuestas guardadas por proceso (0 desactiva la caché)
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+# Distancia coseno máxima entre dos consultas para considerarlas la misma pregunta
+ANSWER_CACHE_MAX_DISTANCE = float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", "0.05"))
+
+
+class AnswerCache:
+    """
+    Respuestas del modelo indexadas por el embedding de la consulta
+
+    Cada entrada guarda la generación de los datos RAG con la que se respondió;
+    cuando una ingesta cambia la generación, las entradas anteriores dejan de
+    servirse y se descartan. Las respuestas se separan por tipo (el mensaje de
+    sistema usado), porque el mismo texto puede responderse distinto en cada
+    endpoint.
+    """
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 max_distance: float = ANSWER_CACHE_MAX_DISTANCE):
+        """
+        Args:
+            max_entries: Número máximo de respuestas en memoria
+            max_distance: Distancia coseno máxima para reutilizar una respuesta
+        """
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self.next_id = 0
+        self.generation = None
+        self.matrices: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.seconds_saved = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def check_generation(self, generation: int):
+        """
+        Descarta todas las respuestas si los datos pasaron a una generación nueva
+
+        Debe llamarse con `self.lock` tomado.
+        """
+        if self.generation is None or generation > self.generation:
+            if self.entries:
+                self.invalidations += 1
+                print(f"Datos RAG en la generación {generation}: se descartan "
+                      f"{len(self.entries)} respuestas en caché")
+            self.entries.clear()
+            self.matrices.clear()
+            self.generation = generation
+
+    def get_matrix(self, kind: str):
+        """
+        Devuelve los ids y la matriz de embeddings de las entradas de un tipo
+
+        Debe llamarse con `self.lock` tomado.
+        """
+        if kind not in self.matrices:
+            ids = [entry_id for entry_id, entry in self.entries.items() if entry["kind"] == kind]
+            matrix = np.stack([self.entries[i]["embedding"] for i in ids]) if ids else None
+            self.matrices[kind] = (ids, matrix)
+        return self.matrices[kind]
+
+    @staticmethod
+    def normalize(embedding) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def get(self, kind: str, embedding, generation: int) -> Optional[Dict[str, Any]]:
+        """
+        Busca la respuesta de una consulta suficientemente parecida
+
+        Returns:
+            Optional[Dict[str, Any]]: Respuesta guardada (con su similitud) o None
+        """
+        if not self.enabled:
+            return None
+        query = self.normalize(embedding)
+        with self.lock:
+            self.check_generation(generation)
+            ids, matrix = self.get_matrix(kind)
+            if generation == self.generation and matrix is not None and matrix.shape[1] == len(query):
+                similarities = matrix @ query
+                best = int(np.argmax(similarities))
+                if 1.0 - float(similarities[best]) <= self.max_distance:
+                    entry = self.entries[ids[best]]
+                    self.entries.move_to_end(ids[best])
+                    self.hits += 1
+                    self.seconds_saved += entry["seconds"]
+                    return dict(entry["answer"], similarity=round(float(similarities[best]), 4))
+            self.misses += 1
+            return None
+
+    def put(self, kind: str, embedding, generation: int, answer: Dict[str, Any], seconds: float):
+        """
+        Guarda una respuesta
+
+        Args:
+            kind: Tipo de respuesta (mensaje de sistema usado)
+            embedding: Embedding de la consulta
+            generation: Generación de los datos RAG usados para responder
+            answer: Respuesta a devolver en los aciertos
+            seconds: Tiempo que costó generar la respuesta
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.check_generation(generation)
+            # La respuesta se generó con datos que ya cambiaron
+            if generation != self.generation:
+                return
+            self.entries[self.next_id] = {
+                "kind": kind,
+                "embedding": self.normalize(embedding),
+                "answer": answer,
+                "seconds": seconds
+            }
+            self.next_id += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.matrices.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Devuelve los contadores de aciertos y el tiempo ahorrado
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "seconds_saved": round(self.seconds_saved, 3),
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "max_distance": self.max_distance,
+                "generation": self.generation,
+                "invalidations": self.invalidations
+            }
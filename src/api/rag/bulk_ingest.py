@@ -0,0 +1,182 @@
+"""
+Ingesta masiva de documentos desde una carpeta o un JSONL (flask rag-ingest).
+
+Los documentos se dividen en chunks en paralelo, los embeddings de todos se
+generan en lotes concurrentes que mezclan chunks de varios documentos, y el
+índice se escribe una sola vez al final. Los chunks con el mismo texto que
+uno ya indexado (o que otro de la entrada) no generan embedding ni fila nueva. Cada lote terminado se guarda en un
+checkpoint: si la ingesta se interrumpe, volver a lanzarla con los mismos
+documentos retoma desde ahí.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Dict, Any, Optional, Tuple
+
+
+from .embeddings_manager import embeddings_manager, DATA_DIR, parse_document, document_id
+from .ingest_jobs import BatchCheckpoint
+
+BULK_CHECKPOINT_DIR = os.path.join(DATA_DIR, "bulk")
+
+
+def read_records(path: str) -> Iterator[Tuple[str, Any]]:
+    """
+    Lee los documentos de una carpeta, un archivo .json/.jsonl o la entrada estándar ("-")
+
+    En una carpeta se leen, en orden, los .json (un documento o una lista de
+    documentos) y los .jsonl (un documento por línea) de todas las subcarpetas.
+
+    Yields:
+        Tuple[str, Any]: Origen del registro (archivo y línea) y el registro
+    """
+    if path == "-":
+        yield from read_jsonl(sys.stdin, "stdin")
+        return
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names
+                       if name.lower().endswith((".json", ".jsonl")))
+    else:
+        files = [path]
+    for file_path in files:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            if file_path.lower().endswith(".jsonl"):
+                yield from read_jsonl(f, file_path)
+                continue
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError as e:
+                yield file_path, e
+                continue
+        for i, record in enumerate(data if isinstance(data, list) else [data]):
+            yield (f"{file_path}[{i}]" if isinstance(data, list) else file_path), record
+
+
+def read_jsonl(lines, name: str) -> Iterator[Tuple[str, Any]]:
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield f"{name}:{number}", json.loads(line)
+        except json.JSONDecodeError as e:
+            yield f"{name}:{number}", e
+
+
+def load_documents(path: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Valida los registros y se queda con la última versión de cada documento
+
+    Returns:
+        Tuple: Documentos (id, title, source, content, content_hash) y errores de los registros inválidos
+    """
+    documents: Dict[str, Dict[str, Any]] = {}
+    errors = []
+    for origin, record in read_records(path):
+        if isinstance(record, Exception):
+            errors.append(f"{origin}: JSON inválido ({record})")
+            continue
+        try:
+            title, content, source = parse_document(record)
+        except ValueError as e:
+            errors.append(f"{origin}: {e}")
+            continue
+        doc_id = document_id(title, source)
+        # Un id repetido en la entrada: vale la última versión
+        documents.pop(doc_id, None)
+        documents[doc_id] = {
+            "id": doc_id,
+            "title": title,
+            "source": source,
+            "content": content,
+            "content_hash": hashlib.md5(content.encode('utf-8')).hexdigest(),
+        }
+    return list(documents.values()), errors
+
+
+def bulk_ingest(path: str, workers: Optional[int] = None, checkpoint_dir: Optional[str] = None,
+                restart: bool = False) -> Dict[str, Any]:
+    """
+    Ingresa todos los documentos de `path` y publica el índice una sola vez
+
+    Args:
+        path: Carpeta, archivo .json/.jsonl o "-" para leer JSONL de la entrada estándar
+        workers: Hilos para dividir los documentos y lotes de embeddings
+            simultáneos (por defecto RAG_EMBED_MAX_WORKERS)
+        checkpoint_dir: Carpeta del checkpoint (por defecto una por conjunto de
+            documentos dentro de la carpeta de datos)
+        restart: Descartar el checkpoint y generar todos los embeddings de nuevo
+
+    Returns:
+        Dict[str, Any]: Documentos, chunks y tokens procesados, tiempos por etapa y rendimiento
+    """
+    manager = embeddings_manager.initialize()
+    started = time.perf_counter()
+    timings: Dict[str, float] = {}
+
+    stage = time.perf_counter()
+    documents, errors = load_documents(path)
+    total = len(documents)
+    documents = [doc for doc in documents if not manager.is_unchanged(doc["id"], doc["content_hash"])]
+    timings["read"] = time.perf_counter() - stage
+    print(f"{total} documentos leídos, {total - len(documents)} sin cambios, {len(errors)} inválidos")
+
+    stats = {"documents": 0, "replaced": 0, "unchanged": total - len(documents), "invalid": len(errors),
+             "errors": errors, "chunks": 0, "tokens": 0, "resumed_chunks": 0, "reused_chunks": 0}
+    if documents:
+        # Dividir en chunks en paralelo (el tokenizador libera el GIL)
+        stage = time.perf_counter()
+
+        def split(document: Dict[str, Any]) -> Dict[str, Any]:
+            chunks = manager.text_splitter.split_text(document["content"])
+            return dict(document, chunks=chunks, token_counts=[manager.count_tokens(chunk) for chunk in chunks])
+
+        with ThreadPoolExecutor(max_workers=workers or None) as executor:
+            documents = list(executor.map(split, documents))
+        documents = [doc for doc in documents if doc["chunks"]]
+        chunk_count = sum(len(doc["chunks"]) for doc in documents)
+        pending = manager.new_chunks(documents)
+        timings["chunking"] = time.perf_counter() - stage
+        print(f"{chunk_count} chunks ({sum(sum(doc['token_counts']) for doc in documents)} tokens) de "
+              f"{len(documents)} documentos; {len(pending)} necesitan embedding")
+
+        # El checkpoint depende de los documentos a procesar y su orden
+        if checkpoint_dir is None:
+            fingerprint = hashlib.md5("".join(f"{doc['id']}:{doc['content_hash']};"
+                                              for doc in documents).encode('utf-8')).hexdigest()
+            checkpoint_dir = os.path.join(BULK_CHECKPOINT_DIR, fingerprint)
+        checkpoint = BatchCheckpoint(checkpoint_dir)
+        if restart:
+            checkpoint.clear()
+
+        stage = time.perf_counter()
+        report: Dict[str, Any] = {}
+        vectors = manager.embed_new_chunks(pending, checkpoint, max_workers=workers, report=report)
+        timings["embedding"] = time.perf_counter() - stage
+        stats["resumed_chunks"] = report.get("resumed_chunks", 0)
+
+        stage = time.perf_counter()
+        written = manager.write_documents(documents, vectors, report)
+        timings["write"] = time.perf_counter() - stage
+        checkpoint.clear()
+        if written:
+            stats["reused_chunks"] = report.get("reused_chunks", 0)
+
+        written_docs = [doc for doc in documents if doc["id"] in written]
+        stats.update(
+            documents=len(written),
+            replaced=sum(written.values()),
+            unchanged=stats["unchanged"] + len(documents) - len(written),
+            chunks=sum(len(doc["chunks"]) for doc in written_docs),
+            tokens=sum(sum(doc["token_counts"]) for doc in written_docs),
+        )
+
+    seconds = time.perf_counter() - started
+    stats["seconds"] = round(seconds, 3)
+    stats["timings"] = {name: round(value, 3) for name, value in timings.items()}
+    stats["docs_per_second"] = round(stats["documents"] / seconds, 2) if seconds else 0.0
+    stats["chunks_per_second"] = round(stats["chunks"] / seconds, 2) if seconds else 0.0
+    stats["tokens_per_second"] = round(stats["tokens"] / seconds, 1) if seconds else 0.0
+    return stats
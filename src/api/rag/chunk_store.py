@@ -0,0 +1,475 @@
+"""
+Almacén de chunks y documentos en archivos de solo anexado, leídos con mmap.
+"""
+import os
+import re
+import mmap
+import json
+import hashlib
+import unicodedata
+from typing import Iterable, List, Dict, Any, Optional
+
+import numpy as np
+
+# Registro de tamaño fijo por fila del índice FAISS
+ROW_DTYPE = np.dtype([
+    ("offset", "<i8"),       # Posición del texto en chunks.bin
+    ("length", "<i4"),       # Longitud del texto en bytes
+    ("doc", "<i4"),          # Número de línea del documento en documents.jsonl
+    ("chunk_index", "<i4"),  # Posición del chunk dentro del documento
+    ("tokens", "<i4"),       # Número de tokens del chunk
+])
+
+# md5 en hexadecimal del texto normalizado de cada fila, en chunk_hashes.bin
+HASH_DTYPE = np.dtype("S32")
+
+
+def normalize_chunk(text: str) -> str:
+    """
+    Normaliza el texto de un chunk para compararlo (Unicode NFC y espacios colapsados)
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def chunk_hash(text: str) -> str:
+    """
+    Hash del texto normalizado de un chunk
+    """
+    return hashlib.md5(normalize_chunk(text).encode('utf-8')).hexdigest()
+
+
+def document_rows(doc: Dict[str, Any]) -> List[int]:
+    """
+    Filas de los chunks de un documento, en orden
+    """
+    if "rows" in doc:
+        return doc["rows"]
+    return list(range(doc["first_row"], doc["first_row"] + doc["chunk_count"]))
+
+
+class ChunkStore:
+    """
+    Chunks y documentos indexados por fila del índice FAISS
+
+    - chunks.bin: textos de los chunks concatenados en UTF-8
+    - chunk_rows.bin: un registro ROW_DTYPE por fila del índice
+    - chunk_hashes.bin: el hash del texto normalizado de cada fila (HASH_DTYPE)
+    - documents.jsonl: una línea JSON por documento
+
+    Los archivos solo crecen al final, así que una ingesta escribe solo
+    sus propios chunks. Los textos y registros se leen con mmap: todos los
+    workers comparten las páginas de la caché del sistema operativo y una
+    búsqueda solo toca los textos de sus resultados.
+
+    Un documento se reemplaza anexando otra línea con el mismo id, y se borra
+    anexando una línea {"id", "deleted": true} sin chunks. Las filas de las
+    versiones anteriores quedan muertas (`dead`) y se filtran en las búsquedas.
+
+    Un chunk cuyo texto ya está en una fila viva no se vuelve a guardar: el
+    documento la referencia en su lista "rows". Una fila sigue viva mientras
+    algún documento vigente la use, y se muestra con el primero de ellos.
+    """
+    def __init__(self, directory: str):
+        """
+        Abre (o crea vacíos) los archivos del almacén
+
+        Args:
+            directory: Carpeta de datos del sistema RAG
+        """
+        self.texts_path = os.path.join(directory, "chunks.bin")
+        self.rows_path = os.path.join(directory, "chunk_rows.bin")
+        self.hashes_path = os.path.join(directory, "chunk_hashes.bin")
+        self.documents_path = os.path.join(directory, "documents.jsonl")
+        for path in (self.texts_path, self.rows_path, self.hashes_path, self.documents_path):
+            if not os.path.exists(path):
+                open(path, 'ab').close()
+        self.texts = None
+        self.rows = np.zeros(0, dtype=ROW_DTYPE)
+        self.documents: List[Dict[str, Any]] = []
+        self.docs_by_id: Dict[str, Dict[str, Any]] = {}
+        self.dead = np.zeros(0, dtype=bool)
+        # Documento (número de línea) con el que se muestra cada fila y posición del chunk en él
+        self.owners = np.zeros(0, dtype=np.int64)
+        self.chunk_indexes = np.zeros(0, dtype=np.int64)
+        # Otros documentos vigentes que usan una fila compartida
+        self.shared: Dict[int, List[int]] = {}
+        self.open()
+
+    def open(self):
+        """
+        Mapea los archivos en memoria (solo lectura) y carga los documentos
+
+        Los mapeos anteriores no se cierran: como los archivos solo crecen, la
+        vista nueva contiene todas las filas de la anterior, y las búsquedas en
+        curso pueden seguir leyendo de la que tomaron hasta soltarla.
+        """
+        count = os.path.getsize(self.rows_path) // ROW_DTYPE.itemsize
+        if count:
+            rows = np.memmap(self.rows_path, dtype=ROW_DTYPE, mode='r', shape=(count,))
+        else:
+            rows = np.zeros(0, dtype=ROW_DTYPE)
+        texts = None
+        if os.path.getsize(self.texts_path):
+            with open(self.texts_path, 'rb') as f:
+                texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        documents = []
+        with open(self.documents_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # Una última línea sin salto de línea es una escritura interrumpida
+                if not line.endswith("\n"):
+                    break
+                documents.append(json.loads(line))
+        # Solo la última línea de cada id está vigente
+        docs_by_id = {}
+        numbers = {}
+        for number, doc in enumerate(documents):
+            if doc.get("deleted"):
+                docs_by_id.pop(doc["id"], None)
+                numbers.pop(doc["id"], None)
+            else:
+                docs_by_id[doc["id"]] = doc
+                numbers[doc["id"]] = number
+        # Las filas de un documento cuya línea aún no se escribió también cuentan como muertas
+        doc_numbers = np.asarray(rows["doc"])
+        live = np.zeros(max(len(documents), int(doc_numbers.max()) + 1 if len(doc_numbers) else 0), dtype=bool)
+        live[list(numbers.values())] = True
+        owners = doc_numbers.astype(np.int64)
+        chunk_indexes = np.asarray(rows["chunk_index"]).astype(np.int64)
+        referenced = live[doc_numbers]
+        # Las filas reutilizadas de un documento que ya no está vigente pasan
+        # al primer documento vigente que las use
+        shared: Dict[int, List[int]] = {}
+        for number in numbers.values():
+            for i, row in enumerate(documents[number].get("rows", ())):
+                if row >= count:
+                    continue
+                if not referenced[row]:
+                    owners[row] = number
+                    chunk_indexes[row] = i
+                    referenced[row] = True
+                elif owners[row] != number and shared.get(row, [None])[-1] != number:
+                    shared.setdefault(row, []).append(number)
+
+        # Los textos y documentos se cambian antes que las filas, para que
+        # cualquier fila visible tenga ya su texto y su documento
+        self.texts = texts
+        self.documents = documents
+        self.docs_by_id = docs_by_id
+        self.owners = owners
+        self.chunk_indexes = chunk_indexes
+        self.shared = shared
+        self.dead = ~referenced
+        self.rows = rows
+
+    def close(self):
+        """
+        Libera los mapeos de memoria
+        """
+        if self.texts is not None:
+            self.texts.close()
+            self.texts = None
+        self.rows = np.zeros(0, dtype=ROW_DTYPE)
+        self.dead = np.zeros(0, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get_text(self, row: int) -> str:
+        """
+        Devuelve el texto del chunk de una fila
+        """
+        record = self.rows[row]
+        offset = int(record["offset"])
+        return self.texts[offset:offset + int(record["length"])].decode('utf-8')
+
+    def get_doc_number(self, row: int) -> int:
+        """
+        Devuelve el número de línea del documento con el que se muestra una fila
+        """
+        return int(self.owners[row])
+
+    def get_document(self, row: int) -> Dict[str, Any]:
+        """
+        Devuelve el documento al que pertenece el chunk de una fila
+        """
+        return self.documents[int(self.owners[row])]
+
+    def get_shared_documents(self, row: int) -> List[Dict[str, Any]]:
+        """
+        Devuelve los demás documentos vigentes que usan el chunk de una fila
+        """
+        return [self.documents[number] for number in self.shared.get(row, ())]
+
+    def get_chunk_id(self, row: int) -> str:
+        """
+        Devuelve el identificador del chunk de una fila
+        """
+        return f"{self.documents[int(self.owners[row])]['id']}_chunk_{int(self.chunk_indexes[row])}"
+
+    def get_token_count(self, row: int) -> int:
+        """
+        Devuelve el número de tokens del chunk de una fila
+        """
+        return int(self.rows[row]["tokens"])
+
+    @property
+    def live_documents(self) -> List[Dict[str, Any]]:
+        """
+        Documentos vigentes (sin los borrados ni las versiones reemplazadas)
+        """
+        return list(self.docs_by_id.values())
+
+    @property
+    def live_row_count(self) -> int:
+        return int(len(self.rows) - self.dead.sum())
+
+    def read_hashes(self, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+        """
+        Lee los hashes de las filas [start, end) (las filas sin hash quedan fuera)
+        """
+        count = min(os.path.getsize(self.hashes_path) // HASH_DTYPE.itemsize, len(self.rows))
+        end = count if end is None else min(end, count)
+        if end <= start:
+            return np.zeros(0, dtype=HASH_DTYPE)
+        return np.fromfile(self.hashes_path, dtype=HASH_DTYPE, count=end - start,
+                           offset=start * HASH_DTYPE.itemsize)
+
+    def find_rows(self, hashes: Iterable[str]) -> Dict[str, int]:
+        """
+        Busca filas vivas con el mismo texto normalizado
+
+        Returns:
+            Dict[str, int]: Fila de cada hash que ya está en el almacén
+        """
+        wanted = np.array(sorted(set(hashes)), dtype=HASH_DTYPE)
+        stored = self.read_hashes()
+        if len(wanted) == 0 or len(stored) == 0:
+            return {}
+        matches = np.flatnonzero(np.isin(stored, wanted) & ~self.dead[:len(stored)])
+        # Si un texto está en varias filas vivas, vale la primera
+        found: Dict[str, int] = {}
+        for row in matches:
+            found.setdefault(stored[row].decode('ascii'), int(row))
+        return found
+
+    def backfill_hashes(self):
+        """
+        Calcula los hashes de las filas guardadas antes de existir chunk_hashes.bin
+        """
+        start = os.path.getsize(self.hashes_path) // HASH_DTYPE.itemsize
+        if start >= len(self.rows):
+            return
+        print(f"Calculando el hash de {len(self.rows) - start} chunks")
+        hashes = np.array([chunk_hash(self.get_text(row)) for row in range(start, len(self.rows))],
+                          dtype=HASH_DTYPE)
+        with open(self.hashes_path, 'ab') as f:
+            f.write(hashes.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add_document(self, doc_id: str, title: str, source: str, chunks: List[str],
+                     token_counts: List[int], content_hash: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Añade un documento y sus chunks al final del almacén
+
+        Las filas nuevas empiezan en len(self). Si ya había un documento con el
+        mismo id, este lo reemplaza.
+
+        Returns:
+            Dict[str, Any]: Registro del documento añadido
+        """
+        return self.add_documents([{
+            "id": doc_id,
+            "title": title,
+            "source": source,
+            "chunks": chunks,
+            "token_counts": token_counts,
+            "content_hash": content_hash,
+        }])[0]
+
+    def add_documents(self, documents: List[Dict[str, Any]], dedupe: bool = False) -> List[Dict[str, Any]]:
+        """
+        Añade varios documentos y sus chunks al final del almacén de una vez
+
+        Se escriben primero los textos, después los hashes y los registros de
+        fila y por último las líneas de los documentos, y el almacén se vuelve
+        a abrir una sola vez.
+
+        Args:
+            documents: Documentos con id, title, source, chunks, token_counts,
+                content_hash (opcional), chunk_hashes (opcional) y chunk_rows
+                (opcional: fila existente que reutiliza cada chunk, o None)
+            dedupe: Guardar una sola vez los chunks nuevos que se repiten entre
+                estos documentos
+
+        Returns:
+            List[Dict[str, Any]]: Registros de los documentos añadidos
+        """
+        self.discard_partial_writes()
+        self.backfill_hashes()
+        doc_number = len(self.documents)
+        next_row = len(self.rows)
+
+        doc_infos = []
+        all_records = []
+        all_hashes = []
+        new_rows: Dict[str, int] = {}
+        with open(self.texts_path, 'ab') as f:
+            position = f.tell()
+            for document in documents:
+                chunks = document["chunks"]
+                hashes = document.get("chunk_hashes") or [chunk_hash(chunk) for chunk in chunks]
+                chunk_rows = list(document.get("chunk_rows") or [None] * len(chunks))
+                records = []
+                first_row = next_row
+                for i, chunk in enumerate(chunks):
+                    if chunk_rows[i] is not None:
+                        continue
+                    if dedupe and hashes[i] in new_rows:
+                        chunk_rows[i] = new_rows[hashes[i]]
+                        continue
+                    data = chunk.encode('utf-8')
+                    f.write(data)
+                    records.append((position, len(data), doc_number, i, document["token_counts"][i]))
+                    all_hashes.append(hashes[i])
+                    position += len(data)
+                    chunk_rows[i] = new_rows[hashes[i]] = next_row
+                    next_row += 1
+                all_records.append(np.array(records, dtype=ROW_DTYPE))
+
+                doc_info = {
+                    "id": document["id"],
+                    "title": document["title"],
+                    "source": document["source"],
+                    "chunk_count": len(chunks),
+                    "first_row": first_row
+                }
+                # Solo los documentos que reutilizan filas guardan la lista completa
+                if chunk_rows != list(range(first_row, first_row + len(chunks))):
+                    doc_info["rows"] = chunk_rows
+                if document.get("content_hash") is not None:
+                    doc_info["content_hash"] = document["content_hash"]
+                doc_infos.append(doc_info)
+                doc_number += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+        with open(self.hashes_path, 'ab') as f:
+            f.write(np.array(all_hashes, dtype=HASH_DTYPE).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        with open(self.rows_path, 'ab') as f:
+            for records in all_records:
+                f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.append_document_lines(doc_infos)
+        return doc_infos
+
+    def delete_document(self, doc_id: str):
+        """
+        Marca un documento como borrado; sus filas quedan muertas
+        """
+        self.discard_partial_writes()
+        self.append_document_lines([{"id": doc_id, "deleted": True, "chunk_count": 0, "first_row": len(self.rows)}])
+
+    def append_document_lines(self, doc_infos: List[Dict[str, Any]]):
+        """
+        Anexa líneas a documents.jsonl y vuelve a abrir el almacén
+        """
+        with open(self.documents_path, 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(doc_info, ensure_ascii=False) + "\n" for doc_info in doc_infos))
+            f.flush()
+            os.fsync(f.fileno())
+        self.open()
+
+    def discard_partial_writes(self):
+        """
+        Elimina los restos de una escritura interrumpida al final de los archivos
+        """
+        size = os.path.getsize(self.rows_path)
+        if size % ROW_DTYPE.itemsize:
+            os.truncate(self.rows_path, size - size % ROW_DTYPE.itemsize)
+        # Los hashes se escriben antes que sus filas: sobran los de filas que no llegaron a escribirse
+        rows_size = os.path.getsize(self.rows_path) // ROW_DTYPE.itemsize * HASH_DTYPE.itemsize
+        if os.path.getsize(self.hashes_path) > rows_size:
+            os.truncate(self.hashes_path, rows_size)
+        with open(self.documents_path, 'rb') as f:
+            data = f.read()
+        if data and not data.endswith(b"\n"):
+            os.truncate(self.documents_path, data.rfind(b"\n") + 1)
+
+    def rollback_to(self, row_count: int):
+        """
+        Descarta las filas a partir de `row_count` y los documentos que las usan
+
+        Se usa cuando una ingesta escribió sus chunks pero no llegó a guardar
+        el índice FAISS, que es el que confirma las filas.
+        """
+        self.discard_partial_writes()
+        self.open()
+        keep = [doc for doc in self.documents if all(row < row_count for row in document_rows(doc))]
+        print(f"Descartando {len(self.rows) - row_count} chunks de una ingesta incompleta")
+        # Sin cerrar los mapeos: las búsquedas en curso solo leen filas confirmadas
+        os.truncate(self.rows_path, row_count * ROW_DTYPE.itemsize)
+        if os.path.getsize(self.hashes_path) > row_count * HASH_DTYPE.itemsize:
+            os.truncate(self.hashes_path, row_count * HASH_DTYPE.itemsize)
+        tmp_path = f"{self.documents_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for doc in keep:
+                f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.documents_path)
+        self.open()
+
+
+def read_legacy_texts(metadata: Dict[str, Any], texts_path: str, offsets_path: str) -> Optional[List[str]]:
+    """
+    Recupera los textos de los chunks de cualquiera de los formatos antiguos
+
+    Los textos pueden estar dentro de metadata.json o en el par
+    chunk_texts.bin / chunk_offsets.bin.
+    """
+    infos = list(metadata["chunk_to_doc"].values())
+    if all("text" in info for info in infos):
+        return [info["text"] for info in infos]
+    if not os.path.exists(texts_path) or not os.path.exists(offsets_path):
+        return None
+    with open(texts_path, 'rb') as f:
+        data = f.read()
+    offsets = np.fromfile(offsets_path, dtype=np.int64)
+    offsets = offsets[:len(offsets) // 2 * 2].reshape(-1, 2)
+    if len(offsets) < len(infos):
+        return None
+    return [data[start:start + length].decode('utf-8') for start, length in offsets[:len(infos)]]
+
+
+def import_legacy_metadata(store: ChunkStore, metadata: Dict[str, Any],
+                           texts: List[str], count_tokens) -> int:
+    """
+    Importa los documentos de un metadata.json antiguo en un almacén vacío
+
+    Args:
+        store: Almacén de destino (vacío)
+        metadata: Contenido de metadata.json ({"documents", "chunk_to_doc"})
+        texts: Texto de cada chunk, en el orden de las filas del índice
+        count_tokens: Función que cuenta los tokens de un texto
+
+    Returns:
+        int: Número de chunks importados
+    """
+    chunk_ids = list(metadata["chunk_to_doc"].keys())
+    row_of_chunk = {chunk_id: row for row, chunk_id in enumerate(chunk_ids)}
+    imported = 0
+    for doc in metadata["documents"]:
+        rows = [row_of_chunk[chunk_id] for chunk_id in doc["chunk_ids"]]
+        # Las filas del documento deben seguir siendo las mismas del índice FAISS
+        if rows != list(range(len(store), len(store) + len(rows))):
+            raise ValueError(f"Los chunks del documento '{doc['title']}' no son contiguos en el índice")
+        doc_texts = [texts[row] for row in rows]
+        store.add_document(doc["id"], doc["title"], doc["source"], doc_texts,
+                           [count_tokens(text) for text in doc_texts])
+        imported += len(rows)
+    return imported
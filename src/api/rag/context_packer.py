@@ -0,0 +1,121 @@
+"""
+Arma el contexto RAG del prompt dentro de un presupuesto de tokens.
+"""
+import os
+from functools import lru_cache
+from typing import List, Dict, Any, Tuple
+
+import tiktoken
+
+# Tokens máximos del contexto RAG (encabezado, documentos y sus fuentes)
+RAG_CONTEXT_MAX_TOKENS = int(os.getenv("RAG_CONTEXT_MAX_TOKENS", "1500"))
+# Un chunk que no entra completo se recorta solo si quedan al menos estos tokens
+RAG_CONTEXT_MIN_TRIM_TOKENS = int(os.getenv("RAG_CONTEXT_MIN_TRIM_TOKENS", "64"))
+
+# Tokens que agrega el formato de chat por mensaje y para iniciar la respuesta
+MESSAGE_OVERHEAD_TOKENS = 3
+REPLY_PRIMING_TOKENS = 3
+
+CONTEXT_PREAMBLE = "Información relevante de nuestra base de conocimiento médico:\n\n"
+CHUNK_HEADER = "DOCUMENTO {number}: {title}\nFUENTE: {source}\nCONTENIDO: "
+CHUNK_SEPARATOR = "\n\n"
+
+
+def get_encoding() -> tiktoken.Encoding:
+    """
+    Devuelve el codificador de gpt-3.5-turbo y text-embedding-3-small
+
+    tiktoken lo carga al primer uso y lo reutiliza en las llamadas siguientes.
+    """
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Cuenta los tokens de un texto
+    """
+    return len(get_encoding().encode(text))
+
+
+@lru_cache(maxsize=4096)
+def count_static_tokens(text: str) -> int:
+    """
+    Cuenta los tokens de un texto que se repite entre peticiones (mensajes de
+    sistema, encabezados de documento) y recuerda el resultado
+    """
+    return count_tokens(text)
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Corta un texto a sus primeros `max_tokens` tokens
+    """
+    encoding = get_encoding()
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
+
+def pack_context(search_results: List[Dict[str, Any]], max_tokens: int = RAG_CONTEXT_MAX_TOKENS,
+                 min_trim_tokens: int = RAG_CONTEXT_MIN_TRIM_TOKENS) -> Tuple[str, List[Dict[str, Any]], int]:
+    """
+    Agrega los chunks en orden de relevancia hasta llenar el presupuesto
+
+    Usa el número de tokens de cada chunk calculado en la ingesta, así que
+    solo se tokeniza el chunk que haya que recortar. Cuando el presupuesto no
+    alcanza, el último chunk que entra se recorta y los de menor relevancia se
+    descartan.
+
+    Args:
+        search_results: Resultados de la búsqueda, del más al menos relevante
+        max_tokens: Presupuesto de tokens del contexto
+        min_trim_tokens: Tokens mínimos para que valga la pena recortar un chunk
+
+    Returns:
+        Tuple[str, List[Dict[str, Any]], int]: Contexto (vacío si no entra
+        ningún chunk), resultados usados y tokens del contexto
+    """
+    parts = [CONTEXT_PREAMBLE]
+    used = []
+    total = count_static_tokens(CONTEXT_PREAMBLE)
+    for result in search_results:
+        header = CHUNK_HEADER.format(
+            number=len(used) + 1,
+            title=result['document']['title'],
+            source=result['document']['source']
+        )
+        overhead = count_static_tokens(header) + count_static_tokens(CHUNK_SEPARATOR)
+        text = result['text']
+        text_tokens = result.get('tokens') or count_tokens(text)
+        remaining = max_tokens - total - overhead
+        if text_tokens <= remaining:
+            parts.append(f"{header}{text}{CHUNK_SEPARATOR}")
+            used.append(result)
+            total += overhead + text_tokens
+            continue
+        if remaining >= min_trim_tokens:
+            text = trim_to_tokens(text, remaining)
+            parts.append(f"{header}{text}{CHUNK_SEPARATOR}")
+            used.append(dict(result, text=text, trimmed=True))
+            total += overhead + remaining
+        print(f"Contexto RAG limitado a {max_tokens} tokens: se usan {len(used)} "
+              f"de {len(search_results)} fragmentos")
+        break
+
+    if not used:
+        return "", [], 0
+    return "".join(parts), used, total
+
+
+def count_prompt_tokens(system_message: str, extra_system_tokens: int, user_message: str) -> int:
+    """
+    Calcula los tokens de entrada de un par de mensajes sistema + usuario
+
+    Args:
+        system_message: Mensaje de sistema fijo (se cuenta una sola vez por texto)
+        extra_system_tokens: Tokens agregados al mensaje de sistema (contexto RAG)
+        user_message: Mensaje del usuario
+
+    Returns:
+        int: Tokens del prompt
+    """
+    return (count_static_tokens(system_message) + extra_system_tokens + count_tokens(user_message)
+            + 2 * MESSAGE_OVERHEAD_TOKENS + REPLY_PRIMING_TOKENS)
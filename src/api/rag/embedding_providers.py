@@ -0,0 +1,193 @@
+"""
+Proveedores de embeddings: la API de OpenAI o un modelo local en la CPU.
+
+RAG_EMBEDDING_PROVIDER elige el proveedor ("openai" o "local"). El modelo
+local se carga desde una carpeta (RAG_LOCAL_EMBEDDING_MODEL) con
+sentence-transformers, que solo hace falta instalar si se usa.
+
+RAG_EMBEDDING_DIMENSION acorta los embeddings: text-embedding-3-small los
+devuelve de la dimensión pedida, y un modelo local entrenado con Matryoshka
+los trunca. Con 512 o 256 dimensiones cada chunk ocupa 3 o 6 veces menos.
+"""
+import os
+import threading
+from typing import List, Dict, Any
+
+from openai import OpenAI
+
+from ..metrics import add_tokens
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+MODEL_NAME = "text-embedding-3-small"
+MODEL_DIMENSION = 1536
+
+# Dimensión de los embeddings (0: la completa del modelo)
+EMBEDDING_DIMENSION = int(os.getenv("RAG_EMBEDDING_DIMENSION", "0"))
+
+EMBEDDING_PROVIDER = os.getenv("RAG_EMBEDDING_PROVIDER", "openai")
+# Carpeta del modelo local (formato de sentence-transformers)
+LOCAL_EMBEDDING_MODEL = os.getenv("RAG_LOCAL_EMBEDDING_MODEL", "")
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("RAG_LOCAL_EMBEDDING_BATCH_SIZE", "32"))
+LOCAL_EMBEDDING_DEVICE = os.getenv("RAG_LOCAL_EMBEDDING_DEVICE", "cpu")
+
+# Proveedor con el que se construyeron los índices anteriores a este registro
+LEGACY_EMBEDDING = {"provider": "openai", "model": MODEL_NAME, "dimension": MODEL_DIMENSION}
+
+# Cliente OpenAI
+client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+
+
+class EmbeddingMismatchError(ValueError):
+    """
+    El índice guardado se construyó con otro proveedor, modelo o dimensión
+    """
+
+
+class EmbeddingProvider:
+    """
+    Interfaz de un proveedor de embeddings
+    """
+    name = ""
+    # Si conviene generar varios lotes a la vez (peticiones remotas) o de a uno (CPU local)
+    parallel = True
+
+    def __init__(self, model: str, dimension: int):
+        self.model = model
+        self.dimension = dimension
+
+    @property
+    def cache_name(self) -> str:
+        """
+        Nombre del modelo en la caché de embeddings de consultas
+        """
+        return embedding_cache_name(self.describe())
+
+    def describe(self) -> Dict[str, Any]:
+        """
+        Proveedor, modelo y dimensión, tal como se guardan en index_info.json
+        """
+        return {"provider": self.name, "model": self.model, "dimension": self.dimension}
+
+    @property
+    def request_options(self) -> Dict[str, Any]:
+        """
+        Parámetros adicionales de la petición de embeddings a la API
+        """
+        return {}
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """
+        Genera los embeddings de varios textos, en el mismo orden
+        """
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """
+    Embeddings de text-embedding-3-small a través de la API de OpenAI
+    """
+    name = "openai"
+
+    def __init__(self, dimension: int = EMBEDDING_DIMENSION):
+        """
+        Args:
+            dimension: Dimensión de los embeddings (0: los 1536 completos)
+        """
+        if not 0 <= dimension <= MODEL_DIMENSION:
+            raise ValueError(f"RAG_EMBEDDING_DIMENSION debe estar entre 1 y {MODEL_DIMENSION}, o 0 para la "
+                             f"dimensión completa (se indicó {dimension})")
+        super().__init__(MODEL_NAME, dimension or MODEL_DIMENSION)
+
+    @property
+    def request_options(self) -> Dict[str, Any]:
+        # La API devuelve los embeddings acortados y normalizados
+        if self.dimension == MODEL_DIMENSION:
+            return {}
+        return {"dimensions": self.dimension}
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        response = client.embeddings.create(
+            model=self.model,
+            input=texts,
+            **self.request_options
+        )
+        add_tokens("embedding", getattr(response.usage, "total_tokens", 0))
+        # La API devuelve cada embedding con el índice de su entrada
+        ordered = sorted(response.data, key=lambda item: item.index)
+        return [item.embedding for item in ordered]
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    Modelo de sentence-transformers cargado desde disco y ejecutado en el proceso
+
+    No depende de la red. La inferencia se hace por lotes de `batch_size`
+    textos y de a una llamada a la vez, para no repartir la CPU entre hilos.
+    """
+    name = "local"
+    parallel = False
+
+    def __init__(self, model_path: str = LOCAL_EMBEDDING_MODEL, batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE,
+                 device: str = LOCAL_EMBEDDING_DEVICE, dimension: int = EMBEDDING_DIMENSION):
+        """
+        Args:
+            model_path: Carpeta del modelo
+            batch_size: Textos por lote de inferencia
+            device: Dispositivo de torch ("cpu" por defecto)
+            dimension: Truncar los embeddings a esta dimensión (0: sin truncar);
+                solo tiene sentido con modelos entrenados con Matryoshka
+        """
+        if not model_path or not os.path.isdir(model_path):
+            raise ValueError(f"RAG_LOCAL_EMBEDDING_MODEL debe ser la carpeta de un modelo local (se indicó '{model_path}')")
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise RuntimeError("El proveedor de embeddings local necesita el paquete sentence-transformers")
+        print(f"Cargando el modelo de embeddings local desde {model_path}")
+        # Los embeddings se truncan antes de normalizarlos
+        options = {"truncate_dim": dimension} if dimension else {}
+        self.encoder = SentenceTransformer(model_path, device=device, **options)
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        super().__init__(os.path.basename(os.path.normpath(model_path)),
+                         self.encoder.get_sentence_embedding_dimension())
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        with self.lock:
+            vectors = self.encoder.encode(
+                texts,
+                batch_size=self.batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            )
+        return vectors.tolist()
+
+
+def embedding_cache_name(embedding: Dict[str, Any]) -> str:
+    """
+    Nombre en la caché de embeddings de consultas de un proveedor, a partir de su `describe()`
+    """
+    if embedding["provider"] == "openai":
+        # Mismo nombre que antes de existir los proveedores, para conservar la caché
+        if embedding["dimension"] == MODEL_DIMENSION:
+            return embedding["model"]
+        return f"{embedding['model']}:{embedding['dimension']}"
+    # Con la dimensión: un modelo local truncado no debe reutilizar los embeddings completos
+    return f"{embedding['provider']}:{embedding['model']}:{embedding['dimension']}"
+
+
+PROVIDERS = {
+    "openai": OpenAIEmbeddingProvider,
+    "local": LocalEmbeddingProvider,
+}
+
+
+def get_embedding_provider(name: str = EMBEDDING_PROVIDER) -> EmbeddingProvider:
+    """
+    Crea el proveedor de embeddings configurado
+    """
+    if name not in PROVIDERS:
+        raise ValueError(f"Proveedor de embeddings desconocido: {name}. Opciones: {', '.join(PROVIDERS)}")
+    return PROVIDERS[name]()
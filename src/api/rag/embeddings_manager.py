@@ -6,22 +6,149 @@ import json
 import faiss
 import numpy as np
 import hashlib
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional, Tuple
-from openai import OpenAI
 import tiktoken
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from ..metrics import stage_timer, count_retrieval
+from .query_cache import QueryEmbeddingCache
+from .chunk_store import ChunkStore, chunk_hash, read_legacy_texts, import_legacy_metadata
+from .lexical_index import LexicalIndex
+from .segmented_index import (
+    SegmentedIndex, IndexSnapshot, SEGMENTS_DIRNAME, write_segment, read_segment, write_base_rows, read_base_rows,
+    write_originals, read_originals
+)
+from .embedding_providers import (
+    EmbeddingProvider, EmbeddingMismatchError, get_embedding_provider, LEGACY_EMBEDDING
+)
+from .index_factory import (
+    get_index_config, make_config, build_index, apply_search_params, infer_config, index_kind, index_storage,
+    is_quantized, vector_bytes, min_training_size, load_index_info, save_index_info, read_index_mmap, write_index_atomic
+)
 
-# Configuración de la API key
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-MODEL_NAME = "text-embedding-3-small"
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
 
 # Configuración de directorios
-DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+DATA_DIR = os.getenv("RAG_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+# Índice base de versiones anteriores (se distribuye con el repositorio): se
+# lee pero nunca se sobrescribe ni se borra
 INDEX_PATH = os.path.join(DATA_DIR, "faiss_index.bin")
-METADATA_PATH = os.path.join(DATA_DIR, "metadata.json")
+SEGMENTS_DIR = os.path.join(DATA_DIR, SEGMENTS_DIRNAME)
+INDEX_INFO_PATH = os.path.join(DATA_DIR, "index_info.json")
+LOCK_PATH = os.path.join(DATA_DIR, ".rag.lock")
+COMPACTION_LOCK_PATH = os.path.join(DATA_DIR, ".compaction.lock")
+LEXICAL_INDEX_PATH = os.path.join(DATA_DIR, "lexical_index.json")
 
-# Cliente OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Formatos antiguos de metadatos, que se importan al almacén de chunks
+LEGACY_METADATA_PATH = os.path.join(DATA_DIR, "metadata.json")
+LEGACY_CHUNK_TEXTS_PATH = os.path.join(DATA_DIR, "chunk_texts.bin")
+LEGACY_CHUNK_OFFSETS_PATH = os.path.join(DATA_DIR, "chunk_offsets.bin")
+# Marcas de migración terminada: los archivos antiguos se dejan donde están
+# (las versiones anteriores renombraban metadata.json a metadata.json.migrated)
+LEGACY_MIGRATED_PATH = os.path.join(DATA_DIR, ".metadata_migrated")
+LEGACY_MIGRATED_PATHS = (LEGACY_MIGRATED_PATH, f"{LEGACY_METADATA_PATH}.migrated")
+
+# Abrir el índice con mmap en solo lectura para compartir páginas entre workers
+MMAP_INDEX = os.getenv("RAG_MMAP_INDEX", "1") == "1"
+
+# Con un índice base cuantizado (RAG_INDEX_STORAGE=float16, sq8 o pq), pedir
+# top_k por este factor candidatos y reordenarlos con los vectores originales
+# en float32, que se leen del disco con mmap (0 o 1 lo desactiva)
+RESCORE_FACTOR = int(os.getenv("RAG_RESCORE_FACTOR", "4"))
+
+# Recarga en caliente: cada búsqueda comprueba (con un stat de index_info.json)
+# si otro worker publicó una generación nueva, y la carga en segundo plano
+HOT_RELOAD = os.getenv("RAG_HOT_RELOAD", "1") == "1"
+
+# Compactación de los segmentos delta en un índice base nuevo: se lanza en
+# segundo plano tras una ingesta o un borrado que supere alguno de los límites
+BACKGROUND_COMPACTION = os.getenv("RAG_BACKGROUND_COMPACTION", "1") == "1"
+COMPACT_MAX_SEGMENTS = int(os.getenv("RAG_COMPACT_MAX_SEGMENTS", "16"))
+COMPACT_MAX_DELTA_ROWS = int(os.getenv("RAG_COMPACT_MAX_DELTA_ROWS", "2000"))
+COMPACT_MAX_DEAD_FRACTION = float(os.getenv("RAG_COMPACT_MAX_DEAD_FRACTION", "0.2"))
+
+# Configuración de la generación de embeddings por lotes
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("RAG_EMBED_BATCH_MAX_TOKENS", "16000"))
+EMBED_BATCH_MAX_INPUTS = int(os.getenv("RAG_EMBED_BATCH_MAX_INPUTS", "128"))
+EMBED_MAX_WORKERS = int(os.getenv("RAG_EMBED_MAX_WORKERS", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("RAG_EMBED_MAX_RETRIES", "3"))
+EMBED_RETRY_BACKOFF = float(os.getenv("RAG_EMBED_RETRY_BACKOFF", "1.0"))
+
+# Búsqueda híbrida: BM25 + vectores, combinados con Reciprocal Rank Fusion
+LEXICAL_SEARCH = os.getenv("RAG_LEXICAL_SEARCH", "1") == "1"
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+# Candidatos que aporta cada búsqueda a la fusión, como múltiplo de top_k
+HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", "4"))
+# Sin embedding en caché, la búsqueda léxica responde sola si su mejor chunk
+# contiene todos los términos de la consulta y supera por este factor al mejor
+# chunk de otro documento (0 desactiva el atajo)
+LEXICAL_FAST_PATH_MARGIN = float(os.getenv("RAG_LEXICAL_FAST_PATH_MARGIN", "1.5"))
+
+# Consultas como máximo por petición de búsqueda por lotes
+SEARCH_BATCH_MAX_QUERIES = int(os.getenv("RAG_SEARCH_BATCH_MAX_QUERIES", "256"))
+
+# Configuración de la caché de embeddings de consultas
+CACHE_DIR = os.getenv("RAG_CACHE_DIR", os.path.join(DATA_DIR, "cache"))
+QUERY_CACHE_PATH = os.path.join(CACHE_DIR, "query_embeddings.sqlite3")
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("RAG_QUERY_CACHE_MAX_ENTRIES", "1024"))
+QUERY_CACHE_MAX_DISK_ENTRIES = int(os.getenv("RAG_QUERY_CACHE_MAX_DISK_ENTRIES", "100000"))
+
+
+def base_index_path(info: Optional[Dict[str, Any]]) -> str:
+    """
+    Devuelve la ruta del índice base publicado en index_info.json
+    """
+    return os.path.join(DATA_DIR, (info or {}).get("base") or os.path.basename(INDEX_PATH))
+
+
+def parse_document(json_data: Dict[str, Any]) -> Tuple[str, str, str]:
+    """
+    Valida el JSON de un documento y devuelve su título, contenido y fuente
+    
+    Raises:
+        ValueError: Si el JSON no tiene el formato esperado
+    """
+    if not isinstance(json_data, dict):
+        raise ValueError("El JSON debe ser un objeto")
+    
+    if "title" not in json_data or "content" not in json_data:
+        raise ValueError("El JSON debe contener campos 'title' y 'content'")
+    
+    return json_data["title"], json_data["content"], json_data.get("source", "Desconocido")
+
+
+def document_id(title: str, source: str) -> str:
+    """
+    ID de un documento: el mismo título y fuente son el mismo documento
+    """
+    return hashlib.md5(f"{title}_{source}".encode('utf-8')).hexdigest()
+
+
+def legacy_metadata_migrated() -> bool:
+    """
+    Indica si el metadata.json antiguo ya se importó al almacén de chunks
+    """
+    return any(os.path.exists(path) for path in LEGACY_MIGRATED_PATHS)
+
+
+def remove_files(paths: List[str]):
+    """
+    Borra archivos que pueden no existir
+    
+    Los workers que todavía tienen mapeado un índice base anterior siguen
+    leyendo su inodo hasta que lo recargan.
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 class EmbeddingsManager:
     """
@@ -31,142 +158,992 @@ class EmbeddingsManager:
         """
         Inicializa el gestor de embeddings
         """
+        # Tiempo de cada etapa de la inicialización, en segundos
+        self.startup_timings: Dict[str, float] = {}
+        started = time.perf_counter()
+        
         # Crear el directorio de datos si no existe
         os.makedirs(DATA_DIR, exist_ok=True)
         
+        # Compactación de segmentos en segundo plano (ver maybe_compact)
+        self.compaction_thread: Optional[threading.Thread] = None
+        # Recarga de la generación publicada por otro worker (ver current_snapshot)
+        self.reload_thread: Optional[threading.Thread] = None
+        self.reload_lock = threading.Lock()
+        # El almacén se abre después del índice (ver make_snapshot)
+        self.store: Optional[ChunkStore] = None
+        
+        # Proveedor de embeddings (OpenAI o modelo local, según RAG_EMBEDDING_PROVIDER)
+        with self.measure_startup("embedding_provider"):
+            self.embedder: EmbeddingProvider = get_embedding_provider()
+            self.dimension = self.embedder.dimension
+        
         # Inicializar o cargar el índice FAISS
-        self.dimension = 1536  # Dimensión para text-embedding-3-small
-        self.initialize_index()
+        with self.measure_startup("index"):
+            self.initialize_index()
         
-        # Metadata para almacenar información sobre los documentos
-        self.metadata = self.load_metadata()
+        # Codificador para contar tokens al armar los lotes de embeddings
+        with self.measure_startup("tokenizer"):
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+            
+            # Divisor de texto
+            self.text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+                chunk_size=500,
+                chunk_overlap=50
+            )
         
-        # Divisor de texto
-        self.text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            chunk_size=500,
-            chunk_overlap=50
-        )
+        # Almacén de chunks y documentos (fila FAISS -> chunk, id -> documento)
+        with self.measure_startup("chunk_store"):
+            self.store = ChunkStore(DATA_DIR)
+            self.migrate_legacy_metadata()
+            self.check_store_consistency()
+            self.apply_deletions()
+        
+        # Índice léxico (BM25) de los chunks
+        with self.measure_startup("lexical_index"):
+            self.lexical = LexicalIndex(LEXICAL_INDEX_PATH)
+            self.load_lexical_index()
+        
+        # Caché de embeddings de consultas (memoria + disco compartido)
+        with self.measure_startup("query_cache"):
+            self.query_cache = QueryEmbeddingCache(
+                QUERY_CACHE_PATH,
+                max_entries=QUERY_CACHE_MAX_ENTRIES,
+                max_disk_entries=QUERY_CACHE_MAX_DISK_ENTRIES
+            )
+        
+        self.startup_timings["total"] = round(time.perf_counter() - started, 4)
+        print(f"Sistema RAG inicializado en {self.startup_timings['total']:.3f}s: {self.startup_timings}")
+    
+    @contextmanager
+    def measure_startup(self, stage: str):
+        """
+        Mide el tiempo de una etapa de la inicialización
+        """
+        start = time.perf_counter()
+        yield
+        self.startup_timings[stage] = round(time.perf_counter() - start, 4)
+    
+    @contextmanager
+    def store_lock(self, shared: bool = False):
+        """
+        Bloqueo entre procesos (y entre hilos) de los archivos de datos
+        
+        Args:
+            shared: Bloqueo compartido, para leer una generación completa sin
+                que otro worker la modifique a la vez (las escrituras usan el exclusivo)
+        """
+        with open(LOCK_PATH, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    @contextmanager
+    def compaction_lock(self, blocking: bool = True):
+        """
+        Bloqueo exclusivo entre procesos (y entre hilos) para compactar el índice
+        
+        Yields:
+            bool: Si se obtuvo el bloqueo (siempre True si `blocking`)
+        """
+        with open(COMPACTION_LOCK_PATH, 'a') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+            try:
+                yield True
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @property
+    def index(self) -> SegmentedIndex:
+        """
+        Índice de la instantánea en uso
+        """
+        return self.snapshot.index
+    
+    @property
+    def active_index_config(self) -> Dict[str, Any]:
+        """
+        Configuración con la que se construyó el índice en uso
+        """
+        return self.snapshot.index.config
+    
+    @property
+    def committed_rows(self) -> int:
+        """
+        Filas del almacén confirmadas por la instantánea en uso
+        """
+        return self.snapshot.committed_rows
+    
+    @property
+    def index_read_only(self) -> bool:
+        return self.snapshot.index.read_only
 
     def initialize_index(self):
         """
         Inicializa o carga el índice FAISS
+        
+        El tipo de índice deseado se toma de RAG_INDEX_TYPE y RAG_INDEX_STORAGE. El tipo con el que
+        se construyó realmente el índice, sus archivos (índice base y segmentos
+        delta) y la generación se guardan en index_info.json.
         """
-        if os.path.exists(INDEX_PATH):
-            print(f"Cargando índice FAISS desde {INDEX_PATH}")
-            self.index = faiss.read_index(INDEX_PATH)
+        self.index_config = get_index_config()
+        # Última generación de los datos vista en disco: aumenta con cada escritura del índice
+        self.generation = 0
+        self.info_signature = None
+        # Generación en uso por las búsquedas (ver current_snapshot)
+        self.snapshot: Optional[IndexSnapshot] = None
+        os.makedirs(SEGMENTS_DIR, exist_ok=True)
+        
+        info = load_index_info(INDEX_INFO_PATH)
+        if os.path.exists(base_index_path(info)):
+            print(f"Cargando índice FAISS desde {base_index_path(info)}")
+            self.snapshot = self.read_snapshot(info)
+            self.generation = self.snapshot.generation
+            self.check_embedding_provider(info)
+            
+            if index_kind(self.active_index_config) != index_kind(self.index_config):
+                print(f"El índice guardado es de tipo {index_kind(self.active_index_config)} pero se "
+                      f"configuró {index_kind(self.index_config)}; se convertirá en la próxima compactación "
+                      f"o con 'flask rag-rebuild-index'")
         else:
             print(f"Creando nuevo índice FAISS en {INDEX_PATH}")
-            self.index = faiss.IndexFlatL2(self.dimension)
-            # Guardar índice vacío
-            faiss.write_index(self.index, INDEX_PATH)
+            self.create_empty_index()
     
-    def load_metadata(self) -> Dict[str, Any]:
+    def load_index(self, info: Optional[Dict[str, Any]]) -> SegmentedIndex:
         """
-        Carga los metadatos de los documentos
+        Carga el índice base (con mmap si está activado) y los segmentos delta de index_info.json
         """
-        if os.path.exists(METADATA_PATH):
-            with open(METADATA_PATH, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {"documents": [], "chunk_to_doc": {}}
+        base_path = base_index_path(info)
+        if MMAP_INDEX:
+            base, read_only = read_index_mmap(base_path, info["type"] if info else None)
+        else:
+            base, read_only = faiss.read_index(base_path), False
+        config = make_config(info["type"], **info["params"]) if info else infer_config(base)
+        apply_search_params(base, config)
+        
+        info = info or {}
+        rows_name = info.get("base_rows")
+        base_rows = read_base_rows(os.path.join(DATA_DIR, rows_name)) if rows_name else None
+        originals_name = info.get("base_originals")
+        originals = read_originals(os.path.join(DATA_DIR, originals_name)) if originals_name else None
+        index = SegmentedIndex(base, config, os.path.basename(base_path), base_rows, rows_name, read_only,
+                               originals, originals_name)
+        for name in info.get("segments", []):
+            index.add_segment(name, *read_segment(os.path.join(SEGMENTS_DIR, name)))
+        return index
     
-    def save_metadata(self):
+    def read_snapshot(self, info: Optional[Dict[str, Any]],
+                      previous: Optional[IndexSnapshot] = None) -> IndexSnapshot:
         """
-        Guarda los metadatos de los documentos
+        Crea una instantánea de la generación publicada en index_info.json
+        
+        Si el índice base es el de `previous` solo se leen los segmentos nuevos;
+        si no, se carga entero (con mmap, sin copiarlo). `previous` no se
+        modifica. El almacén ya debe estar abierto en esa generación.
+        """
+        info = info or {}
+        segments = info.get("segments", [])
+        if previous is not None and info.get("base") == previous.index.name \
+                and segments[:len(previous.index.segments)] == previous.index.segments:
+            index = previous.index.copy()
+            for name in segments[len(previous.index.segments):]:
+                index.add_segment(name, *read_segment(os.path.join(SEGMENTS_DIR, name)))
+        else:
+            index = self.load_index(info)
+        # Los índices anteriores a los segmentos tienen una fila del almacén por vector
+        return self.make_snapshot(index, info.get("generation", 0), info.get("rows", index.base.ntotal))
+    
+    def make_snapshot(self, index: SegmentedIndex, generation: int, committed_rows: int) -> IndexSnapshot:
+        """
+        Crea una instantánea con las filas muertas del almacén hasta `committed_rows`
+        
+        Aplica las filas muertas a `index`, que no debe estar en uso.
+        """
+        dead = np.zeros(committed_rows, dtype=bool)
+        # Al iniciar el almacén todavía no está abierto: apply_deletions aplica después sus filas muertas
+        if self.store is not None:
+            known = self.store.dead[:committed_rows]
+            dead[:len(known)] = known
+            # Filas confirmadas que faltan en el almacén: no se pueden mostrar
+            dead[len(known):] = True
+        index.set_dead(dead)
+        return IndexSnapshot(generation, index, committed_rows, dead)
+    
+    def use_snapshot(self, snapshot: IndexSnapshot):
+        """
+        Pone en uso una instantánea para las búsquedas nuevas
+        
+        Antes de cambiarla se indexan sus filas nuevas en el índice léxico, para
+        que ninguna búsqueda la vea a medias. Las búsquedas en curso terminan
+        con la instantánea que tomaron.
+        """
+        if LEXICAL_SEARCH:
+            self.lexical.sync(self.store, snapshot.committed_rows)
+        self.snapshot = snapshot
+    
+    def create_empty_index(self):
+        """
+        Crea y guarda un índice vacío con la dimensión del proveedor de embeddings
+        """
+        empty = np.zeros((0, self.dimension), dtype=np.float32)
+        base, config = build_index(self.index_config, self.dimension, empty)
+        generation = (load_index_info(INDEX_INFO_PATH) or {}).get("generation", 0)
+        name = f"faiss_index.{generation:08d}-{os.getpid()}.bin"
+        write_index_atomic(base, os.path.join(DATA_DIR, name))
+        # Guardar índice vacío
+        self.snapshot = self.save_index(SegmentedIndex(base, config, name), 0)
+    
+    def check_embedding_provider(self, info: Optional[Dict[str, Any]]):
+        """
+        Verifica que el índice se haya construido con el proveedor de embeddings configurado
+        
+        Los vectores de modelos distintos no son comparables, así que un índice
+        con datos de otro proveedor, modelo o dimensión no se usa. Un índice
+        vacío simplemente se recrea para el proveedor actual.
+        
+        Raises:
+            EmbeddingMismatchError: Si el índice tiene datos de otro proveedor
         """
-        with open(METADATA_PATH, 'w', encoding='utf-8') as f:
-            json.dump(self.metadata, f, ensure_ascii=False, indent=2)
+        built_with = (info or {}).get("embedding", LEGACY_EMBEDDING)
+        current = self.embedder.describe()
+        if built_with == current and self.index.d == self.dimension:
+            return
+        if self.index.ntotal == 0:
+            print(f"El índice vacío se recrea para los embeddings {current}")
+            with self.store_lock():
+                self.create_empty_index()
+            return
+        raise EmbeddingMismatchError(
+            f"El índice RAG se construyó con los embeddings {built_with} (dimensión {self.index.d}) "
+            f"pero el proveedor configurado es {current}. Vuelve a la configuración anterior "
+            f"o borra {DATA_DIR} y procesa de nuevo los documentos"
+        )
+    
+    def save_index(self, index: SegmentedIndex, committed_rows: int) -> IndexSnapshot:
+        """
+        Publica en index_info.json los archivos del índice y avanza la generación de los datos
+        
+        El índice base y los segmentos ya deben estar escritos: este es el paso
+        que confirma las filas nuevas del almacén, y el reemplazo atómico de
+        index_info.json hace que los demás workers vean la generación entera o
+        nada. La generación se toma del disco, porque otro worker puede haberla
+        avanzado. Debe llamarse con `store_lock` tomado.
+        
+        Args:
+            index: Índice a publicar (una copia, no el de la instantánea en uso)
+            committed_rows: Filas del almacén que confirma
+            
+        Returns:
+            IndexSnapshot: Instantánea de la generación publicada, para `use_snapshot`
+        """
+        info = load_index_info(INDEX_INFO_PATH) or {}
+        self.generation = info.get("generation", 0) + 1
+        save_index_info(INDEX_INFO_PATH, index.config, index, self.generation,
+                        self.embedder.describe(), dict(index.layout(), rows=committed_rows))
+        return self.make_snapshot(index, self.generation, committed_rows)
+    
+    def get_generation(self) -> int:
+        """
+        Devuelve la generación actual de los datos en disco
+        
+        Cambia con cada ingesta o reconstrucción, la haga este worker u otro.
+        index_info.json solo se relee cuando cambia el archivo.
+        """
+        try:
+            stat = os.stat(INDEX_INFO_PATH)
+        except OSError:
+            return self.generation
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if signature != self.info_signature:
+            info = load_index_info(INDEX_INFO_PATH) or {}
+            self.generation = info.get("generation", 0)
+            self.info_signature = signature
+        return self.generation
+    
+    def current_snapshot(self) -> IndexSnapshot:
+        """
+        Devuelve la instantánea con la que responder una búsqueda
+        
+        Si otro worker publicó una generación nueva (basta un stat de
+        index_info.json para saberlo), se carga en un hilo de fondo y mientras
+        tanto se sigue respondiendo con la instantánea actual.
+        """
+        snapshot = self.snapshot
+        if HOT_RELOAD and self.get_generation() != snapshot.generation:
+            self.start_reload()
+        return snapshot
+    
+    def start_reload(self):
+        """
+        Lanza la recarga en un hilo de fondo si no hay otra en curso
+        """
+        if not self.reload_lock.acquire(blocking=False):
+            return
+        try:
+            if self.reload_thread is None or not self.reload_thread.is_alive():
+                self.reload_thread = threading.Thread(target=self.reload, name="rag-reload", daemon=True)
+                self.reload_thread.start()
+        finally:
+            self.reload_lock.release()
+    
+    def reload(self) -> bool:
+        """
+        Carga la última generación publicada y la pone en uso
+        
+        Toma el bloqueo de los datos en modo compartido: espera a que termine
+        la escritura de otro worker, pero no detiene a los demás lectores.
+        
+        Returns:
+            bool: Si se cargó una generación nueva
+        """
+        started = time.perf_counter()
+        try:
+            with self.store_lock(shared=True), stage_timer("index_reload"):
+                info = load_index_info(INDEX_INFO_PATH) or {}
+                previous = self.snapshot
+                if info.get("generation", 0) == previous.generation:
+                    return False
+                self.store.open()
+                self.use_snapshot(self.read_snapshot(info, previous))
+        except Exception as e:
+            print(f"Error al recargar el índice RAG: {str(e)}")
+            return False
+        print(f"Generación {self.snapshot.generation} del índice RAG cargada en "
+              f"{time.perf_counter() - started:.3f}s (antes {previous.generation})")
+        return True
+    
+    def reload_from_disk(self) -> IndexSnapshot:
+        """
+        Pone al día este worker con la última versión publicada de los datos
+        
+        Otro worker puede haber añadido segmentos, borrado documentos o
+        compactado el índice desde la última carga. Debe llamarse con
+        `store_lock` tomado, antes de modificar los datos.
+        
+        Returns:
+            IndexSnapshot: Instantánea de la última generación, ya en uso
+        """
+        info = load_index_info(INDEX_INFO_PATH) or {}
+        if info.get("generation", 0) != self.snapshot.generation:
+            self.store.open()
+            self.use_snapshot(self.read_snapshot(info, self.snapshot))
+        return self.snapshot
+    
+    def apply_deletions(self):
+        """
+        Excluye de las búsquedas vectoriales las filas muertas del almacén
+        """
+        snapshot = self.snapshot
+        self.snapshot = self.make_snapshot(snapshot.index.copy(), snapshot.generation, snapshot.committed_rows)
+    
+    def rebuild_index(self, config: Optional[Dict[str, Any]] = None):
+        """
+        Reconstruye el índice con otro tipo o parámetros, entrenándolo si hace falta
+        
+        Args:
+            config: Configuración del nuevo índice (por defecto la de RAG_INDEX_TYPE)
+        """
+        self.compact(config or self.index_config)
+    
+    def needs_compaction(self) -> bool:
+        """
+        Indica si los segmentos delta o las filas muertas superan los límites
+        configurados, o si ya hay vectores para entrenar el tipo de índice pedido
+        """
+        stats = self.index.stats()
+        if stats["segments"] >= COMPACT_MAX_SEGMENTS or stats["delta_vectors"] >= COMPACT_MAX_DELTA_ROWS:
+            return True
+        if stats["deleted_vectors"] > COMPACT_MAX_DEAD_FRACTION * max(self.index.ntotal, 1):
+            return True
+        return (index_kind(self.active_index_config) != index_kind(self.index_config)
+                and stats["live_vectors"] >= min_training_size(self.index_config))
+    
+    def maybe_compact(self):
+        """
+        Lanza la compactación en un hilo de fondo si hace falta
+        """
+        if not BACKGROUND_COMPACTION or not self.needs_compaction():
+            return
+        if self.compaction_thread is not None and self.compaction_thread.is_alive():
+            return
+        self.compaction_thread = threading.Thread(target=self.compact, name="rag-compaction", daemon=True)
+        self.compaction_thread.start()
+    
+    def compact(self, config: Optional[Dict[str, Any]] = None, wait: bool = False) -> bool:
+        """
+        Escribe un índice base nuevo con los vectores vivos y absorbe los segmentos delta
+        
+        El índice nuevo se construye fuera del bloqueo de escritura, así que las
+        ingestas siguen mientras tanto; los segmentos que lleguen durante la
+        compactación quedan como segmentos del índice nuevo. Solo compacta un
+        proceso a la vez: si ya hay otra en curso, esta se omite o la espera.
+        
+        Args:
+            config: Configuración con la que reconstruir y entrenar el índice. Sin
+                ella se conserva el índice base (y su entrenamiento), salvo que
+                ya haya vectores para pasar al tipo configurado.
+            wait: Esperar a que termine otra compactación en lugar de omitirla
+                (siempre se espera si se indica `config`)
+            
+        Returns:
+            bool: Si se publicó el índice compactado
+        """
+        with self.compaction_lock(blocking=wait or config is not None) as acquired:
+            if not acquired:
+                return False
+            with self.store_lock():
+                snapshot = self.reload_from_disk()
+                index = snapshot.index
+                absorbed = list(index.segments)
+                token = f"{snapshot.generation:08d}-{os.getpid()}"
+            
+            started = time.perf_counter()
+            with stage_timer("index_compaction"):
+                # Copia en memoria del índice base: la que sirve las búsquedas no se toca
+                base = faiss.read_index(os.path.join(DATA_DIR, index.name))
+                rows, vectors = index.live_vectors(base, snapshot.dead)
+                if config is None and index_kind(index.config) != index_kind(self.index_config) \
+                        and len(vectors) >= min_training_size(self.index_config):
+                    config = self.index_config
+                if is_quantized(index.config) and index.originals is None:
+                    print(f"Advertencia: los vectores de un índice {index_kind(index.config)} sin vectores "
+                          f"originales se reconstruyen de forma aproximada")
+                if config is not None:
+                    print(f"Reconstruyendo índice {index_kind(index.config)} -> {index_kind(config)} "
+                          f"con {len(vectors)} vectores...")
+                    base, new_config = build_index(config, self.dimension, vectors)
+                else:
+                    new_config = index.config
+                    base.reset()
+                    if len(vectors):
+                        base.add(vectors)
+                    apply_search_params(base, new_config)
+                name = f"faiss_index.{token}.bin"
+                rows_name = f"faiss_index.{token}.rows.npy"
+                write_index_atomic(base, os.path.join(DATA_DIR, name))
+                write_base_rows(os.path.join(DATA_DIR, rows_name), rows)
+                # Un índice cuantizado conserva los vectores originales para reordenar y compactar
+                originals_name = f"faiss_index.{token}.originals.npy" if is_quantized(new_config) else None
+                if originals_name:
+                    write_originals(os.path.join(DATA_DIR, originals_name), vectors)
+                new_files = [os.path.join(DATA_DIR, file_name) for file_name in (name, rows_name, originals_name)
+                             if file_name]
+            
+            with self.store_lock():
+                current = self.reload_from_disk()
+                if current.index.name != index.name or current.index.segments[:len(absorbed)] != absorbed:
+                    print("El índice cambió de base durante la compactación; se descarta")
+                    remove_files(new_files)
+                    return False
+                
+                remaining = current.index.segments[len(absorbed):]
+                originals = read_originals(os.path.join(DATA_DIR, originals_name)) if originals_name else None
+                compacted = SegmentedIndex(base, new_config, name, rows, rows_name,
+                                           originals=originals, originals_name=originals_name)
+                for segment in remaining:
+                    compacted.add_segment(segment, *read_segment(os.path.join(SEGMENTS_DIR, segment)))
+                self.save_index(compacted, current.committed_rows)
+                
+                # Volver a abrir el índice publicado con mmap, compartido con los demás workers
+                self.use_snapshot(self.read_snapshot(load_index_info(INDEX_INFO_PATH)))
+                # Las búsquedas en curso con la instantánea anterior siguen leyendo
+                # los archivos borrados (mapeados o ya en memoria) hasta terminar
+                remove_files([os.path.join(DATA_DIR, file_name)
+                              for file_name in (index.name, index.rows_name, index.originals_name)
+                              if file_name and file_name != os.path.basename(INDEX_PATH)]
+                             + [os.path.join(SEGMENTS_DIR, segment) for segment in absorbed])
+                self.remove_orphan_files()
+            
+            # El índice léxico se guarda aquí y no en cada ingesta, fuera de
+            # `store_lock`: las filas confirmadas que indexa no cambian
+            if LEXICAL_SEARCH:
+                self.lexical.save()
+        
+        print(f"Índice compactado en {time.perf_counter() - started:.2f}s: {len(rows)} vectores vivos, "
+              f"{len(absorbed)} segmentos absorbidos, {len(remaining)} pendientes")
+        return True
+    
+    def remove_orphan_files(self):
+        """
+        Borra los segmentos e índices base que no figuran en index_info.json
+        
+        Son restos de ingestas o compactaciones interrumpidas. El índice
+        antiguo faiss_index.bin se conserva. Debe llamarse con `store_lock` tomado.
+        """
+        layout = self.index.layout()
+        current = {layout["base"], layout["base_rows"], layout["base_originals"], os.path.basename(INDEX_PATH)}
+        orphans = [os.path.join(SEGMENTS_DIR, name) for name in os.listdir(SEGMENTS_DIR)
+                   if name not in layout["segments"]]
+        orphans += [os.path.join(DATA_DIR, name) for name in os.listdir(DATA_DIR)
+                    if name.startswith("faiss_index.") and name not in current]
+        remove_files(orphans)
+    
+    def count_tokens(self, text: str) -> int:
+        """
+        Cuenta los tokens de un texto con el codificador del modelo de embeddings
+        """
+        return len(self.encoding.encode(text))
+    
+    def load_lexical_index(self):
+        """
+        Carga el índice léxico e indexa los chunks que le falten
+        
+        Si hubo que indexar chunks, el índice actualizado se guarda para los
+        demás workers (las filas confirmadas no cambian, así que no hace falta
+        `store_lock`).
+        """
+        if not LEXICAL_SEARCH:
+            return
+        self.lexical.load()
+        indexed = self.lexical.sync(self.store, self.committed_rows)
+        if not indexed:
+            return
+        print(f"Índice léxico: {indexed} chunks indexados")
+        self.lexical.save()
+    
+    def check_store_consistency(self):
+        """
+        Verifica que el almacén de chunks tenga las filas confirmadas por el índice
+        
+        index_info.json se publica al final de cada ingesta; si hay más filas
+        que las confirmadas, son chunks de una ingesta que no llegó a completarse.
+        """
+        if len(self.store) > self.committed_rows:
+            with self.store_lock():
+                self.store.rollback_to(self.committed_rows)
+        elif len(self.store) < self.committed_rows:
+            print(f"Advertencia: el índice confirma {self.committed_rows} filas "
+                  f"pero hay {len(self.store)} chunks en el almacén")
+        # Almacenes anteriores a chunk_hashes.bin
+        if len(self.store.read_hashes()) < len(self.store):
+            with self.store_lock():
+                self.store.backfill_hashes()
+    
+    def migrate_legacy_metadata(self):
+        """
+        Importa el metadata.json de versiones anteriores al almacén de chunks
+        
+        Los archivos antiguos no se tocan (metadata.json se distribuye con el
+        repositorio): al terminar se crea la marca .metadata_migrated.
+        """
+        if not os.path.exists(LEGACY_METADATA_PATH) or legacy_metadata_migrated():
+            return
+        
+        with self.store_lock():
+            # Otro worker puede haber hecho la migración mientras esperábamos
+            if legacy_metadata_migrated():
+                self.store.open()
+                return
+            
+            with open(LEGACY_METADATA_PATH, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            texts = read_legacy_texts(metadata, LEGACY_CHUNK_TEXTS_PATH, LEGACY_CHUNK_OFFSETS_PATH)
+            if texts is None:
+                print("No se encontraron los textos de los chunks de metadata.json; no se puede migrar")
+                return
+            
+            # Empezar de cero por si una migración anterior quedó a medias
+            self.store.rollback_to(0)
+            imported = import_legacy_metadata(self.store, metadata, texts, self.count_tokens)
+            print(f"Migrados {len(metadata['documents'])} documentos y {imported} chunks desde metadata.json")
+            
+            with open(LEGACY_MIGRATED_PATH, 'w', encoding='utf-8'):
+                pass
     
     def get_embedding(self, text: str) -> List[float]:
         """
         Genera un embedding para el texto proporcionado
         """
-        response = client.embeddings.create(
-            model=MODEL_NAME,
-            input=[text]
-        )
-        embedding = response.data[0].embedding
+        return self.embedder.embed([text])[0]
+    
+    def get_query_embedding(self, query: str) -> np.ndarray:
+        """
+        Devuelve el embedding de una consulta, usando la caché si es posible
+        """
+        embedding = self.query_cache.get(query, self.embedder.cache_name)
+        if embedding is None:
+            embedding = self.query_cache.put(query, self.embedder.cache_name, self.get_embedding(query))
         return embedding
     
-    def process_json_file(self, json_data: Dict[str, Any]) -> str:
+    def get_query_embeddings(self, queries: List[str]) -> np.ndarray:
+        """
+        Devuelve los embeddings de varias consultas, pidiendo en una sola
+        petición los que no están en la caché
+        
+        Returns:
+            np.ndarray: Matriz con un embedding por consulta, en el mismo orden
+        """
+        cache_name = self.embedder.cache_name
+        embeddings = [self.query_cache.get(query, cache_name) for query in queries]
+        # Sin repetir las consultas que aparecen varias veces
+        missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+        if missing:
+            generated = {query: self.query_cache.put(query, cache_name, embedding)
+                         for query, embedding in zip(missing, self.get_embeddings(missing))}
+            embeddings = [generated[query] if embedding is None else embedding
+                          for query, embedding in zip(queries, embeddings)]
+        return np.array(embeddings, dtype=np.float32).reshape(len(queries), self.dimension)
+    
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Genera los embeddings de varios textos en una sola petición (o lote local)
+        """
+        return self.embedder.embed(texts)
+    
+    def make_batches(self, token_counts: List[int]) -> List[List[int]]:
+        """
+        Agrupa los chunks en lotes que respetan el presupuesto de tokens
+        
+        Args:
+            token_counts: Número de tokens de cada chunk
+            
+        Returns:
+            List[List[int]]: Posiciones de los chunks de cada lote
+        """
+        batches = []
+        current = []
+        current_tokens = 0
+        for i, tokens in enumerate(token_counts):
+            # Cerrar el lote actual si el chunk no entra en el presupuesto
+            if current and (current_tokens + tokens > EMBED_BATCH_MAX_TOKENS
+                            or len(current) >= EMBED_BATCH_MAX_INPUTS):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+    
+    def embed_chunks(self, chunks: List[str], token_counts: Optional[List[int]] = None,
+                     checkpoint=None, max_workers: Optional[int] = None,
+                     report: Optional[Dict[str, Any]] = None) -> List[List[float]]:
+        """
+        Genera los embeddings de una lista de chunks en lotes concurrentes
+        
+        Los lotes se envían en paralelo con un pool acotado de hilos. Los lotes
+        que fallan se reintentan en rondas sucesivas sin volver a generar los
+        que ya terminaron bien.
+        
+        Args:
+            chunks: Textos de los chunks
+            token_counts: Tokens de cada chunk (se calculan si no se indican)
+            checkpoint: Dónde guardar cada lote terminado para retomar la
+                ingesta si se interrumpe (ver ingest_jobs.JobCheckpoint):
+                `begin(chunk_count, model, fingerprint)` devuelve los embeddings ya
+                generados por posición y `save(positions, embeddings)` guarda un lote
+            max_workers: Lotes simultáneos (por defecto RAG_EMBED_MAX_WORKERS)
+            report: Diccionario donde dejar el informe de la ingesta (tiempo de
+                cada lote, chunks retomados del checkpoint...)
+            
+        Returns:
+            List[List[float]]: Embeddings en el mismo orden que los chunks
+        """
+        if token_counts is None:
+            token_counts = [self.count_tokens(chunk) for chunk in chunks]
+        done = {}
+        if checkpoint:
+            fingerprint = hashlib.md5("".join(chunk_hash(chunk) for chunk in chunks).encode('utf-8')).hexdigest()
+            done = checkpoint.begin(len(chunks), self.embedder.cache_name, fingerprint)
+        # Solo se generan los chunks que no estaban en el checkpoint
+        todo = [i for i in range(len(chunks)) if i not in done]
+        batches = [[todo[i] for i in batch] for batch in self.make_batches([token_counts[i] for i in todo])]
+        results: Dict[int, List[List[float]]] = {}
+        timings: Dict[int, Dict[str, Any]] = {}
+        errors: Dict[int, str] = {}
+        pending = list(range(len(batches)))
+        started = time.perf_counter()
+        
+        def run_batch(batch_no: int) -> Tuple[int, List[List[float]], float]:
+            texts = [chunks[i] for i in batches[batch_no]]
+            batch_start = time.perf_counter()
+            embeddings = self.get_embeddings(texts)
+            if len(embeddings) != len(texts):
+                raise ValueError(f"Se esperaban {len(texts)} embeddings y se recibieron {len(embeddings)}")
+            return batch_no, embeddings, time.perf_counter() - batch_start
+        
+        workers = max(1, min((max_workers or EMBED_MAX_WORKERS) if self.embedder.parallel else 1, len(batches)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for attempt in range(1, EMBED_MAX_RETRIES + 2):
+                if not pending:
+                    break
+                if attempt > 1:
+                    # Espera exponencial antes de reintentar solo los lotes fallidos
+                    delay = EMBED_RETRY_BACKOFF * (2 ** (attempt - 2))
+                    print(f"Reintentando {len(pending)} lotes fallidos en {delay:.1f}s (intento {attempt})")
+                    time.sleep(delay)
+                
+                futures = {executor.submit(run_batch, batch_no): batch_no for batch_no in pending}
+                failed = []
+                for future, batch_no in futures.items():
+                    try:
+                        _, embeddings, seconds = future.result()
+                    except Exception as e:
+                        errors[batch_no] = str(e)
+                        failed.append(batch_no)
+                        print(f"Error en el lote {batch_no + 1}/{len(batches)}: {str(e)}")
+                        continue
+                    results[batch_no] = embeddings
+                    errors.pop(batch_no, None)
+                    if checkpoint:
+                        checkpoint.save(batches[batch_no], embeddings)
+                    timings[batch_no] = {
+                        "batch": batch_no,
+                        "inputs": len(batches[batch_no]),
+                        "tokens": sum(token_counts[i] for i in batches[batch_no]),
+                        "seconds": round(seconds, 4),
+                        "attempts": attempt
+                    }
+                    print(f"Lote {batch_no + 1}/{len(batches)}: {len(batches[batch_no])} chunks en {seconds:.2f}s")
+                pending = failed
+        
+        if report is not None:
+            report.update({
+                "chunks": len(chunks),
+                "resumed_chunks": len(done),
+                "batches": [timings[b] for b in sorted(timings)],
+                "failed_batches": sorted(errors),
+                "workers": workers,
+                "max_batch_tokens": EMBED_BATCH_MAX_TOKENS,
+                "total_seconds": round(time.perf_counter() - started, 4)
+            })
+        
+        if pending:
+            raise RuntimeError(
+                f"No se pudieron generar embeddings para {len(pending)} de {len(batches)} lotes: "
+                f"{errors[pending[0]]}"
+            )
+        
+        # Reordenar los embeddings según la posición original de cada chunk
+        embeddings = [None] * len(chunks)
+        for position, embedding in done.items():
+            embeddings[position] = embedding
+        for batch_no, batch in enumerate(batches):
+            for position, embedding in zip(batch, results[batch_no]):
+                embeddings[position] = embedding
+        return embeddings
+    
+    def new_chunks(self, documents: List[Dict[str, Any]]) -> Dict[str, Tuple[str, int]]:
+        """
+        Calcula el hash de los chunks de los documentos y devuelve los que no están indexados
+        
+        Un chunk con el mismo texto normalizado que una fila viva (o que otro
+        chunk de estos documentos) no necesita embedding: `write_documents`
+        reutiliza la fila.
+        
+        Args:
+            documents: Documentos con chunks y token_counts (se les añade chunk_hashes)
+            
+        Returns:
+            Dict[str, Tuple[str, int]]: Texto y tokens de cada chunk sin indexar,
+            por hash y en orden de aparición
+        """
+        for document in documents:
+            document["chunk_hashes"] = [chunk_hash(chunk) for chunk in document["chunks"]]
+        existing = self.store.find_rows(h for document in documents for h in document["chunk_hashes"])
+        chunks: Dict[str, Tuple[str, int]] = {}
+        for document in documents:
+            for h, chunk, tokens in zip(document["chunk_hashes"], document["chunks"], document["token_counts"]):
+                if h not in existing and h not in chunks:
+                    chunks[h] = (chunk, tokens)
+        return chunks
+    
+    def embed_new_chunks(self, chunks: Dict[str, Tuple[str, int]], checkpoint=None,
+                         max_workers: Optional[int] = None,
+                         report: Optional[Dict[str, Any]] = None) -> Dict[str, np.ndarray]:
+        """
+        Genera los embeddings de los chunks devueltos por `new_chunks` (ver `embed_chunks`)
+        
+        Returns:
+            Dict[str, np.ndarray]: Vector de cada chunk, por hash
+        """
+        texts = [text for text, _ in chunks.values()]
+        embeddings = self.embed_chunks(texts, [tokens for _, tokens in chunks.values()], checkpoint, max_workers,
+                                       report)
+        return dict(zip(chunks, np.array(embeddings, dtype=np.float32).reshape(-1, self.dimension)))
+    
+    def process_json_file(self, json_data: Dict[str, Any], checkpoint=None,
+                          report: Optional[Dict[str, Any]] = None) -> str:
         """
         Procesa un archivo JSON para generar y almacenar embeddings
         
+        Si ya existe un documento con el mismo título y fuente pero otro
+        contenido, la versión nueva lo reemplaza. Solo se generan embeddings
+        para los chunks cuyo texto no está ya indexado; los demás reutilizan
+        su fila. Los vectores nuevos se guardan en un segmento delta, así que
+        el costo de la escritura es proporcional al documento y no al tamaño
+        del índice.
+        
         Args:
             json_data: Datos JSON a procesar
+            checkpoint: Checkpoint de los lotes de embeddings (ver `embed_chunks`)
+            report: Diccionario donde dejar el informe de esta ingesta (lotes,
+                replaced, reused_chunks); cada llamada usa el suyo, así que
+                varias ingestas simultáneas no se mezclan
             
         Returns:
             str: ID del documento procesado
         """
-        # Verificar formato del JSON
-        if not isinstance(json_data, dict):
-            raise ValueError("El JSON debe ser un objeto")
+        report = {} if report is None else report
         
-        if "title" not in json_data or "content" not in json_data:
-            raise ValueError("El JSON debe contener campos 'title' y 'content'")
-        
-        title = json_data["title"]
-        content = json_data["content"]
-        source = json_data.get("source", "Desconocido")
+        # Verificar formato del JSON
+        title, content, source = parse_document(json_data)
         
         # Generar ID único para el documento
-        doc_id = hashlib.md5(f"{title}_{source}".encode('utf-8')).hexdigest()
+        doc_id = document_id(title, source)
+        content_hash = hashlib.md5(content.encode('utf-8')).hexdigest()
         
-        # Comprobar si ya existe
-        for doc in self.metadata["documents"]:
-            if doc["id"] == doc_id:
-                print(f"El documento '{title}' ya existe en la base de datos")
-                return doc_id
+        # Comprobar si ya existe con el mismo contenido
+        if self.is_unchanged(doc_id, content_hash):
+            print(f"El documento '{title}' ya existe en la base de datos")
+            return doc_id
         
         # Dividir el contenido en chunks
-        chunks = self.text_splitter.split_text(content)
-        
-        # Lista para almacenar los embeddings
-        embeddings = []
-        chunk_ids = []
-        
-        # Generar embeddings para cada chunk
-        print(f"Generando embeddings para {len(chunks)} chunks...")
-        for i, chunk in enumerate(chunks):
-            # Generar ID único para el chunk
-            chunk_id = f"{doc_id}_chunk_{i}"
-            
-            # Generar embedding
-            embedding = self.get_embedding(chunk)
-            
-            # Agregar a la lista
-            embeddings.append(embedding)
-            chunk_ids.append(chunk_id)
-            
-            # Agregar al mapeo de chunk a documento
-            self.metadata["chunk_to_doc"][chunk_id] = {
-                "doc_id": doc_id,
-                "chunk_index": i,
-                "text": chunk
-            }
+        with stage_timer("ingest_chunking"):
+            chunks = self.text_splitter.split_text(content)
+            token_counts = [self.count_tokens(chunk) for chunk in chunks]
         
-        # Convertir lista de embeddings a matriz numpy
-        embeddings_array = np.array(embeddings, dtype=np.float32)
+        document = {"id": doc_id, "title": title, "source": source, "chunks": chunks,
+                    "token_counts": token_counts, "content_hash": content_hash}
         
-        # Agregar embeddings al índice
-        self.index.add(embeddings_array)
+        # Generar por lotes los embeddings de los chunks que no están indexados
+        pending = self.new_chunks([document])
+        print(f"Generando embeddings para {len(pending)} de {len(chunks)} chunks "
+              f"({len(chunks) - len(pending)} ya indexados)...")
+        with stage_timer("ingest_embedding"):
+            vectors = self.embed_new_chunks(pending, checkpoint, report=report)
         
-        # Guardar el índice
-        faiss.write_index(self.index, INDEX_PATH)
+        written = self.write_documents([document], vectors, report)
+        if not written:
+            print(f"El documento '{title}' ya existe en la base de datos")
+            return doc_id
         
-        # Agregar información del documento
-        self.metadata["documents"].append({
-            "id": doc_id,
-            "title": title,
-            "source": source,
-            "chunk_count": len(chunks),
-            "chunk_ids": chunk_ids
-        })
+        replaced = written[doc_id]
+        report["replaced"] = replaced
+        print(f"Documento '{title}' {'reemplazado' if replaced else 'procesado'} con éxito, ID: {doc_id}")
+        return doc_id
+    
+    def write_documents(self, documents: List[Dict[str, Any]], vectors: Dict[str, np.ndarray],
+                        report: Optional[Dict[str, Any]] = None) -> Dict[str, bool]:
+        """
+        Escribe documentos ya divididos en chunks y sus embeddings con una sola publicación
         
-        # Guardar metadatos
-        self.save_metadata()
+        Los chunks cuyo texto ya está en una fila viva la reutilizan, y los
+        repetidos entre los documentos se guardan una vez. Los vectores de las
+        filas nuevas van a un mismo segmento delta, y index_info.json se
+        publica una vez, así que el costo no depende del número de documentos.
         
-        print(f"Documento '{title}' procesado con éxito, ID: {doc_id}")
-        return doc_id
+        Args:
+            documents: Documentos con id, title, source, chunks, token_counts y content_hash
+            vectors: Embedding de cada chunk nuevo, por hash (ver `new_chunks`).
+                Si otro worker borró mientras tanto una fila que se iba a
+                reutilizar, su embedding se genera aquí.
+            
+        Returns:
+            Dict[str, bool]: Si cada documento escrito reemplazó a otra versión.
+            No incluye los que otro worker ya había escrito con el mismo contenido.
+        """
+        with self.store_lock(), stage_timer("ingest_write"):
+            snapshot = self.reload_from_disk()
+            
+            # Otro worker puede haber procesado los mismos documentos mientras tanto
+            keep = [i for i, document in enumerate(documents)
+                    if not self.is_unchanged(document["id"], document["content_hash"])]
+            if not keep:
+                return {}
+            written = {documents[i]["id"]: documents[i]["id"] in self.store.docs_by_id for i in keep}
+            documents = [documents[i] for i in keep]
+            
+            # Descartar chunks huérfanos de una ingesta interrumpida
+            if len(self.store) > snapshot.committed_rows:
+                self.store.rollback_to(snapshot.committed_rows)
+            
+            # Reutilizar las filas vivas con el mismo texto (solo vivas: la
+            # compactación quita los vectores de las filas muertas)
+            self.store.backfill_hashes()
+            for document in documents:
+                if "chunk_hashes" not in document:
+                    document["chunk_hashes"] = [chunk_hash(chunk) for chunk in document["chunks"]]
+            existing = self.store.find_rows(h for document in documents for h in document["chunk_hashes"])
+            missing: Dict[str, Tuple[str, int]] = {}
+            for document in documents:
+                document["chunk_rows"] = [existing.get(h) for h in document["chunk_hashes"]]
+                for h, chunk, tokens in zip(document["chunk_hashes"], document["chunks"], document["token_counts"]):
+                    if h not in existing and h not in vectors:
+                        missing.setdefault(h, (chunk, tokens))
+            if missing:
+                print(f"Generando embeddings para {len(missing)} chunks que ya no están indexados...")
+                vectors = dict(vectors, **self.embed_new_chunks(missing))
+            
+            # Anexar solo los chunks nuevos y los registros de los documentos (que
+            # dejan muertas las filas de las versiones anteriores). Las búsquedas
+            # en curso no ven estas filas: siguen con su instantánea.
+            first_row = len(self.store)
+            self.store.add_documents(documents, dedupe=True)
+            rows = np.arange(first_row, len(self.store), dtype=np.int64)
+            chunk_count = sum(len(document["chunks"]) for document in documents)
+            if report is not None:
+                report["reused_chunks"] = chunk_count - len(rows)
+            
+            # Guardar los embeddings de las filas nuevas en un segmento delta
+            index = snapshot.index.copy()
+            if len(rows):
+                new_vectors = np.stack([vectors[h.decode('ascii')]
+                                        for h in self.store.read_hashes(first_row, len(self.store))])
+                segment = f"delta-{snapshot.generation + 1:08d}.npz"
+                write_segment(os.path.join(SEGMENTS_DIR, segment), rows, new_vectors)
+                index.add_segment(segment, rows, new_vectors)
+            
+            # Publicar el índice (confirma las filas nuevas del almacén) y ponerlo en uso
+            self.use_snapshot(self.save_index(index, len(self.store)))
+        
+        print(f"{len(rows)} chunks nuevos, {chunk_count - len(rows)} reutilizados de filas ya indexadas")
+        self.maybe_compact()
+        return written
+    
+    def is_unchanged(self, doc_id: str, content_hash: str) -> bool:
+        """
+        Indica si el documento ya está indexado con el mismo contenido
+        
+        Los documentos indexados antes de guardar el hash del contenido se
+        reemplazan la primera vez que se vuelven a subir.
+        """
+        doc = self.store.docs_by_id.get(doc_id)
+        return doc is not None and doc.get("content_hash") == content_hash
+    
+    def delete_document(self, doc_id: str) -> bool:
+        """
+        Borra un documento: sus chunks dejan de aparecer en las búsquedas
+        
+        Los vectores se quitan del índice en la siguiente compactación.
+        
+        Returns:
+            bool: False si el documento no existe
+        """
+        with self.store_lock(), stage_timer("ingest_write"):
+            snapshot = self.reload_from_disk()
+            if doc_id not in self.store.docs_by_id:
+                return False
+            if len(self.store) > snapshot.committed_rows:
+                self.store.rollback_to(snapshot.committed_rows)
+            title = self.store.docs_by_id[doc_id]["title"]
+            self.store.delete_document(doc_id)
+            self.use_snapshot(self.save_index(snapshot.index.copy(), snapshot.committed_rows))
+        
+        self.maybe_compact()
+        print(f"Documento '{title}' borrado, ID: {doc_id}")
+        return True
     
     def search(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
         """
@@ -180,63 +1157,332 @@ class EmbeddingsManager:
             List[Dict[str, Any]]: Lista de chunks relevantes con sus metadatos
         """
         # Verificar que el índice no esté vacío
-        if self.index.ntotal == 0:
+        snapshot = self.current_snapshot()
+        if snapshot.index.live_count == 0:
             return []
         
-        # Generar embedding para la consulta
-        query_embedding = self.get_embedding(query)
+        # Con una coincidencia léxica clara no hace falta pedir el embedding
+        lexical = self.lexical_candidates(query, top_k, snapshot)
+        results = self.fast_path_results(query, lexical, top_k)
+        if results is not None:
+            return results
         
-        # Convertir a matriz numpy
-        query_np = np.array([query_embedding], dtype=np.float32)
+        # Generar embedding para la consulta (o recuperarlo de la caché)
+        with stage_timer("query_embedding"):
+            query_embedding = self.get_query_embedding(query)
+        return self.hybrid_search(query, query_embedding, top_k, lexical, snapshot)
+    
+    def fast_path_search(self, query: str, top_k: int = 5) -> Optional[List[Dict[str, Any]]]:
+        """
+        Busca solo en el índice léxico, si su coincidencia es clara
         
-        # Buscar en el índice
-        distances, indices = self.index.search(query_np, min(top_k, self.index.ntotal))
+        Returns:
+            Optional[List[Dict[str, Any]]]: Resultados, o None si hace falta el embedding
+        """
+        snapshot = self.current_snapshot()
+        if snapshot.index.live_count == 0:
+            return []
+        return self.fast_path_results(query, self.lexical_candidates(query, top_k, snapshot), top_k)
+    
+    def lexical_candidates(self, query: str, top_k: int,
+                           snapshot: Optional[IndexSnapshot] = None) -> Tuple[List[Tuple[int, float, int]], int]:
+        """
+        Busca candidatos en el índice léxico
         
-        # Obtener resultados
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if idx == -1:  # En caso de que no haya suficientes resultados
-                continue
-                
-            # Obtener chunk_id correspondiente a este índice
-            chunk_id = list(self.metadata["chunk_to_doc"].keys())[idx]
-            chunk_info = self.metadata["chunk_to_doc"][chunk_id]
-            
-            # Obtener información del documento
-            doc_id = chunk_info["doc_id"]
-            doc_info = next((doc for doc in self.metadata["documents"] if doc["id"] == doc_id), None)
-            
-            if doc_info:
-                results.append({
-                    "chunk_id": chunk_id,
-                    "text": chunk_info["text"],
-                    "distance": float(distances[0][i]),
-                    "document": {
-                        "id": doc_id,
-                        "title": doc_info["title"],
-                        "source": doc_info["source"]
-                    }
-                })
+        Args:
+            query: Texto de la consulta
+            top_k: Número de resultados que se quieren
+            snapshot: Instantánea de los datos (por defecto la actual)
+        
+        Returns:
+            Tuple: (fila, puntuación BM25, términos coincidentes) por candidato y
+            número de términos de la consulta
+        """
+        if not LEXICAL_SEARCH:
+            return [], 0
+        snapshot = snapshot or self.current_snapshot()
+        with stage_timer("lexical_search"):
+            return self.lexical.search(query, top_k * HYBRID_CANDIDATES, snapshot.dead)
+    
+    def fast_path_results(self, query: str, lexical: Tuple[List[Tuple[int, float, int]], int],
+                          top_k: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Devuelve los resultados léxicos si bastan para responder sin embedding
+        
+        Solo se usa cuando el embedding de la consulta no está en caché (si lo
+        está, la búsqueda híbrida no cuesta una llamada a la API), hay al
+        menos top_k chunks que coinciden (el contexto tiene los mismos chunks
+        que con la búsqueda vectorial) y el mejor contiene todos los términos
+        de la consulta con un margen claro sobre el mejor chunk de cualquier
+        otro documento.
+        
+        Returns:
+            Optional[List[Dict[str, Any]]]: Resultados, o None si hace falta la búsqueda híbrida
+        """
+        candidates, term_count = lexical
+        if LEXICAL_FAST_PATH_MARGIN <= 0 or not candidates or len(candidates) < top_k:
+            return None
+        best_row, best_score, matched = candidates[0]
+        if matched < term_count:
+            return None
+        best_doc = self.store.get_doc_number(best_row)
+        runner_up = next((score for row, score, _ in candidates[1:]
+                          if self.store.get_doc_number(row) != best_doc), 0.0)
+        if best_score < LEXICAL_FAST_PATH_MARGIN * runner_up:
+            return None
+        if self.query_cache.contains(query, self.embedder.cache_name):
+            return None
+        count_retrieval("lexical")
+        return [self.make_result(row, bm25=score) for row, score, _ in candidates[:top_k]]
+    
+    def hybrid_search(self, query: str, query_embedding, top_k: int = 5,
+                      lexical: Optional[Tuple[List[Tuple[int, float, int]], int]] = None,
+                      snapshot: Optional[IndexSnapshot] = None) -> List[Dict[str, Any]]:
+        """
+        Combina las búsquedas léxica y vectorial con Reciprocal Rank Fusion
+        
+        Cada chunk suma 1 / (RAG_RRF_K + posición) por cada lista en la que
+        aparece. Sin embedding (por ejemplo si falló la API) se usa solo la
+        búsqueda léxica.
+        
+        Args:
+            query: Texto de la consulta
+            query_embedding: Embedding de la consulta, o None
+            top_k: Número de resultados a devolver
+            lexical: Candidatos léxicos ya calculados (opcional)
+            snapshot: Instantánea con la que se calcularon (por defecto la actual)
+            
+        Returns:
+            List[Dict[str, Any]]: Lista de chunks relevantes con sus metadatos
+        """
+        snapshot = snapshot or self.current_snapshot()
+        if snapshot.index.live_count == 0:
+            return []
+        if lexical is None:
+            lexical = self.lexical_candidates(query, top_k, snapshot)
+        candidates = lexical[0]
+        vector = []
+        if query_embedding is not None:
+            vector = self.vector_candidates(query_embedding, top_k * HYBRID_CANDIDATES if candidates else top_k,
+                                            snapshot)
+        if not candidates:
+            count_retrieval("vector")
+            return [self.make_result(row, distance=distance) for row, distance in vector[:top_k]]
+        if not vector:
+            count_retrieval("lexical")
+            return [self.make_result(row, bm25=score) for row, score, _ in candidates[:top_k]]
         
+        return self.fuse_results(candidates, vector, top_k)
+    
+    def fuse_results(self, candidates: List[Tuple[int, float, int]], vector: List[Tuple[int, float]],
+                     top_k: int) -> List[Dict[str, Any]]:
+        """
+        Combina candidatos léxicos y vectoriales (ambos no vacíos) con Reciprocal Rank Fusion
+        """
+        count_retrieval("hybrid")
+        fused: Dict[int, float] = {}
+        bm25 = {row: score for row, score, _ in candidates}
+        distances = dict(vector)
+        for ranking in ([row for row, _, _ in candidates], [row for row, _ in vector]):
+            for rank, row in enumerate(ranking):
+                fused[row] = fused.get(row, 0.0) + 1.0 / (RRF_K + rank + 1)
+        best = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [self.make_result(row, distance=distances.get(row), bm25=bm25.get(row), rrf=score)
+                for row, score in best]
+    
+    def search_batch(self, queries: List[str], top_k: int = 5,
+                     query_embeddings: Optional[np.ndarray] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Busca varias consultas a la vez
+        
+        Los embeddings que no están en la caché se piden en una sola llamada y
+        el índice FAISS se consulta una sola vez con la matriz de todas las
+        consultas. Cada consulta se combina después con sus candidatos léxicos
+        como en `hybrid_search`; no se usa el atajo léxico, porque el embedding
+        de todo el lote cuesta una sola llamada.
+        
+        Args:
+            queries: Textos de las consultas
+            top_k: Número de resultados por consulta
+            query_embeddings: Embeddings ya calculados, uno por consulta (opcional)
+            
+        Returns:
+            List[List[Dict[str, Any]]]: Resultados de cada consulta, en el mismo orden
+            
+        Raises:
+            ValueError: Si no hay consultas o hay más de RAG_SEARCH_BATCH_MAX_QUERIES
+        """
+        if not queries:
+            raise ValueError("No se proporcionó ninguna consulta")
+        if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+            raise ValueError(f"Se admiten como máximo {SEARCH_BATCH_MAX_QUERIES} consultas por petición")
+        snapshot = self.current_snapshot()
+        if snapshot.index.live_count == 0:
+            return [[] for _ in queries]
+        
+        lexical = [self.lexical_candidates(query, top_k, snapshot) for query in queries]
+        if query_embeddings is None:
+            with stage_timer("query_embedding"):
+                query_embeddings = self.get_query_embeddings(queries)
+        # Una sola búsqueda con los candidatos que necesita la consulta que más pide
+        k = top_k * HYBRID_CANDIDATES if any(candidates for candidates, _ in lexical) else top_k
+        vectors = self.vector_candidates_batch(query_embeddings, k, snapshot)
+        
+        results = []
+        for (candidates, _), vector in zip(lexical, vectors):
+            if not candidates:
+                count_retrieval("vector")
+                results.append([self.make_result(row, distance=distance) for row, distance in vector[:top_k]])
+            elif not vector:
+                count_retrieval("lexical")
+                results.append([self.make_result(row, bm25=score) for row, score, _ in candidates[:top_k]])
+            else:
+                results.append(self.fuse_results(candidates, vector, top_k))
         return results
     
+    def search_by_embedding(self, query_embedding, top_k: int = 5) -> List[Dict[str, Any]]:
+        """
+        Busca los documentos más similares a un embedding de consulta ya calculado
+        
+        Returns:
+            List[Dict[str, Any]]: Lista de chunks relevantes con sus metadatos
+        """
+        return [self.make_result(row, distance=distance)
+                for row, distance in self.vector_candidates(query_embedding, top_k)]
+    
+    def vector_candidates(self, query_embedding, top_k: int,
+                          snapshot: Optional[IndexSnapshot] = None) -> List[Tuple[int, float]]:
+        """
+        Busca en el índice FAISS las filas más cercanas a un embedding
+        
+        Returns:
+            List[Tuple[int, float]]: (fila, distancia) de la más a la menos cercana
+        """
+        return self.vector_candidates_batch(np.array([query_embedding], dtype=np.float32), top_k, snapshot)[0]
+    
+    def vector_candidates_batch(self, query_embeddings: np.ndarray, top_k: int,
+                                snapshot: Optional[IndexSnapshot] = None) -> List[List[Tuple[int, float]]]:
+        """
+        Busca en el índice FAISS las filas más cercanas a varios embeddings con una sola búsqueda
+        
+        Args:
+            query_embeddings: Matriz con un embedding de consulta por fila
+            
+        Returns:
+            List[List[Tuple[int, float]]]: (fila, distancia) de cada consulta, de la más a la menos cercana
+        """
+        index = (snapshot or self.current_snapshot()).index
+        if index.live_count == 0:
+            return [[] for _ in range(len(query_embeddings))]
+        
+        # Buscar en el índice base y en los segmentos delta
+        with stage_timer("faiss_search"):
+            return index.search(np.asarray(query_embeddings, dtype=np.float32), top_k, RESCORE_FACTOR)
+    
+    def make_result(self, row: int, distance: Optional[float] = None, bm25: Optional[float] = None,
+                    rrf: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Arma el resultado de búsqueda de una fila con su chunk y su documento
+        """
+        doc_info = self.store.get_document(row)
+        result = {
+            "chunk_id": self.store.get_chunk_id(row),
+            "text": self.store.get_text(row),
+            "tokens": self.store.get_token_count(row),
+            "distance": distance,
+            "document": {
+                "id": doc_info["id"],
+                "title": doc_info["title"],
+                "source": doc_info["source"]
+            }
+        }
+        # El mismo chunk está en otros documentos vigentes
+        shared = self.store.get_shared_documents(row)
+        if shared:
+            result["other_documents"] = [{"id": doc["id"], "title": doc["title"], "source": doc["source"]}
+                                         for doc in shared]
+        if bm25 is not None:
+            result["bm25"] = round(bm25, 4)
+        if rrf is not None:
+            result["rrf"] = round(rrf, 5)
+        return result
+    
     def get_document_count(self) -> int:
         """
         Devuelve el número de documentos en la base de datos
         """
-        return len(self.metadata["documents"])
+        return len(self.store.docs_by_id)
     
     def get_chunk_count(self) -> int:
         """
-        Devuelve el número total de chunks en la base de datos
+        Devuelve el número de chunks vigentes en la base de datos
         """
-        return self.index.ntotal
+        return self.current_snapshot().index.live_count
     
     def get_document_titles(self) -> List[str]:
         """
         Devuelve la lista de títulos de documentos
         """
-        return [doc["title"] for doc in self.metadata["documents"]]
+        return [doc["title"] for doc in self.store.live_documents]
+    
+    def get_index_info(self) -> Dict[str, Any]:
+        """
+        Devuelve el tipo y los parámetros del índice activo
+        """
+        return {
+            "type": self.active_index_config["type"],
+            "params": self.active_index_config["params"],
+            "configured_type": self.index_config["type"],
+            "storage": index_storage(self.active_index_config),
+            "configured_storage": index_storage(self.index_config),
+            "bytes_per_vector": vector_bytes(self.active_index_config, self.dimension),
+            "rescore_factor": RESCORE_FACTOR if self.index.originals is not None else 0,
+            "embedding": self.embedder.describe(),
+            "generation": self.get_generation(),
+            "loaded_generation": self.snapshot.generation,
+            "segments": self.index.stats()
+        }
+    
+    def get_lexical_index_stats(self) -> Dict[str, Any]:
+        """
+        Devuelve el tamaño del índice léxico
+        """
+        return dict(self.lexical.stats(), enabled=LEXICAL_SEARCH)
+    
+    def get_query_cache_stats(self) -> Dict[str, Any]:
+        """
+        Devuelve los contadores de la caché de embeddings de consultas
+        """
+        return self.query_cache.stats()
+
+class LazyEmbeddingsManager:
+    """
+    Proxy del EmbeddingsManager que lo crea en el primer uso
+    
+    Importar el módulo ya no carga el índice: la carga ocurre en la primera
+    búsqueda o ingesta, o en el proceso maestro de gunicorn si se llama a
+    `initialize()` con preload_app activado.
+    """
+    def __init__(self):
+        self.instance: Optional[EmbeddingsManager] = None
+        self.lock = threading.Lock()
+    
+    def initialize(self) -> EmbeddingsManager:
+        """
+        Crea la instancia real si todavía no existe
+        """
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    self.instance = EmbeddingsManager()
+        return self.instance
+    
+    @property
+    def is_initialized(self) -> bool:
+        return self.instance is not None
+    
+    def __getattr__(self, name):
+        return getattr(self.initialize(), name)
 
-# Instancia singleton
-embeddings_manager = EmbeddingsManager()
\ No newline at end of file
+# Instancia singleton (inicialización diferida)
+embeddings_manager = LazyEmbeddingsManager()
\ No newline at end of file
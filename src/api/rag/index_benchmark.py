@@ -0,0 +1,353 @@
+"""
+Benchmark de recall y latencia de los tipos de índice FAISS soportados.
+
+Compara cada configuración contra la búsqueda exacta (flat) y muestra
+recall@k, latencia p50/p99 por consulta, tiempo de construcción y tamaño.
+Las búsquedas pasan por SegmentedIndex con una fracción de filas borradas
+(--deleted), igual que en producción antes de compactar.
+
+Con --tradeoff compara, para un tipo de índice, la memoria por chunk y el
+recall de cada dimensión de embedding (acortando los vectores como lo hace
+la API de OpenAI) y precisión de almacenamiento, con y sin reordenar los
+candidatos con los vectores originales. Con --from-index usa los vectores
+del corpus y, si las hay, las consultas reales de la caché de consultas.
+
+Uso (desde la carpeta src/):
+    python -m api.rag.index_benchmark --vectors 20000 --queries 200 --k 5
+    python -m api.rag.index_benchmark --from-index
+    python -m api.rag.index_benchmark --configs "hnsw:m=16,ef_search=32;ivf:nlist=256,nprobe=16"
+    python -m api.rag.index_benchmark --configs "flat:storage=pq;flat:storage=sq8" --deleted 0.05
+    python -m api.rag.index_benchmark --from-index --tradeoff --type hnsw --dimensions 1536,512,256
+"""
+import os
+import argparse
+import json
+import math
+import time
+from typing import List, Dict, Any, Optional
+
+import faiss
+import numpy as np
+
+from .index_factory import (
+    STORAGE_TYPES, make_config, build_index, index_kind, is_quantized, vector_bytes, rescore,
+    reconstruct_vectors, load_index_info
+)
+from .segmented_index import SegmentedIndex
+
+
+def synthetic_vectors(count: int, dimension: int, clusters: int = 50, seed: int = 42) -> np.ndarray:
+    """
+    Genera vectores normalizados agrupados en clusters, parecidos a embeddings reales
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    assignment = rng.integers(0, clusters, size=count)
+    vectors = centers[assignment] + 0.6 * rng.standard_normal((count, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def make_queries(vectors: np.ndarray, count: int, seed: int = 7) -> np.ndarray:
+    """
+    Genera consultas perturbando vectores existentes
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(vectors), size=count)
+    queries = vectors[picks] + 0.3 * rng.standard_normal((count, vectors.shape[1])).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries.astype(np.float32)
+
+
+def shorten(vectors: np.ndarray, dimension: int) -> np.ndarray:
+    """
+    Acorta los vectores a sus primeras `dimension` componentes y los normaliza,
+    igual que la API de OpenAI con el parámetro dimensions
+    """
+    vectors = np.array(vectors[:, :dimension], dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return vectors
+
+
+def pq_params(count: int, dimension: int) -> Dict[str, int]:
+    """
+    Subcuantizadores y bits de PQ válidos para la dimensión y el tamaño del corpus
+    """
+    pq_m = next(m for m in (64, 48, 32, 16, 8, 4, 2, 1) if dimension % m == 0)
+    pq_nbits = 8 if count >= 256 else max(1, int(math.log2(max(count, 2))))
+    return {"pq_m": pq_m, "pq_nbits": pq_nbits}
+
+
+def default_configs(count: int, dimension: int) -> List[Dict[str, Any]]:
+    """
+    Configuraciones a comparar, con nlist ajustado al tamaño del corpus
+    """
+    nlist = max(1, min(4096, int(4 * math.sqrt(count))))
+    pq = pq_params(count, dimension)
+    pq_m, pq_nbits = pq["pq_m"], pq["pq_nbits"]
+    return [
+        make_config("flat"),
+        make_config("flat", storage="sq8"),
+        make_config("flat", storage="pq", pq_m=pq_m, pq_nbits=pq_nbits),
+        make_config("ivf", nlist=nlist, nprobe=1),
+        make_config("ivf", nlist=nlist, nprobe=8),
+        make_config("ivf", nlist=nlist, nprobe=32),
+        make_config("hnsw", m=32, ef_search=16),
+        make_config("hnsw", m=32, ef_search=64),
+        make_config("hnsw", m=32, ef_search=128),
+        make_config("ivfpq", nlist=nlist, nprobe=8, pq_m=pq_m, pq_nbits=pq_nbits),
+        make_config("ivfpq", nlist=nlist, nprobe=32, pq_m=pq_m, pq_nbits=pq_nbits),
+    ]
+
+
+def parse_configs(spec: str) -> List[Dict[str, Any]]:
+    """
+    Interpreta configuraciones con el formato "tipo:param=valor,...;tipo:..."
+    """
+    configs = []
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        index_type, _, raw_params = item.partition(":")
+        params = {}
+        for pair in filter(None, raw_params.split(",")):
+            name, _, value = pair.partition("=")
+            params[name.strip()] = int(value) if value.strip().isdigit() else value.strip()
+        configs.append(make_config(index_type.strip(), **params))
+    return configs
+
+
+def run_benchmark(vectors: np.ndarray, queries: np.ndarray, k: int,
+                  configs: List[Dict[str, Any]], deleted: float = 0.0) -> List[Dict[str, Any]]:
+    """
+    Construye cada índice y mide recall@k y latencia frente a la búsqueda exacta
+
+    Args:
+        deleted: Fracción de filas marcadas como borradas, que no deben aparecer en los resultados
+    """
+    dimension = vectors.shape[1]
+    dead = np.zeros(len(vectors), dtype=bool)
+    dead[np.random.default_rng(3).permutation(len(vectors))[:int(len(vectors) * deleted)]] = True
+    live_rows = np.flatnonzero(~dead)
+    exact = faiss.IndexFlatL2(dimension)
+    exact.add(vectors[live_rows])
+    _, ground_truth = exact.search(queries, k)
+    ground_truth = live_rows[ground_truth]
+
+    results = []
+    for config in configs:
+        build_start = time.perf_counter()
+        index, effective = build_index(config, dimension, vectors)
+        build_seconds = time.perf_counter() - build_start
+        segmented = SegmentedIndex(index, effective, "")
+        segmented.set_dead(dead)
+
+        latencies = []
+        hits = 0
+        for i in range(len(queries)):
+            # Una consulta por llamada, igual que en EmbeddingsManager.search
+            start = time.perf_counter()
+            found = segmented.search(queries[i:i + 1], k)[0]
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += len({row for row, _ in found} & set(ground_truth[i]))
+
+        results.append({
+            "type": effective["type"],
+            "params": effective["params"],
+            "recall_at_k": round(hits / (len(queries) * k), 4),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 4),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 4),
+            "build_seconds": round(build_seconds, 3),
+            "index_bytes": int(faiss.serialize_index(index).size),
+        })
+    return results
+
+
+def run_tradeoff(vectors: np.ndarray, queries: np.ndarray, k: int, index_type: str, dimensions: List[int],
+                 storages: List[str], rescore_factor: int) -> List[Dict[str, Any]]:
+    """
+    Mide memoria por vector y recall@k de cada dimensión y precisión de almacenamiento
+
+    El recall se mide contra la búsqueda exacta con los vectores completos,
+    así que incluye lo que se pierde al acortar los embeddings.
+    """
+    full_dimension = vectors.shape[1]
+    exact = faiss.IndexFlatL2(full_dimension)
+    exact.add(vectors)
+    _, ground_truth = exact.search(queries, k)
+    full_bytes = vector_bytes(make_config("flat"), full_dimension)
+
+    results = []
+    for dimension in dimensions:
+        short_vectors = shorten(vectors, dimension) if dimension < full_dimension else vectors
+        short_queries = shorten(queries, dimension) if dimension < full_dimension else queries
+        for storage in storages:
+            params = dict(storage=storage, **(pq_params(len(vectors), dimension) if storage == "pq" else {}))
+            index, effective = build_index(make_config(index_type, **params), dimension, short_vectors)
+            index_bytes = int(faiss.serialize_index(index).size)
+            factors = [0, rescore_factor] if is_quantized(effective) and rescore_factor > 1 else [0]
+            for factor in factors:
+                latencies = []
+                hits = 0
+                for i in range(len(queries)):
+                    start = time.perf_counter()
+                    _, found = index.search(short_queries[i:i + 1], k * factor if factor else k)
+                    found = found[0]
+                    if factor:
+                        found, _ = rescore(short_queries[i], found[found != -1], short_vectors, k)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    hits += len(set(found) & set(ground_truth[i]))
+                code_bytes = vector_bytes(effective, dimension)
+                results.append({
+                    "dimension": dimension,
+                    "index": index_kind(effective),
+                    "params": effective["params"],
+                    "rescore_factor": factor,
+                    "code_bytes": code_bytes,
+                    "bytes_per_vector": round(index_bytes / max(len(vectors), 1), 1),
+                    "reduction": round(full_bytes / code_bytes, 1),
+                    "index_bytes": index_bytes,
+                    "recall_at_k": round(hits / (len(queries) * k), 4),
+                    "p50_ms": round(float(np.percentile(latencies, 50)), 4),
+                    "p99_ms": round(float(np.percentile(latencies, 99)), 4),
+                })
+    return results
+
+
+def print_tradeoff(results: List[Dict[str, Any]], k: int):
+    """
+    Muestra la comparación de memoria y recall como tabla
+    """
+    print(f"{'dim':>5} {'índice':<14} {'rescore':>7} {'B/código':>9} {'B/vector':>9} {'reducción':>9} "
+          f"{'recall@' + str(k):>9} {'p50 ms':>8} {'p99 ms':>8} {'MB':>8}")
+    for row in results:
+        rescore_label = f"x{row['rescore_factor']}" if row["rescore_factor"] else "-"
+        print(f"{row['dimension']:>5} {row['index']:<14} {rescore_label:>7} {row['code_bytes']:>9.0f} "
+              f"{row['bytes_per_vector']:>9.1f} {row['reduction']:>8.1f}x {row['recall_at_k']:>9.4f} "
+              f"{row['p50_ms']:>8.3f} {row['p99_ms']:>8.3f} {row['index_bytes'] / 1e6:>8.2f}")
+
+
+def corpus_vectors() -> np.ndarray:
+    """
+    Vectores vivos del índice publicado: índice base y segmentos delta, sin
+    las filas de documentos borrados o reemplazados
+    """
+    from .embeddings_manager import DATA_DIR, INDEX_INFO_PATH, SEGMENTS_DIR, base_index_path
+    from .chunk_store import ChunkStore
+    from .segmented_index import read_base_rows, read_originals, read_segment
+
+    info = load_index_info(INDEX_INFO_PATH) or {}
+    if info.get("base_originals"):
+        base_vectors = np.asarray(read_originals(os.path.join(DATA_DIR, info["base_originals"])))
+    else:
+        base_vectors = reconstruct_vectors(faiss.read_index(base_index_path(info)))
+    if info.get("base_rows"):
+        base_rows = np.asarray(read_base_rows(os.path.join(DATA_DIR, info["base_rows"])))
+    else:
+        base_rows = np.arange(len(base_vectors), dtype=np.int64)
+    rows, vectors = [base_rows], [base_vectors]
+    for name in info.get("segments", []):
+        segment_rows, segment_vectors = read_segment(os.path.join(SEGMENTS_DIR, name))
+        rows.append(segment_rows)
+        vectors.append(segment_vectors)
+    rows, vectors = np.concatenate(rows), np.concatenate(vectors)
+
+    dead = ChunkStore(DATA_DIR).dead
+    keep = np.zeros(len(rows), dtype=bool)
+    known = rows < len(dead)
+    keep[known] = ~dead[rows[known]]
+    return np.ascontiguousarray(vectors[keep], dtype=np.float32)
+
+
+def cached_queries(dimension: int, count: int) -> Optional[np.ndarray]:
+    """
+    Embeddings de consultas reales de la caché de consultas, si son del
+    proveedor con el que se construyó el índice
+    """
+    from .embeddings_manager import INDEX_INFO_PATH, QUERY_CACHE_PATH
+    from .embedding_providers import LEGACY_EMBEDDING, embedding_cache_name
+    from .query_cache import QueryEmbeddingCache
+
+    if not os.path.exists(QUERY_CACHE_PATH):
+        return None
+    embedding = (load_index_info(INDEX_INFO_PATH) or {}).get("embedding", LEGACY_EMBEDDING)
+    queries = QueryEmbeddingCache(QUERY_CACHE_PATH).sample(embedding_cache_name(embedding), count)
+    if len(queries) == 0 or queries.shape[1] != dimension:
+        return None
+    return np.ascontiguousarray(queries)
+
+
+def print_report(results: List[Dict[str, Any]], k: int):
+    """
+    Muestra los resultados como tabla
+    """
+    print(f"{'tipo':<7} {'parámetros':<48} {'recall@' + str(k):>9} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'build s':>8} {'MB':>8}")
+    for row in results:
+        params = ",".join(f"{name}={value}" for name, value in row["params"].items())
+        print(f"{row['type']:<7} {params:<48} {row['recall_at_k']:>9.4f} {row['p50_ms']:>8.3f} "
+              f"{row['p99_ms']:>8.3f} {row['build_seconds']:>8.2f} {row['index_bytes'] / 1e6:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de índices FAISS para el sistema RAG")
+    parser.add_argument("--vectors", type=int, default=20000, help="Número de vectores sintéticos")
+    parser.add_argument("--dimension", type=int, default=1536, help="Dimensión de los vectores sintéticos")
+    parser.add_argument("--queries", type=int, default=200, help="Número de consultas")
+    parser.add_argument("--k", type=int, default=5, help="Resultados por consulta")
+    parser.add_argument("--from-index", action="store_true",
+                        help="Usar los vectores del índice publicado y las consultas de la caché")
+    parser.add_argument("--configs", default=None, help="Configuraciones a comparar (tipo:param=valor;...)")
+    parser.add_argument("--tradeoff", action="store_true",
+                        help="Comparar memoria y recall por dimensión y precisión de almacenamiento")
+    parser.add_argument("--type", dest="index_type", default="flat", help="Tipo de índice de --tradeoff")
+    parser.add_argument("--dimensions", default=None,
+                        help="Dimensiones de --tradeoff, separadas por comas (por defecto la completa, 1/2, 1/3 y 1/6)")
+    parser.add_argument("--storages", default=",".join(STORAGE_TYPES),
+                        help="Precisiones de --tradeoff, separadas por comas")
+    parser.add_argument("--rescore", type=int, default=4,
+                        help="Factor de candidatos reordenados con los vectores originales (0 para no medirlo)")
+    parser.add_argument("--deleted", type=float, default=0.01,
+                        help="Fracción de filas borradas que las búsquedas deben filtrar")
+    parser.add_argument("--json", dest="json_path", default=None, help="Guardar los resultados en un archivo JSON")
+    args = parser.parse_args()
+
+    queries = None
+    if args.from_index:
+        vectors = corpus_vectors()
+        if len(vectors) == 0:
+            parser.error("El índice publicado no tiene vectores")
+        queries = cached_queries(vectors.shape[1], args.queries)
+    else:
+        vectors = synthetic_vectors(args.vectors, args.dimension)
+    if queries is None:
+        queries = make_queries(vectors, args.queries)
+        query_source = "sintéticas"
+    else:
+        query_source = "de la caché de consultas"
+    k = min(args.k, len(vectors))
+    print(f"Benchmark con {len(vectors)} vectores de dimensión {vectors.shape[1]}, "
+          f"{len(queries)} consultas {query_source}, k={k}")
+
+    if args.tradeoff:
+        full_dimension = vectors.shape[1]
+        if args.dimensions:
+            dimensions = [int(value) for value in args.dimensions.split(",")]
+        else:
+            dimensions = [full_dimension, full_dimension // 2, full_dimension // 3, full_dimension // 6]
+        dimensions = [dimension for dimension in dimensions if 0 < dimension <= full_dimension]
+        storages = [storage.strip() for storage in args.storages.split(",") if storage.strip()]
+        results = run_tradeoff(vectors, queries, k, args.index_type, dimensions, storages, args.rescore)
+        print_tradeoff(results, k)
+    else:
+        configs = parse_configs(args.configs) if args.configs else default_configs(len(vectors), vectors.shape[1])
+        results = run_benchmark(vectors, queries, k, configs, args.deleted)
+        print_report(results, k)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({"vectors": len(vectors), "dimension": int(vectors.shape[1]),
+                       "queries": len(queries), "k": k, "results": results}, f, indent=2)
+        print(f"Resultados guardados en {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""
+Fábrica de índices FAISS configurables (flat, IVF, HNSW e IVF-PQ).
+
+Los índices flat, IVF y HNSW pueden guardar los vectores en float32, en
+float16, cuantizados a 8 bits por dimensión (sq8) o con cuantización de
+producto (pq), para ocupar entre 2 y 100 veces menos memoria por chunk.
+"""
+import os
+import json
+from typing import Dict, Any, Optional
+
+import faiss
+import numpy as np
+
+# Tipos de índice soportados y los que necesitan entrenamiento previo
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+TRAINED_INDEX_TYPES = ("ivf", "ivfpq")
+
+# Parámetros por defecto de cada tipo de índice
+DEFAULT_PARAMS = {
+    "flat": {"storage": "float32"},
+    "ivf": {"nlist": 100, "nprobe": 8, "storage": "float32"},
+    "hnsw": {"m": 32, "ef_construction": 200, "ef_search": 64, "storage": "float32"},
+    "ivfpq": {"nlist": 100, "nprobe": 8, "pq_m": 64, "pq_nbits": 8},
+}
+
+# Precisión con la que los índices flat, IVF y HNSW guardan los vectores
+STORAGE_TYPES = ("float32", "float16", "sq8", "pq")
+SCALAR_QUANTIZERS = {"float16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}
+# Parámetros de la cuantización de producto con storage=pq
+PQ_PARAMS = {"pq_m": 64, "pq_nbits": 8}
+# Vectores mínimos para entrenar los rangos de sq8
+SQ8_MIN_TRAINING = 256
+
+
+def get_index_config() -> Dict[str, Any]:
+    """
+    Lee la configuración del índice desde las variables de entorno
+
+    RAG_INDEX_TYPE elige el tipo (flat por defecto), RAG_INDEX_STORAGE la
+    precisión de los vectores (float32 por defecto) y RAG_IVF_NLIST,
+    RAG_IVF_NPROBE, RAG_HNSW_M, RAG_HNSW_EF_CONSTRUCTION, RAG_HNSW_EF_SEARCH,
+    RAG_PQ_M y RAG_PQ_NBITS ajustan sus parámetros.
+    """
+    index_type = os.getenv("RAG_INDEX_TYPE", "flat").lower()
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Tipo de índice no soportado: {index_type}. Opciones: {', '.join(INDEX_TYPES)}")
+    storage = os.getenv("RAG_INDEX_STORAGE", "float32").lower()
+
+    env_names = {
+        "nlist": "RAG_IVF_NLIST",
+        "nprobe": "RAG_IVF_NPROBE",
+        "m": "RAG_HNSW_M",
+        "ef_construction": "RAG_HNSW_EF_CONSTRUCTION",
+        "ef_search": "RAG_HNSW_EF_SEARCH",
+        "pq_m": "RAG_PQ_M",
+        "pq_nbits": "RAG_PQ_NBITS",
+    }
+    config = make_config(index_type, storage=storage)
+    params = config["params"]
+    for name, env_name in env_names.items():
+        value = os.getenv(env_name)
+        if name in params and value:
+            params[name] = int(value)
+    return config
+
+
+def make_config(index_type: str, **params) -> Dict[str, Any]:
+    """
+    Crea una configuración de índice completando los parámetros por defecto
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Tipo de índice no soportado: {index_type}. Opciones: {', '.join(INDEX_TYPES)}")
+    storage = params.get("storage", DEFAULT_PARAMS[index_type].get("storage"))
+    if index_type == "ivf" and storage == "pq":
+        # IVF con cuantización de producto es el tipo ivfpq
+        index_type = "ivfpq"
+    if index_type == "ivfpq":
+        params = {name: value for name, value in params.items() if name != "storage"}
+    merged = dict(DEFAULT_PARAMS[index_type])
+    if index_type != "ivfpq":
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Precisión de vectores no soportada: {storage}. Opciones: {', '.join(STORAGE_TYPES)}")
+        if storage == "pq":
+            merged.update(PQ_PARAMS)
+    merged.update(params)
+    return {"type": index_type, "params": merged}
+
+
+def index_storage(config: Dict[str, Any]) -> str:
+    """
+    Precisión con la que el índice guarda los vectores (ivfpq siempre usa pq)
+    """
+    return "pq" if config["type"] == "ivfpq" else config["params"].get("storage", "float32")
+
+
+def index_kind(config: Dict[str, Any]) -> str:
+    """
+    Tipo de índice y precisión de los vectores, p. ej. "hnsw" o "hnsw/sq8"
+    """
+    storage = config["params"].get("storage", "float32")
+    return config["type"] if storage == "float32" else f"{config['type']}/{storage}"
+
+
+def is_quantized(config: Dict[str, Any]) -> bool:
+    """
+    Indica si el índice guarda los vectores con pérdida (y conviene conservar los originales)
+    """
+    return index_storage(config) != "float32"
+
+
+def vector_bytes(config: Dict[str, Any], dimension: int) -> float:
+    """
+    Bytes que ocupa el código de cada vector en el índice (sin el grafo HNSW ni las listas IVF)
+    """
+    params = config["params"]
+    storage = index_storage(config)
+    if storage == "pq":
+        return params["pq_m"] * params["pq_nbits"] / 8
+    return dimension * {"float32": 4, "float16": 2, "sq8": 1}[storage]
+
+
+def min_training_size(config: Dict[str, Any]) -> int:
+    """
+    Devuelve el número mínimo de vectores necesarios para entrenar el índice
+    """
+    params = config["params"]
+    size = params["nlist"] if config["type"] in TRAINED_INDEX_TYPES else 0
+    storage = index_storage(config)
+    if storage == "pq":
+        size = max(size, 2 ** params["pq_nbits"])
+    elif storage == "sq8":
+        size = max(size, SQ8_MIN_TRAINING)
+    return size
+
+
+def create_index(config: Dict[str, Any], dimension: int) -> faiss.Index:
+    """
+    Crea un índice vacío (sin entrenar) según la configuración
+    """
+    index_type = config["type"]
+    params = config["params"]
+    storage = index_storage(config)
+    if storage == "pq" and dimension % params["pq_m"] != 0:
+        raise ValueError(f"La dimensión {dimension} debe ser múltiplo de pq_m={params['pq_m']}")
+
+    if index_type == "flat":
+        if storage == "float32":
+            return faiss.IndexFlatL2(dimension)
+        if storage == "pq":
+            return faiss.IndexPQ(dimension, params["pq_m"], params["pq_nbits"], faiss.METRIC_L2)
+        return faiss.IndexScalarQuantizer(dimension, SCALAR_QUANTIZERS[storage], faiss.METRIC_L2)
+
+    if index_type == "hnsw":
+        if storage == "float32":
+            index = faiss.IndexHNSWFlat(dimension, params["m"])
+        elif storage == "pq":
+            index = faiss.IndexHNSWPQ(dimension, params["pq_m"], params["m"], params["pq_nbits"])
+        else:
+            index = faiss.IndexHNSWSQ(dimension, SCALAR_QUANTIZERS[storage], params["m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+        return index
+
+    quantizer = faiss.IndexFlatL2(dimension)
+    if storage == "pq":
+        return faiss.IndexIVFPQ(quantizer, dimension, params["nlist"], params["pq_m"], params["pq_nbits"])
+    if index_type == "ivf":
+        if storage == "float32":
+            return faiss.IndexIVFFlat(quantizer, dimension, params["nlist"], faiss.METRIC_L2)
+        return faiss.IndexIVFScalarQuantizer(quantizer, dimension, params["nlist"], SCALAR_QUANTIZERS[storage],
+                                             faiss.METRIC_L2)
+
+    raise ValueError(f"Tipo de índice no soportado: {index_type}")
+
+
+def apply_search_params(index: faiss.Index, config: Dict[str, Any]):
+    """
+    Aplica los parámetros de búsqueda (nprobe, efSearch) que FAISS no persiste
+    """
+    params = config["params"]
+    if config["type"] in TRAINED_INDEX_TYPES:
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+    elif config["type"] == "hnsw":
+        index.hnsw.efSearch = params["ef_search"]
+
+
+def supports_selector(index: faiss.Index) -> bool:
+    """
+    Indica si el índice acepta un IDSelector en los parámetros de búsqueda
+
+    IndexPQ (flat con storage=pq) lo rechaza con cualquier SearchParameters.
+    """
+    return not isinstance(faiss.downcast_index(index), faiss.IndexPQ)
+
+
+def make_search_params(config: Dict[str, Any], selector) -> faiss.SearchParameters:
+    """
+    Parámetros de búsqueda con un filtro de filas (IDSelector)
+
+    Los parámetros explícitos sustituyen a nprobe y efSearch del índice, así
+    que se copian de la configuración.
+    """
+    params = config["params"]
+    if config["type"] in TRAINED_INDEX_TYPES:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=params["nprobe"])
+    if config["type"] == "hnsw":
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=params["ef_search"])
+    return faiss.SearchParameters(sel=selector)
+
+
+def build_index(config: Dict[str, Any], dimension: int, vectors: np.ndarray):
+    """
+    Crea, entrena y llena un índice con los vectores proporcionados
+
+    Si el tipo pedido necesita entrenamiento y todavía no hay vectores
+    suficientes, se usa un índice flat hasta la próxima reconstrucción.
+
+    Returns:
+        Tuple[faiss.Index, Dict[str, Any]]: Índice y configuración efectiva
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if len(vectors) < min_training_size(config):
+        print(f"No hay vectores suficientes para entrenar un índice {index_kind(config)} "
+              f"({len(vectors)} < {min_training_size(config)}), se usará flat")
+        config = make_config("flat")
+
+    index = create_index(config, dimension)
+    if not index.is_trained:
+        print(f"Entrenando índice {index_kind(config)} con {len(vectors)} vectores...")
+        index.train(vectors)
+    if len(vectors):
+        index.add(vectors)
+    apply_search_params(index, config)
+    return index, config
+
+
+def reconstruct_vectors(index: faiss.Index) -> np.ndarray:
+    """
+    Recupera todos los vectores almacenados en un índice, en orden de fila
+
+    Para los índices cuantizados (sq8, pq, IVF-PQ) la reconstrucción es aproximada.
+    """
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def infer_config(index: faiss.Index) -> Dict[str, Any]:
+    """
+    Deduce la configuración de un índice guardado sin metadatos
+    """
+    def storage_params(codes) -> Dict[str, Any]:
+        codes = faiss.downcast_index(codes) if isinstance(codes, faiss.Index) else codes
+        if isinstance(codes, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+            return {"storage": "pq", "pq_m": codes.pq.M, "pq_nbits": codes.pq.nbits}
+        if isinstance(codes, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+            qtype = codes.sq.qtype
+            return {"storage": next(name for name, value in SCALAR_QUANTIZERS.items() if value == qtype)}
+        return {"storage": "float32"}
+
+    if isinstance(index, faiss.IndexHNSW):
+        return make_config("hnsw", m=index.hnsw.nb_neighbors(1),
+                           ef_construction=index.hnsw.efConstruction,
+                           ef_search=index.hnsw.efSearch, **storage_params(index.storage))
+    if isinstance(index, faiss.IndexIVFPQ):
+        return make_config("ivfpq", nlist=index.nlist, nprobe=index.nprobe,
+                           pq_m=index.pq.M, pq_nbits=index.pq.nbits)
+    if isinstance(index, faiss.IndexIVF):
+        return make_config("ivf", nlist=index.nlist, nprobe=index.nprobe, **storage_params(index))
+    return make_config("flat", **storage_params(index))
+
+
+def rescore(query: np.ndarray, rows: np.ndarray, vectors: np.ndarray, k: int):
+    """
+    Reordena candidatos por su distancia exacta a la consulta
+
+    Args:
+        query: Embedding de la consulta
+        rows: Posición de cada candidato en `vectors` (sin -1)
+        vectors: Vectores originales en float32 (suele ser un mmap en disco)
+        k: Candidatos que se conservan
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Posiciones y distancias L2 al cuadrado, de menor a mayor
+    """
+    if len(rows) == 0:
+        return rows, np.zeros(0, dtype=np.float32)
+    # Leer las filas en orden mejora el acceso al mmap
+    order = np.argsort(rows)
+    candidates = np.asarray(vectors[rows[order]], dtype=np.float32)
+    distances = ((candidates - query) ** 2).sum(axis=1)
+    best = np.argsort(distances, kind='stable')[:k]
+    return rows[order][best], distances[best]
+
+
+def read_index_mmap(path: str, index_type: Optional[str] = None):
+    """
+    Abre un índice guardado con mmap y en modo solo lectura
+
+    Los índices IVF mapean sus listas invertidas (IO_FLAG_MMAP) y el resto
+    mapea directamente sus códigos (IO_FLAG_MMAP_IFC, en versiones recientes
+    de FAISS). Si ninguna opción es compatible se carga en memoria.
+
+    Returns:
+        Tuple[faiss.Index, bool]: Índice y si quedó mapeado en solo lectura
+    """
+    flags = [faiss.IO_FLAG_MMAP]
+    if index_type not in TRAINED_INDEX_TYPES and hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        flags.insert(0, faiss.IO_FLAG_MMAP_IFC)
+    for flag in flags:
+        try:
+            return faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY), True
+        except RuntimeError:
+            continue
+    return faiss.read_index(path), False
+
+
+def write_index_atomic(index: faiss.Index, path: str):
+    """
+    Escribe el índice en un archivo temporal y lo renombra sobre el original
+
+    Los workers que tienen el archivo anterior mapeado siguen leyendo el
+    inodo viejo en lugar de ver un archivo a medio escribir.
+    """
+    tmp_path = f"{path}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_index_info(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Carga los metadatos del índice guardados junto a faiss_index.bin
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_index_info(path: str, config: Dict[str, Any], index: faiss.Index, generation: int = 0,
+                    embedding: Optional[Dict[str, Any]] = None, layout: Optional[Dict[str, Any]] = None):
+    """
+    Guarda el tipo, los parámetros, el tamaño, la generación del índice, el
+    proveedor de embeddings con el que se construyó y los archivos que lo
+    forman (índice base y segmentos delta)
+    """
+    info = {
+        "type": config["type"],
+        "params": config["params"],
+        "dimension": index.d,
+        "ntotal": index.ntotal,
+        "generation": generation,
+    }
+    if embedding is not None:
+        info["embedding"] = embedding
+    if layout is not None:
+        info.update(layout)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
@@ -0,0 +1,422 @@
+"""
+Cola de trabajos de ingesta: las subidas se procesan en segundo plano.
+
+Cada trabajo es una carpeta de jobs/ con el documento subido
+(document.json), su estado (job.json) y los embeddings de los lotes ya
+generados (batches/). Cualquier worker puede consultar el estado de un
+trabajo. Lo procesa el worker que toma su bloqueo de archivo; si ese
+proceso muere, otro worker lo retoma desde el último lote completado.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+from .embeddings_manager import embeddings_manager, DATA_DIR, parse_document, document_id
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+JOBS_DIR = os.path.join(DATA_DIR, "jobs")
+# Trabajos que procesa a la vez cada worker (las escrituras al índice ya se serializan)
+INGEST_WORKERS = int(os.getenv("RAG_INGEST_WORKERS", "1"))
+# Veces que se retoma un trabajo cuyo proceso murió antes de marcarlo como fallido
+INGEST_MAX_ATTEMPTS = int(os.getenv("RAG_INGEST_MAX_ATTEMPTS", "3"))
+# Horas que se conservan los trabajos terminados
+INGEST_JOB_RETENTION_HOURS = float(os.getenv("RAG_INGEST_JOB_RETENTION_HOURS", "72"))
+
+PENDING_STATUSES = ("queued", "running")
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def write_json_atomic(path: str, data: Dict[str, Any]):
+    """
+    Escribe un JSON de forma atómica (los lectores ven el anterior o el nuevo)
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class BatchCheckpoint:
+    """
+    Lotes de embeddings ya generados de una ingesta, para retomarla tras un fallo
+
+    Cada lote se guarda en <carpeta>/<posición>.npz con las posiciones de sus
+    chunks y sus vectores. La división en chunks es determinista, pero los
+    chunks que necesitan embedding dependen de lo que ya está indexado, así
+    que las posiciones solo sirven entre intentos mientras no cambien esos
+    chunks ni el modelo de embeddings (checkpoint.json).
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        # Chunks con embedding, incluidos los retomados
+        self.embedded = 0
+
+    def begin(self, chunk_count: int, model: str, fingerprint: Optional[str] = None) -> Dict[int, np.ndarray]:
+        """
+        Devuelve los embeddings ya generados, por posición del chunk
+
+        Args:
+            chunk_count: Número de chunks de la ingesta
+            model: Modelo de embeddings con el que se generan
+            fingerprint: Hash de los textos de los chunks
+        """
+        meta_path = os.path.join(self.directory, "checkpoint.json")
+        meta = {"chunk_count": chunk_count, "model": model}
+        if fingerprint is not None:
+            meta["fingerprint"] = fingerprint
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = None
+        if saved is not None and saved != meta:
+            print(f"Cambiaron los chunks o el modelo; se descartan los lotes guardados en {self.directory}")
+            self.clear()
+        os.makedirs(self.directory, exist_ok=True)
+        write_json_atomic(meta_path, meta)
+
+        done: Dict[int, np.ndarray] = {}
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".npz"):
+                continue
+            with np.load(os.path.join(self.directory, name)) as data:
+                for position, vector in zip(data["positions"], data["vectors"]):
+                    done[int(position)] = vector
+        if done:
+            print(f"Se retoman {len(done)} de {chunk_count} chunks con embeddings ya generados")
+        self.embedded = len(done)
+        self.on_begin(chunk_count, model, len(done))
+        return done
+
+    def save(self, positions: List[int], embeddings: List[List[float]]):
+        """
+        Guarda un lote terminado
+        """
+        path = os.path.join(self.directory, f"{positions[0]:08d}.npz")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, positions=np.asarray(positions, dtype=np.int64),
+                     vectors=np.asarray(embeddings, dtype=np.float32))
+        os.replace(tmp_path, path)
+        self.embedded += len(positions)
+        self.on_save()
+
+    def clear(self):
+        """
+        Borra los lotes guardados (al terminar la ingesta o si ya no sirven)
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def on_begin(self, chunk_count: int, model: str, resumed: int):
+        """
+        Se llama al empezar, con los chunks ya generados de un intento anterior
+        """
+
+    def on_save(self):
+        """
+        Se llama tras guardar cada lote
+        """
+
+
+class JobCheckpoint(BatchCheckpoint):
+    """
+    Checkpoint de un trabajo de la cola, que además guarda su progreso en job.json
+    """
+    def __init__(self, queue: "IngestJobQueue", job_id: str):
+        super().__init__(os.path.join(queue.job_dir(job_id), "batches"))
+        self.queue = queue
+        self.job_id = job_id
+
+    def on_begin(self, chunk_count: int, model: str, resumed: int):
+        self.queue.update(self.job_id, chunks_total=chunk_count, model=model,
+                          chunks_embedded=resumed, chunks_resumed=resumed)
+
+    def on_save(self):
+        self.queue.update(self.job_id, chunks_embedded=self.embedded)
+
+
+class IngestJobQueue:
+    """
+    Cola de trabajos de ingesta guardada en disco y procesada por un pool de hilos
+
+    Cada worker de gunicorn tiene su pool; el bloqueo de cada trabajo evita
+    que dos procesos lo hagan a la vez.
+    """
+    def __init__(self, jobs_dir: str = JOBS_DIR, workers: int = INGEST_WORKERS):
+        """
+        Args:
+            jobs_dir: Carpeta de los trabajos
+            workers: Trabajos que se procesan a la vez en este proceso
+        """
+        self.jobs_dir = jobs_dir
+        self.workers = max(1, workers)
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.executor_pid = None
+        self.lock = threading.Lock()
+        # Trabajos enviados al pool de este proceso y todavía sin terminar
+        self.scheduled = set()
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id)
+
+    def read(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Lee el estado guardado de un trabajo (None si no existe)
+        """
+        if not JOB_ID_PATTERN.match(job_id or ""):
+            return None
+        try:
+            with open(os.path.join(self.job_dir(job_id), "job.json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def update(self, job_id: str, **fields) -> Dict[str, Any]:
+        """
+        Actualiza campos del estado de un trabajo
+        """
+        with self.lock:
+            record = self.read(job_id) or {}
+            record.update(fields)
+            write_json_atomic(os.path.join(self.job_dir(job_id), "job.json"), record)
+        return record
+
+    @contextmanager
+    def job_lock(self, job_id: str):
+        """
+        Bloqueo exclusivo y no bloqueante del trabajo mientras se procesa
+
+        El sistema operativo lo libera si el proceso muere, y así otro worker
+        puede retomar el trabajo.
+
+        Yields:
+            bool: Si se obtuvo el bloqueo
+        """
+        with open(os.path.join(self.job_dir(job_id), ".lock"), 'a') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+            try:
+                yield True
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def is_locked(self, job_id: str) -> bool:
+        """
+        Indica si algún proceso está procesando el trabajo
+        """
+        with self.job_lock(job_id) as acquired:
+            return not acquired
+
+    def submit(self, json_data: Dict[str, Any], filename: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Encola la ingesta de un documento y devuelve su trabajo sin esperar a procesarlo
+
+        Raises:
+            ValueError: Si el JSON no tiene el formato de un documento
+        """
+        title, _, source = parse_document(json_data)
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.job_dir(job_id), "batches"))
+        write_json_atomic(os.path.join(self.job_dir(job_id), "document.json"), json_data)
+        record = self.update(
+            job_id,
+            id=job_id,
+            status="queued",
+            filename=filename,
+            title=title,
+            source=source,
+            document_id=document_id(title, source),
+            created_at=time.time(),
+            started_at=None,
+            finished_at=None,
+            attempts=0,
+            chunks_total=None,
+            chunks_embedded=0,
+            chunks_resumed=0,
+            error=None,
+        )
+        self.start()
+        self.schedule(job_id)
+        return self.describe(record)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Devuelve el estado de un trabajo con su progreso y tiempo restante estimado
+
+        Un trabajo pendiente que nadie está procesando (su worker murió) se
+        vuelve a encolar en este proceso.
+        """
+        self.start()
+        record = self.read(job_id)
+        if record is None:
+            return None
+        if record["status"] in PENDING_STATUSES and job_id not in self.scheduled and not self.is_locked(job_id):
+            self.schedule(job_id)
+        return self.describe(record)
+
+    def list(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Devuelve los trabajos más recientes
+        """
+        self.start()
+        records = [self.read(job_id) for job_id in self.job_ids()]
+        records = sorted((r for r in records if r), key=lambda r: r.get("created_at", 0), reverse=True)
+        return [self.describe(record) for record in records[:limit]]
+
+    def retry(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Vuelve a encolar un trabajo fallido; retoma desde sus lotes guardados
+
+        Returns:
+            Optional[Dict[str, Any]]: Estado del trabajo, o None si no existe
+        """
+        record = self.read(job_id)
+        if record is None:
+            return None
+        if record["status"] == "failed":
+            record = self.update(job_id, status="queued", attempts=0, error=None, finished_at=None)
+            self.schedule(job_id)
+        return self.describe(record)
+
+    def describe(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Estado de un trabajo con su progreso y el tiempo restante estimado
+        """
+        job = dict(record)
+        total = job.get("chunks_total")
+        embedded = job.get("chunks_embedded", 0)
+        job["progress"] = round(embedded / total, 4) if total else (1.0 if job["status"] == "done" else 0.0)
+        job["eta_seconds"] = None
+        if job["status"] == "running" and total and job.get("started_at"):
+            # Ritmo de este intento, sin contar los chunks retomados de otro anterior
+            elapsed = time.time() - job["started_at"]
+            generated = embedded - job.get("chunks_resumed", 0)
+            if generated > 0 and elapsed > 0:
+                job["eta_seconds"] = round((total - embedded) * elapsed / generated, 1)
+        elif job["status"] == "done":
+            job["eta_seconds"] = 0.0
+        return job
+
+    def job_ids(self) -> List[str]:
+        if not os.path.isdir(self.jobs_dir):
+            return []
+        return [name for name in os.listdir(self.jobs_dir) if JOB_ID_PATTERN.match(name)]
+
+    def start(self):
+        """
+        Crea el pool de este proceso y encola los trabajos pendientes sin dueño
+
+        Se llama en el primer uso de la cola de cada proceso (y desde
+        gunicorn.conf.py al arrancar cada worker), así que los trabajos de un
+        worker que murió se retoman en cuanto arranca otro.
+        """
+        with self.lock:
+            if self.executor is not None and self.executor_pid == os.getpid():
+                return
+            # Tras un fork, el pool del proceso padre no tiene hilos en este
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="rag-ingest")
+            self.executor_pid = os.getpid()
+            self.scheduled = set()
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self.remove_expired()
+        for job_id in self.job_ids():
+            record = self.read(job_id)
+            if record and record["status"] in PENDING_STATUSES and not self.is_locked(job_id):
+                self.schedule(job_id)
+
+    def schedule(self, job_id: str):
+        """
+        Envía un trabajo al pool de este proceso (si no estaba ya)
+        """
+        with self.lock:
+            if job_id in self.scheduled:
+                return
+            self.scheduled.add(job_id)
+        self.executor.submit(self.run, job_id)
+
+    def run(self, job_id: str):
+        """
+        Procesa un trabajo, si ningún otro proceso lo tiene tomado
+        """
+        try:
+            with self.job_lock(job_id) as acquired:
+                if acquired:
+                    self.process(job_id)
+        except Exception as e:
+            print(f"Error en el trabajo de ingesta {job_id}: {str(e)}")
+        finally:
+            with self.lock:
+                self.scheduled.discard(job_id)
+
+    def process(self, job_id: str):
+        """
+        Genera los embeddings del documento del trabajo y lo escribe en el índice
+
+        Debe llamarse con el bloqueo del trabajo tomado.
+        """
+        record = self.read(job_id)
+        if record is None or record["status"] not in PENDING_STATUSES:
+            return
+        if record["attempts"] >= INGEST_MAX_ATTEMPTS:
+            self.update(job_id, status="failed", finished_at=time.time(),
+                        error=f"El trabajo se interrumpió {record['attempts']} veces sin terminar")
+            return
+
+        self.update(job_id, status="running", attempts=record["attempts"] + 1, started_at=time.time(), error=None)
+        print(f"Trabajo de ingesta {job_id}: '{record['title']}' (intento {record['attempts'] + 1})")
+        with open(os.path.join(self.job_dir(job_id), "document.json"), 'r', encoding='utf-8') as f:
+            json_data = json.load(f)
+        # Informe propio de este trabajo: otros trabajos pueden estar ingiriendo a la vez
+        report: Dict[str, Any] = {}
+        try:
+            doc_id = embeddings_manager.process_json_file(json_data, checkpoint=JobCheckpoint(self, job_id),
+                                                          report=report)
+        except Exception as e:
+            # Los lotes ya generados se conservan para retomarlos con retry()
+            print(f"Trabajo de ingesta {job_id} fallido: {str(e)}")
+            self.update(job_id, status="failed", finished_at=time.time(), error=str(e))
+            return
+
+        record = self.read(job_id)
+        self.update(job_id, status="done", finished_at=time.time(), document_id=doc_id,
+                    replaced=report.get("replaced", False), chunks_reused=report.get("reused_chunks", 0),
+                    chunks_embedded=record.get("chunks_total") or record.get("chunks_embedded", 0),
+                    seconds=round(time.time() - record["started_at"], 3))
+        # El documento y los lotes ya no hacen falta
+        JobCheckpoint(self, job_id).clear()
+        try:
+            os.remove(os.path.join(self.job_dir(job_id), "document.json"))
+        except FileNotFoundError:
+            pass
+
+    def remove_expired(self):
+        """
+        Borra los trabajos terminados hace más de RAG_INGEST_JOB_RETENTION_HOURS
+        """
+        limit = time.time() - INGEST_JOB_RETENTION_HOURS * 3600
+        for job_id in self.job_ids():
+            record = self.read(job_id)
+            if record and record["status"] not in PENDING_STATUSES and (record.get("finished_at") or 0) < limit:
+                shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+
+# Instancia singleton (el pool se crea en el primer uso de cada proceso)
+ingest_queue = IngestJobQueue()
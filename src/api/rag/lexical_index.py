@@ -0,0 +1,496 @@
+"""
+Índice invertido BM25 sobre los chunks, para búsquedas por palabras exactas.
+
+Los nombres de protocolos y medicamentos suelen aparecer literalmente en los
+documentos; este índice los encuentra sin pedir un embedding a la API.
+
+Las listas de filas de cada término se guardan como arrays de numpy en un
+directorio lexical.<filas>-<pid>/ que publica lexical_index.json; se abren con
+mmap, así que todos los workers comparten las mismas páginas en memoria.
+"""
+import os
+import re
+import json
+import math
+import shutil
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import List, Dict, Tuple, Optional
+
+import numpy as np
+import snowballstemmer
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+# Parámetros de BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Peso de las palabras del título del documento en cada uno de sus chunks
+TITLE_WEIGHT = 2
+# Frecuencia máxima de un término en un chunk que se guarda (uint16)
+MAX_TERM_FREQUENCY = 65535
+
+# Términos de idf muy bajo: los que aparecen en más de esta fracción de los
+# chunks (y en al menos LOW_IDF_MIN_ROWS) no aportan candidatos, solo suman su
+# puntuación a los chunks que encontraron los términos más raros de la
+# consulta (1 lo desactiva)
+LEXICAL_MAX_DF = float(os.getenv("RAG_LEXICAL_MAX_DF", "0.2"))
+LOW_IDF_MIN_ROWS = 1000
+
+# Filas que se analizan antes de añadirlas al índice de una vez
+SYNC_BATCH_ROWS = 1000
+
+POSTINGS_FILES = ("terms", "offsets", "rows", "tfs")
+
+WORD = re.compile(r"\w+")
+
+# Palabras vacías del español, sin tildes
+STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes aqui asi aun cada como con contra cual
+cuales cuando de del desde donde dos el ella ellas ello ellos en entre era eran es esa esas ese eso
+esos esta estaba estan estar este esto estos fue fueron ha hace hacer han hasta hay la las le les lo
+los mas me mi mientras muy nada ni no nos o otra otras otro otros para pero poco por porque que
+quien se sea segun ser si sin sobre solo son su sus tambien tan te tiene tienen todo todos tu un una
+unas uno unos usted y ya yo
+""".split())
+
+stemmer = snowballstemmer.stemmer("spanish")
+stemmer_lock = threading.Lock()
+
+
+def fold_accents(text: str) -> str:
+    """
+    Quita tildes y diéresis ("reanimación" -> "reanimacion")
+    """
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+@lru_cache(maxsize=100000)
+def normalize_word(word: str) -> Optional[str]:
+    """
+    Convierte una palabra en minúsculas en su término del índice
+
+    Se aplica la raíz (stemming) antes de quitar las tildes, porque el
+    algoritmo de Snowball para español las tiene en cuenta.
+
+    Returns:
+        Optional[str]: Término, o None si es una palabra vacía
+    """
+    folded = fold_accents(word)
+    if folded in STOPWORDS or (len(folded) < 2 and not folded.isdigit()):
+        return None
+    with stemmer_lock:
+        stem = stemmer.stemWord(word)
+    return fold_accents(stem)
+
+
+def analyze(text: str) -> List[str]:
+    """
+    Divide un texto en términos del índice
+    """
+    terms = []
+    for word in WORD.findall(text.lower()):
+        term = normalize_word(word)
+        if term:
+            terms.append(term)
+    return terms
+
+
+def count_terms(text: str, title: str = "") -> Counter:
+    """
+    Cuenta los términos de un chunk, con las palabras del título de su documento
+    """
+    terms = Counter(analyze(text))
+    for term in analyze(title):
+        terms[term] += TITLE_WEIGHT
+    return terms
+
+
+def bm25_weights(rows: np.ndarray, tfs: np.ndarray, df: int, total: int,
+                 lengths: np.ndarray, avg_length: float) -> np.ndarray:
+    """
+    Puntuación BM25 de un término en cada una de las filas indicadas
+
+    Args:
+        rows: Filas donde aparece el término
+        tfs: Frecuencia del término en cada fila
+        df: Número total de filas con el término
+        total: Número de filas del índice
+        lengths: Términos de cada fila del índice
+        avg_length: Términos por fila en promedio
+    """
+    idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+    tf = tfs.astype(np.float64)
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / avg_length)
+    return idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+
+class Postings:
+    """
+    Filas de cada término en formato CSR, de solo lectura
+
+    `terms` está ordenado (términos en UTF-8) y las filas del término i son
+    rows[offsets[i]:offsets[i + 1]], en orden creciente, con su frecuencia en
+    el mismo tramo de `tfs`. Nunca se modifican: añadir o quitar filas crea
+    otras listas.
+    """
+    def __init__(self, terms: np.ndarray, offsets: np.ndarray, rows: np.ndarray, tfs: np.ndarray):
+        self.terms = terms
+        self.offsets = offsets
+        self.rows = rows
+        self.tfs = tfs
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    @classmethod
+    def empty(cls) -> "Postings":
+        return cls(np.zeros(0, dtype="S1"), np.zeros(1, dtype=np.int64),
+                   np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint16))
+
+    @classmethod
+    def from_lists(cls, postings: Dict[str, Tuple[List[int], List[int]]]) -> "Postings":
+        """
+        Convierte las listas de filas en memoria (término -> (filas, frecuencias))
+        """
+        if not postings:
+            return cls.empty()
+        terms = sorted(postings)
+        counts = np.array([len(postings[term][0]) for term in terms], dtype=np.int64)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        rows = np.fromiter((row for term in terms for row in postings[term][0]), dtype=np.int32,
+                           count=int(offsets[-1]))
+        tfs = np.fromiter((tf for term in terms for tf in postings[term][1]), dtype=np.uint16,
+                          count=int(offsets[-1]))
+        return cls(np.array([term.encode('utf-8') for term in terms]), offsets, rows, tfs)
+
+    @classmethod
+    def read(cls, directory: str) -> "Postings":
+        """
+        Abre con mmap las listas guardadas en `directory`
+        """
+        return cls(*(np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in POSTINGS_FILES))
+
+    def write(self, directory: str):
+        """
+        Guarda las listas en `directory`, que no debe estar en uso
+        """
+        for name in POSTINGS_FILES:
+            with open(os.path.join(directory, f"{name}.npy"), 'wb') as f:
+                np.save(f, getattr(self, name))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Devuelve las filas y frecuencias de un término, o None si no aparece
+        """
+        key = term.encode('utf-8')
+        i = int(np.searchsorted(self.terms, key))
+        if i == len(self.terms) or self.terms[i] != key:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.rows[start:end], self.tfs[start:end]
+
+    def merge(self, other: "Postings") -> "Postings":
+        """
+        Une dos listas en las que todas las filas de `other` son posteriores a las de esta
+        """
+        terms = np.union1d(self.terms, other.terms)
+        own = np.searchsorted(terms, self.terms.astype(terms.dtype))
+        new = np.searchsorted(terms, other.terms.astype(terms.dtype))
+        own_counts = np.zeros(len(terms), dtype=np.int64)
+        own_counts[own] = np.diff(self.offsets)
+        new_counts = np.zeros(len(terms), dtype=np.int64)
+        new_counts[new] = np.diff(other.offsets)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(own_counts + new_counts, out=offsets[1:])
+        rows = np.empty(int(offsets[-1]), dtype=np.int32)
+        tfs = np.empty(int(offsets[-1]), dtype=np.uint16)
+        # Cada posición de origen se desplaza al inicio de su término en las
+        # listas nuevas; las filas de `other` van detrás de las de esta
+        for source, starts, counts in ((self, offsets[own], own_counts[own]),
+                                       (other, offsets[new] + own_counts[new], new_counts[new])):
+            targets = np.repeat(starts - source.offsets[:-1], counts) + np.arange(len(source.rows))
+            rows[targets] = source.rows
+            tfs[targets] = source.tfs
+        return Postings(terms, offsets, rows, tfs)
+
+    def truncate(self, row_count: int) -> "Postings":
+        """
+        Devuelve las listas sin las filas a partir de `row_count`
+        """
+        keep = self.rows < row_count
+        term_ids = np.repeat(np.arange(len(self.terms)), np.diff(self.offsets))[keep]
+        counts = np.bincount(term_ids, minlength=len(self.terms))
+        present = counts > 0
+        offsets = np.zeros(int(present.sum()) + 1, dtype=np.int64)
+        np.cumsum(counts[present], out=offsets[1:])
+        return Postings(self.terms[present], offsets, self.rows[keep], self.tfs[keep])
+
+
+class LexicalIndex:
+    """
+    Índice invertido de los chunks, por fila del índice FAISS
+
+    Como el almacén de chunks, solo crece al final. Las filas guardadas se
+    leen con mmap desde el directorio que publica el archivo del índice, y
+    las añadidas después se acumulan en memoria hasta el siguiente `save`
+    (al final de cada compactación). Al arrancar solo se indexan las filas
+    que falten.
+    """
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Archivo JSON que indica el directorio con el índice guardado
+        """
+        self.path = path
+        self.directory = os.path.dirname(path)
+        # Filas guardadas en disco [0, saved_rows) y nombre de su directorio
+        self.saved = Postings.empty()
+        self.saved_rows = 0
+        self.saved_name: Optional[str] = None
+        # Filas añadidas después de guardar: término -> (filas, frecuencias)
+        self.pending: Dict[str, Tuple[List[int], List[int]]] = {}
+        # Términos de cada fila; se reemplaza (nunca se modifica) al añadir filas
+        self.lengths = np.zeros(0, dtype=np.int32)
+        self.total_length = 0
+        # Cambia con cada rollback_to, para descartar un save que empezó antes
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def load(self) -> bool:
+        """
+        Carga el índice guardado
+
+        Returns:
+            bool: True si había un índice guardado válido
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                name = json.load(f)["name"]
+            saved = Postings.read(os.path.join(self.directory, name))
+            lengths = np.load(os.path.join(self.directory, name, "lengths.npy"))
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        with self.lock:
+            self.saved, self.saved_rows, self.saved_name = saved, len(lengths), name
+            self.pending = {}
+            self.lengths = lengths.astype(np.int32)
+            self.total_length = int(lengths.sum())
+            self.version += 1
+        return True
+
+    @contextmanager
+    def file_lock(self):
+        """
+        Bloqueo exclusivo entre procesos para publicar el índice guardado
+        """
+        with open(os.path.join(self.directory, ".lexical.lock"), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self):
+        """
+        Guarda el índice en un directorio nuevo y lo publica de forma atómica
+
+        Bajo `self.lock` solo se copian las filas añadidas desde el último
+        guardado; la unión con las listas guardadas y la escritura se hacen
+        fuera, sin frenar las búsquedas. Después el índice pasa a leer las
+        listas nuevas con mmap. Los workers que tienen mapeado un directorio
+        anterior lo siguen leyendo hasta que vuelven a cargar el índice.
+        """
+        with self.lock:
+            if not self.pending and self.saved_name is not None and self.saved_rows == len(self.lengths):
+                return
+            saved, lengths, version = self.saved, self.lengths, self.version
+            pending = Postings.from_lists(self.pending)
+        postings = saved.merge(pending)
+        row_count = len(lengths)
+        name = f"lexical.{row_count:08d}-{os.getpid()}"
+        directory = os.path.join(self.directory, name)
+
+        with self.file_lock():
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+            postings.write(directory)
+            with open(os.path.join(directory, "lengths.npy"), 'wb') as f:
+                np.save(f, lengths)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"name": name, "rows": row_count}, f)
+            os.replace(tmp_path, self.path)
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith("lexical.") and entry.is_dir() and entry.name != name:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        saved = Postings.read(directory)
+
+        with self.lock:
+            if self.version != version:
+                return
+            self.saved, self.saved_rows, self.saved_name = saved, row_count, name
+            for term in list(self.pending):
+                rows, tfs = self.pending[term]
+                cut = bisect_left(rows, row_count)
+                del rows[:cut]
+                del tfs[:cut]
+                if not rows:
+                    del self.pending[term]
+
+    def extend(self, start: int, chunks: List[Counter]):
+        """
+        Indexa los chunks de las filas siguientes a partir de `start`
+
+        Las filas que otro hilo ya haya indexado se omiten.
+        """
+        with self.lock:
+            chunks = chunks[max(len(self.lengths) - start, 0):]
+            first = len(self.lengths)
+            for row, terms in enumerate(chunks, first):
+                for term, count in terms.items():
+                    rows, tfs = self.pending.setdefault(term, ([], []))
+                    rows.append(row)
+                    tfs.append(min(count, MAX_TERM_FREQUENCY))
+            lengths = np.fromiter((sum(terms.values()) for terms in chunks), dtype=np.int32, count=len(chunks))
+            self.lengths = np.concatenate([self.lengths, lengths])
+            self.total_length += int(lengths.sum())
+
+    def rollback_to(self, row_count: int):
+        """
+        Descarta las filas a partir de `row_count`
+        """
+        with self.lock:
+            if row_count >= len(self.lengths):
+                return
+            if row_count < self.saved_rows:
+                self.saved = self.saved.truncate(row_count)
+                self.saved_rows = row_count
+                self.saved_name = None
+            for term in list(self.pending):
+                rows, tfs = self.pending[term]
+                cut = bisect_left(rows, row_count)
+                del rows[cut:]
+                del tfs[cut:]
+                if not rows:
+                    del self.pending[term]
+            self.total_length -= int(self.lengths[row_count:].sum())
+            self.lengths = self.lengths[:row_count].copy()
+            self.version += 1
+
+    def sync(self, store, row_count: Optional[int] = None) -> int:
+        """
+        Pone el índice al día con las filas del almacén de chunks
+
+        Args:
+            store: ChunkStore con los textos de los chunks
+            row_count: Filas a indexar (por defecto todas las del almacén)
+
+        Returns:
+            int: Número de filas indexadas
+        """
+        if row_count is None:
+            row_count = len(store)
+        if len(self) > row_count:
+            self.rollback_to(row_count)
+        start = len(self)
+        for batch_start in range(start, row_count, SYNC_BATCH_ROWS):
+            batch_end = min(batch_start + SYNC_BATCH_ROWS, row_count)
+            self.extend(batch_start, [count_terms(store.get_text(row), store.get_document(row)["title"])
+                                      for row in range(batch_start, batch_end)])
+        return row_count - start
+
+    def search(self, query: str, top_k: int, dead=None) -> Tuple[List[Tuple[int, float, int]], int]:
+        """
+        Busca los chunks con mayor puntuación BM25
+
+        Los términos de idf muy bajo (ver LEXICAL_MAX_DF) solo puntúan los
+        chunks que encontraron los demás; si todos lo son, el más raro sí
+        aporta candidatos.
+
+        Args:
+            query: Texto de la consulta
+            top_k: Número máximo de resultados
+            dead: Máscara de filas que no deben aparecer (documentos borrados o
+                reemplazados). Las filas posteriores a la máscara tampoco aparecen.
+
+        Returns:
+            Tuple[List[Tuple[int, float, int]], int]: (fila, puntuación, términos
+            de la consulta presentes en el chunk) de mayor a menor puntuación, y
+            número de términos distintos de la consulta
+        """
+        terms = set(analyze(query))
+        postings = []
+        # Bajo el bloqueo solo se toman los arrays, que no se modifican después
+        with self.lock:
+            lengths, total_length = self.lengths, self.total_length
+            for term in terms:
+                found = self.saved.get(term)
+                pending = self.pending.get(term)
+                if pending:
+                    extra = (np.array(pending[0], dtype=np.int32), np.array(pending[1], dtype=np.uint16))
+                    found = extra if found is None else tuple(np.concatenate(pair) for pair in zip(found, extra))
+                if found is not None:
+                    postings.append(found)
+        total = len(lengths)
+        if not postings or not total:
+            return [], len(terms)
+        avg_length = total_length / total or 1.0
+
+        postings.sort(key=lambda pair: len(pair[0]))
+        max_df = max(LOW_IDF_MIN_ROWS, LEXICAL_MAX_DF * total)
+        common_start = next((i for i, (rows, _) in enumerate(postings) if i and len(rows) > max_df), len(postings))
+        selective, common = postings[:common_start], postings[common_start:]
+
+        # Puntuaciones de todas las filas: sumar con bincount no necesita ordenar
+        selected = np.concatenate([rows for rows, _ in selective])
+        weights = np.concatenate([bm25_weights(rows, tfs, len(rows), total, lengths, avg_length)
+                                  for rows, tfs in selective])
+        scores = np.bincount(selected, weights=weights, minlength=total)
+        matched = np.bincount(selected, minlength=total)
+        found = matched > 0
+        for rows, tfs in common:
+            hits = found[rows]
+            rows, tfs = rows[hits], tfs[hits]
+            scores[rows] += bm25_weights(rows, tfs, len(hits), total, lengths, avg_length)
+            matched[rows] += 1
+
+        if dead is not None:
+            alive = min(len(dead), total)
+            found[:alive] &= ~np.asarray(dead[:alive])
+            found[alive:] = False
+        candidates = np.flatnonzero(found)
+        scores = scores[candidates]
+        if len(scores) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+            best = best[np.argsort(-scores[best], kind='stable')]
+        else:
+            best = np.argsort(-scores, kind='stable')
+        return [(int(candidates[i]), float(scores[i]), int(matched[candidates[i]])) for i in best], len(terms)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Devuelve el tamaño del índice
+        """
+        with self.lock:
+            rows = len(self.lengths)
+            return {
+                "rows": rows,
+                "terms": len(self.saved) + sum(1 for term in self.pending if self.saved.get(term) is None),
+                "avg_chunk_terms": round(self.total_length / rows, 1) if rows else 0.0
+            }
@@ -0,0 +1,237 @@
+"""
+Caché de embeddings de consultas en dos niveles: LRU en memoria y SQLite en disco.
+"""
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normaliza una consulta para usarla como clave de caché
+
+    Ignora mayúsculas, acentos y espacios repetidos, de modo que
+    "RCP  Adulto" y "rcp adulto" comparten la misma entrada.
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"\s+", " ", text.casefold())
+    return text.strip()
+
+
+class QueryEmbeddingCache:
+    """
+    Caché de embeddings de consultas
+
+    El primer nivel es un LRU acotado propio de cada proceso. El segundo nivel
+    es una base SQLite en disco compartida por todos los workers de gunicorn,
+    que sobrevive a los reinicios.
+    """
+    def __init__(self, db_path: str, max_entries: int = 1024, max_disk_entries: int = 100000):
+        """
+        Inicializa la caché
+
+        Args:
+            db_path: Ruta del archivo SQLite del nivel en disco
+            max_entries: Número máximo de entradas en memoria
+            max_disk_entries: Número máximo de entradas en disco
+        """
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_errors = 0
+        self.writes = 0
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        try:
+            with self.connection() as conn:
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS query_embeddings (
+                        key TEXT PRIMARY KEY,
+                        model TEXT NOT NULL,
+                        query TEXT NOT NULL,
+                        embedding BLOB NOT NULL,
+                        last_used REAL NOT NULL
+                    )"""
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_query_embeddings_last_used "
+                    "ON query_embeddings (last_used)"
+                )
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            print(f"No se pudo inicializar la caché de consultas en disco: {str(e)}")
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Devuelve la conexión SQLite del hilo actual
+        """
+        conn = getattr(self.local, "conn", None)
+        # Una conexión abierta antes del fork de gunicorn no debe reutilizarse
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            # WAL permite lecturas concurrentes de varios workers mientras uno escribe
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def make_key(query: str, model: str) -> str:
+        """
+        Genera la clave de caché para una consulta y un modelo
+        """
+        return hashlib.sha256(f"{model}\x00{normalize_query(query)}".encode("utf-8")).hexdigest()
+
+    def remember(self, key: str, embedding: np.ndarray):
+        """
+        Guarda un embedding en el nivel de memoria, descartando el menos usado
+        """
+        with self.lock:
+            self.memory[key] = embedding
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def get(self, query: str, model: str) -> Optional[np.ndarray]:
+        """
+        Busca el embedding de una consulta en la caché
+
+        Returns:
+            Optional[np.ndarray]: Embedding en float32 o None si no está
+        """
+        key = self.make_key(query, model)
+        with self.lock:
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+
+        try:
+            with self.connection() as conn:
+                row = conn.execute(
+                    "SELECT embedding FROM query_embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE query_embeddings SET last_used = ? WHERE key = ?",
+                        (time.time(), key)
+                    )
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            print(f"Error al leer la caché de consultas en disco: {str(e)}")
+            row = None
+
+        if row is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        embedding = np.frombuffer(row[0], dtype=np.float32)
+        self.remember(key, embedding)
+        with self.lock:
+            self.disk_hits += 1
+        return embedding
+
+    def contains(self, query: str, model: str) -> bool:
+        """
+        Indica si la consulta está en la caché, sin contarlo en las estadísticas
+        ni cambiar el orden de uso
+        """
+        key = self.make_key(query, model)
+        with self.lock:
+            if key in self.memory:
+                return True
+        try:
+            with self.connection() as conn:
+                return conn.execute(
+                    "SELECT 1 FROM query_embeddings WHERE key = ?", (key,)
+                ).fetchone() is not None
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            print(f"Error al leer la caché de consultas en disco: {str(e)}")
+            return False
+
+    def put(self, query: str, model: str, embedding) -> np.ndarray:
+        """
+        Guarda el embedding de una consulta en ambos niveles
+
+        Returns:
+            np.ndarray: Embedding almacenado en float32
+        """
+        key = self.make_key(query, model)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self.remember(key, embedding)
+
+        try:
+            with self.connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO query_embeddings (key, model, query, embedding, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, model, normalize_query(query), embedding.tobytes(), time.time())
+                )
+                self.writes += 1
+                # Recortar el nivel en disco de vez en cuando
+                if self.writes % 100 == 0:
+                    conn.execute(
+                        "DELETE FROM query_embeddings WHERE key IN ("
+                        "SELECT key FROM query_embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                        (self.max_disk_entries,)
+                    )
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            print(f"Error al escribir la caché de consultas en disco: {str(e)}")
+        return embedding
+
+    def sample(self, model: str, limit: int) -> np.ndarray:
+        """
+        Devuelve los embeddings de las consultas más recientes de un modelo, para los benchmarks
+
+        Returns:
+            np.ndarray: Matriz float32 con hasta `limit` embeddings (vacía si no hay)
+        """
+        try:
+            with self.connection() as conn:
+                rows = conn.execute(
+                    "SELECT embedding FROM query_embeddings WHERE model = ? ORDER BY last_used DESC LIMIT ?",
+                    (model, limit)
+                ).fetchall()
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            print(f"Error al leer la caché de consultas en disco: {str(e)}")
+            rows = []
+        if not rows:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([np.frombuffer(row[0], dtype=np.float32) for row in rows])
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Devuelve los contadores de aciertos y fallos de la caché
+        """
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self.memory),
+                "max_memory_entries": self.max_entries,
+                "disk_errors": self.disk_errors
+            }
@@ -5,13 +5,17 @@ from flask import Blueprint, request, jsonify
 import json
 import os
 from .embeddings_manager import embeddings_manager
+from .ingest_jobs import ingest_queue
 
 rag_api = Blueprint('rag_api', __name__)
 
 @rag_api.route('/upload', methods=['POST'])
 def upload_document():
     """
-    Endpoint para subir un archivo JSON y procesarlo
+    Endpoint para subir un archivo JSON y encolar su procesamiento
+    
+    Responde enseguida con el id del trabajo; el progreso se consulta en
+    /jobs/<job_id>.
     """
     try:
         # Comprobar si hay un archivo en la petición
@@ -34,13 +38,18 @@ def upload_document():
         except json.JSONDecodeError:
             return jsonify({"error": "El archivo no contiene JSON válido"}), 400
         
-        # Procesar el archivo
-        doc_id = embeddings_manager.process_json_file(json_data)
+        # Encolar el procesamiento del archivo
+        try:
+            job = ingest_queue.submit(json_data, file.filename)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         return jsonify({
-            "message": "Documento procesado correctamente",
-            "document_id": doc_id
-        }), 200
+            "message": "Documento en cola para procesarse",
+            "job_id": job["id"],
+            "document_id": job["document_id"],
+            "job": job
+        }), 202
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -54,7 +63,11 @@ def get_stats():
         return jsonify({
             "document_count": embeddings_manager.get_document_count(),
             "chunk_count": embeddings_manager.get_chunk_count(),
-            "documents": embeddings_manager.get_document_titles()
+            "documents": embeddings_manager.get_document_titles(),
+            "index": embeddings_manager.get_index_info(),
+            "query_cache": embeddings_manager.get_query_cache_stats(),
+            "lexical_index": embeddings_manager.get_lexical_index_stats(),
+            "startup_timings": embeddings_manager.startup_timings
         }), 200
     
     except Exception as e:
@@ -82,4 +95,95 @@ def search():
         }), 200
     
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+@rag_api.route('/search/batch', methods=['POST'])
+def search_batch():
+    """
+    Endpoint para buscar varias consultas en una sola petición
+
+    Recibe {"queries": [...], "top_k": 5} y devuelve los resultados de cada
+    consulta en el mismo orden. Los embeddings se piden en una sola llamada y
+    el índice se consulta una sola vez para todo el lote.
+    """
+    try:
+        data = request.json
+        queries = (data or {}).get('queries')
+
+        if not isinstance(queries, list) or not queries:
+            return jsonify({"error": "No se proporcionó ninguna consulta"}), 400
+        if not all(isinstance(query, str) and query.strip() for query in queries):
+            return jsonify({"error": "Todas las consultas deben ser textos no vacíos"}), 400
+
+        top_k = data.get('top_k', 5)
+
+        try:
+            results = embeddings_manager.search_batch(queries, top_k)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        return jsonify({
+            "results": [{"query": query, "results": query_results}
+                        for query, query_results in zip(queries, results)]
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@rag_api.route('/documents/<doc_id>', methods=['DELETE'])
+def delete_document(doc_id):
+    """
+    Endpoint para borrar un documento de la base de datos RAG
+    """
+    try:
+        if not embeddings_manager.delete_document(doc_id):
+            return jsonify({"error": "Documento no encontrado"}), 404
+        
+        return jsonify({
+            "message": "Documento borrado correctamente",
+            "document_id": doc_id
+        }), 200
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@rag_api.route('/jobs', methods=['GET'])
+def list_jobs():
+    """
+    Endpoint para listar los trabajos de ingesta más recientes
+    """
+    try:
+        limit = request.args.get('limit', 20, type=int)
+        return jsonify({"jobs": ingest_queue.list(limit)}), 200
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@rag_api.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Endpoint para consultar el estado de un trabajo de ingesta: chunks
+    generados, tiempo restante estimado y errores
+    """
+    try:
+        job = ingest_queue.get(job_id)
+        if job is None:
+            return jsonify({"error": "Trabajo no encontrado"}), 404
+        return jsonify(job), 200
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@rag_api.route('/jobs/<job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    """
+    Endpoint para volver a encolar un trabajo de ingesta fallido
+    """
+    try:
+        job = ingest_queue.retry(job_id)
+        if job is None:
+            return jsonify({"error": "Trabajo no encontrado"}), 404
+        return jsonify(job), 202
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -0,0 +1,317 @@
+"""
+Índice vectorial en segmentos: un índice FAISS base más segmentos delta pequeños.
+
+Cada ingesta guarda solo los vectores de sus chunks en un segmento delta
+(segments/delta-*.npz), en lugar de reescribir el índice completo. Los chunks
+de documentos borrados o reemplazados se filtran en la búsqueda con un
+IDSelector hasta que la compactación los quita del índice base y absorbe
+los segmentos en uno nuevo.
+
+Las filas del índice base no tienen por qué coincidir con las filas del
+almacén de chunks: el índice base guarda junto a él la fila del almacén de
+cada vector (base_rows), y cada segmento guarda la suya.
+
+Un índice base cuantizado (float16, sq8, pq) guarda además sus vectores
+originales en float32 (base_originals). Se leen con mmap, así que no ocupan
+memoria de los workers: solo se tocan las filas de los candidatos que se
+reordenan por distancia exacta, y la compactación los usa en lugar de
+reconstruir vectores aproximados.
+"""
+import os
+import copy
+from typing import List, Dict, Any, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from .index_factory import make_search_params, supports_selector, reconstruct_vectors, rescore
+
+SEGMENTS_DIRNAME = "segments"
+
+
+def write_segment(path: str, rows: np.ndarray, vectors: np.ndarray):
+    """
+    Guarda un segmento delta (filas del almacén y sus vectores) de forma atómica
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, rows=np.asarray(rows, dtype=np.int64), vectors=np.asarray(vectors, dtype=np.float32))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_segment(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Lee las filas del almacén y los vectores de un segmento delta
+    """
+    with np.load(path) as data:
+        return data["rows"], data["vectors"]
+
+
+def write_base_rows(path: str, rows: np.ndarray):
+    """
+    Guarda la fila del almacén de cada vector del índice base
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.asarray(rows, dtype=np.int64))
+    os.replace(tmp_path, path)
+
+
+def read_base_rows(path: str) -> np.ndarray:
+    """
+    Lee (con mmap) las filas del almacén de los vectores del índice base
+    """
+    return np.load(path, mmap_mode='r')
+
+
+def write_originals(path: str, vectors: np.ndarray):
+    """
+    Guarda en float32 los vectores originales de un índice base cuantizado
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.asarray(vectors, dtype=np.float32))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_originals(path: str) -> np.ndarray:
+    """
+    Lee (con mmap) los vectores originales del índice base
+    """
+    return np.load(path, mmap_mode='r')
+
+
+class SegmentedIndex:
+    """
+    Índice base (de cualquier tipo de index_factory) más los vectores de los
+    segmentos delta en un IndexFlatL2 en memoria
+
+    Las búsquedas devuelven filas del almacén de chunks. Las filas muertas
+    (de documentos borrados o reemplazados) se indican con `set_dead` y no
+    aparecen en los resultados.
+    """
+    def __init__(self, base: faiss.Index, config: Dict[str, Any], name: str,
+                 base_rows: Optional[np.ndarray] = None, rows_name: Optional[str] = None, read_only: bool = False,
+                 originals: Optional[np.ndarray] = None, originals_name: Optional[str] = None):
+        """
+        Args:
+            base: Índice FAISS base
+            config: Configuración efectiva del índice base
+            name: Archivo del índice base, relativo a la carpeta de datos
+            base_rows: Fila del almacén de cada vector del índice base (None: la misma posición)
+            rows_name: Archivo de base_rows, relativo a la carpeta de datos
+            read_only: Si el índice base está mapeado en solo lectura
+            originals: Vectores originales (float32) del índice base, en su mismo orden
+            originals_name: Archivo de originals, relativo a la carpeta de datos
+        """
+        self.base = base
+        self.name = name
+        self.rows_name = rows_name
+        self.config = config
+        self.base_rows = base_rows
+        self.read_only = read_only
+        self.originals = originals
+        self.originals_name = originals_name
+        self.segments: List[str] = []
+        self.delta_rows = np.zeros(0, dtype=np.int64)
+        self.delta_vectors = np.zeros((0, base.d), dtype=np.float32)
+        self.delta = faiss.IndexFlatL2(base.d)
+        self.delta_live_rows = self.delta_rows
+        self.dead_base = 0
+        self.selector = None
+        self.search_params = None
+        # Posiciones muertas del índice base, si no admite IDSelector
+        self.dead_mask = None
+        self.live_count = base.ntotal
+
+    @property
+    def d(self) -> int:
+        return self.base.d
+
+    @property
+    def ntotal(self) -> int:
+        """
+        Vectores guardados, incluidos los de filas muertas
+        """
+        return self.base.ntotal + len(self.delta_rows)
+
+    def base_row_ids(self) -> np.ndarray:
+        """
+        Fila del almacén de cada vector del índice base
+        """
+        if self.base_rows is None:
+            return np.arange(self.base.ntotal, dtype=np.int64)
+        return np.asarray(self.base_rows)
+
+    def copy(self) -> "SegmentedIndex":
+        """
+        Copia que comparte el índice base y los vectores, para añadirle segmentos
+        o filas muertas sin tocar el índice que están usando las búsquedas
+        """
+        clone = copy.copy(self)
+        clone.segments = list(self.segments)
+        return clone
+
+    def add_segment(self, name: str, rows: np.ndarray, vectors: np.ndarray):
+        """
+        Añade los vectores de un segmento delta
+
+        Los vectores no se buscan hasta la siguiente llamada a `set_dead`.
+        """
+        self.segments.append(name)
+        self.delta_rows = np.concatenate([self.delta_rows, np.asarray(rows, dtype=np.int64)])
+        self.delta_vectors = np.concatenate([self.delta_vectors, np.asarray(vectors, dtype=np.float32)])
+
+    def set_dead(self, dead: np.ndarray):
+        """
+        Actualiza las filas del almacén que ya no deben aparecer en las búsquedas
+
+        Args:
+            dead: Máscara booleana por fila del almacén de chunks
+        """
+        if self.base_rows is None:
+            dead_positions = np.flatnonzero(dead[:self.base.ntotal])
+        else:
+            dead_positions = np.flatnonzero(dead[self.base_row_ids()])
+        self.dead_base = len(dead_positions)
+        self.dead_mask = None
+        if self.dead_base and not supports_selector(self.base):
+            # Se piden dead_base candidatos más y se descartan las posiciones muertas
+            self.dead_mask = np.zeros(self.base.ntotal, dtype=bool)
+            self.dead_mask[dead_positions] = True
+            self.selector = None
+            self.search_params = None
+        elif self.dead_base:
+            dead_positions = dead_positions.astype(np.int64)
+            batch = faiss.IDSelectorBatch(len(dead_positions), faiss.swig_ptr(dead_positions))
+            # IDSelectorNot no conserva una referencia al selector interno
+            self.selector = (faiss.IDSelectorNot(batch), batch)
+            self.search_params = make_search_params(self.config, self.selector[0])
+        else:
+            self.selector = None
+            self.search_params = None
+
+        live = ~dead[self.delta_rows] if len(self.delta_rows) else np.zeros(0, dtype=bool)
+        self.delta = faiss.IndexFlatL2(self.d)
+        if live.any():
+            self.delta.add(np.ascontiguousarray(self.delta_vectors[live]))
+        self.delta_live_rows = self.delta_rows[live]
+        self.live_count = self.base.ntotal - self.dead_base + len(self.delta_live_rows)
+
+    def search(self, queries: np.ndarray, top_k: int, rescore_factor: int = 0) -> List[List[Tuple[int, float]]]:
+        """
+        Busca en el índice base y en los segmentos delta y combina los resultados
+
+        Args:
+            queries: Matriz de embeddings de consulta (una fila por consulta)
+            top_k: Número máximo de resultados por consulta
+            rescore_factor: Si el índice base tiene vectores originales, pedirle
+                top_k * rescore_factor candidatos y quedarse con los top_k más
+                cercanos por distancia exacta (0 o 1 no reordena)
+
+        Returns:
+            List[List[Tuple[int, float]]]: (fila del almacén, distancia) de cada
+            consulta, de la más a la menos cercana
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        results: List[List[Tuple[int, float]]] = [[] for _ in range(len(queries))]
+        base_live = self.base.ntotal - self.dead_base
+        if base_live > 0:
+            exact = rescore_factor > 1 and self.originals is not None
+            k = min(top_k * rescore_factor if exact else top_k, base_live)
+            if self.search_params is not None:
+                distances, positions = self.base.search(queries, k, params=self.search_params)
+            elif self.dead_mask is not None:
+                distances, positions = self.base.search(queries, min(k + self.dead_base, self.base.ntotal))
+            else:
+                distances, positions = self.base.search(queries, k)
+            base_rows = self.base_rows
+            for q in range(len(queries)):
+                found, found_distances = positions[q], distances[q]
+                if self.dead_mask is not None:
+                    keep = found != -1
+                    keep[keep] = ~self.dead_mask[found[keep]]
+                    found, found_distances = found[keep][:k], found_distances[keep][:k]
+                if exact:
+                    found, found_distances = rescore(queries[q], found[found != -1], self.originals, top_k)
+                for position, distance in zip(found, found_distances):
+                    if position == -1:
+                        continue
+                    row = int(position) if base_rows is None else int(base_rows[position])
+                    results[q].append((row, float(distance)))
+
+        if self.delta.ntotal:
+            distances, positions = self.delta.search(queries, min(top_k, self.delta.ntotal))
+            for q in range(len(queries)):
+                for position, distance in zip(positions[q], distances[q]):
+                    if position != -1:
+                        results[q].append((int(self.delta_live_rows[position]), float(distance)))
+                results[q].sort(key=lambda item: item[1])
+                del results[q][top_k:]
+        return results
+
+    def live_vectors(self, base: faiss.Index, dead: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Filas del almacén y vectores de todas las filas vivas, para compactar
+
+        Args:
+            base: Copia en memoria del índice base (se reconstruyen sus vectores
+                si no hay vectores originales)
+            dead: Máscara de filas muertas
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Filas y vectores, en orden de fila del almacén
+        """
+        rows = np.concatenate([self.base_row_ids(), self.delta_rows])
+        base_vectors = np.asarray(self.originals) if self.originals is not None else reconstruct_vectors(base)
+        vectors = np.concatenate([base_vectors, self.delta_vectors])
+        keep = ~dead[rows]
+        rows, vectors = rows[keep], vectors[keep]
+        order = np.argsort(rows, kind='stable')
+        return rows[order], vectors[order]
+
+    def layout(self) -> Dict[str, Any]:
+        """
+        Archivos que forman el índice, tal como se guardan en index_info.json
+        """
+        return {"base": self.name, "base_rows": self.rows_name, "base_originals": self.originals_name,
+                "segments": list(self.segments)}
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Tamaño del índice base y de los segmentos delta
+        """
+        return {
+            "base_vectors": int(self.base.ntotal),
+            "segments": len(self.segments),
+            "delta_vectors": int(len(self.delta_rows)),
+            "deleted_vectors": int(self.ntotal - self.live_count),
+            "live_vectors": int(self.live_count),
+        }
+
+
+class IndexSnapshot:
+    """
+    Generación publicada de los datos, tal como la usan las búsquedas
+
+    No se modifica después de crearse: una ingesta o una recarga crean otra
+    y la ponen en uso de una sola vez. Una búsqueda toma la instantánea al
+    empezar y la usa hasta el final, así que nunca mezcla dos generaciones.
+    """
+    def __init__(self, generation: int, index: SegmentedIndex, committed_rows: int, dead: np.ndarray):
+        """
+        Args:
+            generation: Generación de index_info.json
+            index: Índice con las filas muertas ya aplicadas
+            committed_rows: Filas del almacén confirmadas en esta generación
+            dead: Máscara de filas muertas hasta committed_rows (las filas
+                posteriores no existen para esta instantánea)
+        """
+        self.generation = generation
+        self.index = index
+        self.committed_rows = committed_rows
+        self.dead = dead
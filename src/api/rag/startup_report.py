@@ -0,0 +1,98 @@
+"""
+Informe de tiempos de arranque: importación de módulos e inicialización del sistema RAG.
+
+Uso (desde la carpeta src/):
+    python -m api.rag.startup_report
+    python -m api.rag.startup_report --top 30 --json startup.json
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+from typing import List, Dict, Any
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure_imports(module: str = "app") -> List[Dict[str, Any]]:
+    """
+    Importa un módulo en un proceso limpio con `-X importtime`
+
+    Returns:
+        List[Dict[str, Any]]: Importaciones de primer nivel con su tiempo acumulado
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SRC_DIR, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"No se pudo importar {module}: {result.stderr[-2000:]}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        # Las importaciones anidadas vienen indentadas; solo nos interesan las de primer nivel
+        if match and len(match.group(3)) <= 1:
+            imports.append({
+                "module": match.group(4),
+                "self_ms": int(match.group(1)) / 1000,
+                "cumulative_ms": int(match.group(2)) / 1000,
+            })
+    return imports
+
+
+def measure_rag_init() -> Dict[str, Any]:
+    """
+    Inicializa el EmbeddingsManager en este proceso y mide cada etapa
+    """
+    from .embeddings_manager import EmbeddingsManager
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    manager = EmbeddingsManager()
+    elapsed = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "seconds": round(elapsed, 4),
+        "stages": manager.startup_timings,
+        "index_mmap": manager.index_read_only,
+        "chunks": manager.get_chunk_count(),
+        "max_rss_increase_kb": rss_after - rss_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Informe de tiempos de arranque del servidor")
+    parser.add_argument("--module", default="app", help="Módulo a importar (por defecto app)")
+    parser.add_argument("--top", type=int, default=15, help="Número de importaciones a mostrar")
+    parser.add_argument("--json", dest="json_path", default=None, help="Guardar el informe en un archivo JSON")
+    args = parser.parse_args()
+
+    imports = measure_imports(args.module)
+    total_ms = sum(item["cumulative_ms"] for item in imports)
+    print(f"Importación de '{args.module}': {total_ms:.1f} ms en total")
+    for item in sorted(imports, key=lambda item: item["cumulative_ms"], reverse=True)[:args.top]:
+        print(f"  {item['cumulative_ms']:>9.1f} ms  {item['module']}")
+
+    rag_init = measure_rag_init()
+    print(f"Inicialización del sistema RAG: {rag_init['seconds'] * 1000:.1f} ms "
+          f"({rag_init['chunks']} chunks, índice mmap: {rag_init['index_mmap']}, "
+          f"RSS +{rag_init['max_rss_increase_kb']} KB)")
+    for stage, seconds in rag_init["stages"].items():
+        if stage != "total":
+            print(f"  {seconds * 1000:>9.1f} ms  {stage}")
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({"module": args.module, "import_total_ms": total_ms, "imports": imports,
+                       "rag_init": rag_init}, f, indent=2)
+        print(f"Informe guardado en {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
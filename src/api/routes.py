@@ -2,13 +2,23 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for, Blueprint
+import json
+import time
+import base64
+import secrets
+from flask import Flask, request, jsonify, url_for, Blueprint, Response, stream_with_context, send_file, g
 from api.models import db, User
-from api.utils import generate_sitemap, APIException
+from api.utils import generate_sitemap, APIException, sse_event
+from api.speech import SpeechPipeline, AudioStore, TTSCache, AUDIO_FORMATS, AUDIO_PUBLIC_URL
+from api.metrics import (
+    registry, stage_timer, observe_stage, observe_request, observe_prompt_tokens, add_usage, add_audio_bytes
+)
 from flask_cors import CORS
 from openai import OpenAI
 from api.rag import embeddings_manager
 from api.rag.routes import rag_api
+from api.rag.answer_cache import AnswerCache
+from api.rag.context_packer import pack_context, count_prompt_tokens, count_static_tokens
 
 api = Blueprint('api', __name__)
 
@@ -17,61 +27,53 @@ CORS(api)
 
 # Initialize OpenAI client
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+# URL alternativa de la API (por ejemplo el servidor simulado de benchmarks.mock_openai)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
 
 print(f"Initializing OpenAI client with API key: {OPENAI_API_KEY[:6]}...{OPENAI_API_KEY[-4:]}")
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+if OPENAI_BASE_URL:
+    print(f"Using OpenAI base URL: {OPENAI_BASE_URL}")
+openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
 
-# Registrar las rutas del sistema RAG
-api.register_blueprint(rag_api, url_prefix='/rag')
+# Número máximo de oraciones que se sintetizan a la vez en /realtime-chat
+TTS_MAX_WORKERS = int(os.getenv("TTS_MAX_WORKERS", "3"))
 
+# Formas de entregar el audio: base64 en el JSON, URL aparte o multipart con el audio en binario
+AUDIO_DELIVERY_MODES = ("base64", "url", "multipart")
+AUDIO_CHUNK_SIZE = 16 * 1024
 
-@api.route('/hello', methods=['POST', 'GET'])
-def handle_hello():
+# Modelo y voz de la síntesis de voz
+TTS_MODEL = "tts-1"
+TTS_VOICE = "alloy"
 
-    response_body = {
-        "message": "Hello! I'm a message that came from the backend, check the network tab on the google inspector and you will see the GET request"
-    }
+# Audios servidos por URL, compartidos entre workers
+audio_store = AudioStore()
 
-    return jsonify(response_body), 200
+# Audios ya sintetizados, compartidos entre workers
+tts_cache = TTSCache()
 
+# Respuestas a preguntas casi idénticas, válidas mientras no cambien los datos RAG
+answer_cache = AnswerCache()
+
+@api.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
-@api.route('/chat', methods=['POST'])
-def handle_chat():
-    data = request.json
-    
-    if not data or not data.get('message'):
-        return jsonify({"error": "No message provided"}), 400
-    
-    user_message = data.get('message')
-    
-    try:
-        print(f"Sending message to OpenAI: {user_message}")
-        print(f"API Key used: {openai_client.api_key[:6]}...{openai_client.api_key[-4:]}")
-        
-        # Buscar contexto relevante en la base de datos RAG
-        relevant_context = ""
-        try:
-            if embeddings_manager.get_chunk_count() > 0:
-                print(f"Buscando contexto relevante para: {user_message}")
-                search_results = embeddings_manager.search(user_message, top_k=3)
-                
-                if search_results:
-                    relevant_context = "Información relevante de nuestra base de conocimiento médico:\n\n"
-                    for i, result in enumerate(search_results):
-                        relevant_context += f"DOCUMENTO {i+1}: {result['document']['title']}\n"
-                        relevant_context += f"FUENTE: {result['document']['source']}\n"
-                        relevant_context += f"CONTENIDO: {result['text']}\n\n"
-                    print(f"Se encontraron {len(search_results)} fragmentos relevantes")
-                else:
-                    print("No se encontró contexto relevante en la base RAG")
-            else:
-                print("La base de datos RAG está vacía")
-        except Exception as rag_error:
-            print(f"Error al buscar en la base RAG: {str(rag_error)}")
-            # No bloqueamos la ejecución, simplemente continuamos sin contexto RAG
-        
-        # Construcción del sistema de mensaje para emergencias médicas
-        system_message = """Eres un asistente de IA especializado en soporte a operadores médicos de campo para emergencias. Tu función es responder consultas con precisión, usando una base de datos RAG con manuales de emergencia, protocolos médicos y guías actualizadas.
+
+@api.after_request
+def record_request_metrics(response):
+    # En streaming se mide hasta enviar las cabeceras; el resto queda en api_stage_seconds
+    if hasattr(g, "request_start"):
+        observe_request(request.endpoint or "unknown", response.status_code,
+                        time.perf_counter() - g.request_start)
+    return response
+
+
+# Registrar las rutas del sistema RAG
+api.register_blueprint(rag_api, url_prefix='/rag')
+
+# Mensaje de sistema para emergencias médicas (chat y tiempo real)
+SYSTEM_MESSAGE = """Eres un asistente de IA especializado en soporte a operadores médicos de campo para emergencias. Tu función es responder consultas con precisión, usando una base de datos RAG con manuales de emergencia, protocolos médicos y guías actualizadas.
 
 Directivas:
 Precisión: Extrae información únicamente de la base RAG. Si no hay datos relevantes, indica que se consulte a un supervisor médico. Siempre entrega los pasos de la base de RAG exactos sin modificaciones además asegúrate que siempre indicas que llame al 911.
@@ -91,32 +93,489 @@ Respuesta: Per manuales RAG:
 4. Compresiones torácicas: 100-120/min, 5-6 cm profundidad, centro pecho.
 5. Ventilaciones (si capacitado): 2 cada 30 compresiones.
 Nota: Continuar hasta llegada de ayuda o respuesta del paciente."""
-        
-        # Si tenemos contexto relevante, lo agregamos al mensaje del sistema
-        if relevant_context:
-            system_message += f"\n\n{relevant_context}"
-            
-            # Y pedimos específicamente que use la información RAG
-            system_message += "\n\nIMPORTANTE: Utiliza específicamente la información proporcionada en los documentos anteriores para responder a la consulta del usuario. Cita la fuente de la información. Si la información no es suficiente para responder completamente, indica qué información falta y sugiere consultar con un supervisor médico."
+
+# Mensaje de sistema para el chat de voz
+VOICE_SYSTEM_MESSAGE = "Eres un asistente de IA especializado en soporte a operadores médicos de campo para emergencias. Tu función es responder consultas con precisión, usando una base de datos RAG con manuales de emergencia, protocolos médicos y guías actualizadas.\nDirectivas:\nPrecisión: Extrae información únicamente de la base RAG. Si no hay datos relevantes, indica que se consulte a un supervisor médico. Siempre entrega los pasos de la base de RAG exactos sin modificaciones ademas asegurate que siempre indicas que llame al 911.\nContexto de emergencia: Usa lenguaje claro, conciso y profesional, optimizado para entornos de alta presión.\nEstructura: Presenta respuestas en pasos numerados o listas cuando sea aplicable.\nSeguridad: Prioriza protocolos que protejan al paciente. Advierte sobre procedimientos de alto riesgo que requieran supervisión.\nLimitaciones: No diagnostiques ni decidas clínicamente. Limítate a información de apoyo. Indica si la consulta excede el alcance de la base RAG.\nTono: Profesional, empático, directo.\nConsulta RAG: Busca datos actuales y relevantes en la base. Selecciona la fuente alineada con protocolos médicos estándar."
+
+# Número de fragmentos RAG candidatos para el prompt (el presupuesto de tokens decide cuántos entran)
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "3"))
+
+# Instrucción que se agrega cuando hay contexto RAG
+RAG_INSTRUCTIONS = "\n\nIMPORTANTE: Utiliza específicamente la información proporcionada en los documentos anteriores para responder a la consulta del usuario. Cita la fuente de la información. Si la información no es suficiente para responder completamente, indica qué información falta y sugiere consultar con un supervisor médico."
+
+
+def format_rag_context(search_results):
+    """
+    Convierte los resultados de la búsqueda RAG en el contexto para el prompt
+
+    El contexto respeta el presupuesto RAG_CONTEXT_MAX_TOKENS: los fragmentos
+    menos relevantes se recortan o descartan primero.
+
+    Returns:
+        Tuple[str, list, int]: Contexto, resultados que entraron y tokens del contexto
+    """
+    with stage_timer("context_packing"):
+        return pack_context(search_results)
+
+
+def build_rag_context(user_message, fast_results=None):
+    """
+    Busca contexto relevante en la base RAG para el mensaje del usuario
+
+    Args:
+        fast_results: Resultados de la búsqueda léxica ya hecha en `lookup_answer`
+
+    Returns:
+        Tuple[str, list, int]: Contexto para el prompt (vacío si no hay),
+        resultados usados en el contexto y sus tokens
+    """
+    relevant_context = ""
+    search_results = []
+    context_tokens = 0
+    try:
+        if fast_results is not None or embeddings_manager.get_chunk_count() > 0:
+            if fast_results is not None:
+                search_results = fast_results
+            else:
+                print(f"Buscando contexto relevante para: {user_message}")
+                search_results = embeddings_manager.search(user_message, top_k=RAG_TOP_K)
             
-        # Send message to OpenAI API
+            if search_results:
+                relevant_context, search_results, context_tokens = format_rag_context(search_results)
+                print(f"Se encontraron {len(search_results)} fragmentos relevantes")
+            else:
+                print("No se encontró contexto relevante en la base RAG")
+        else:
+            print("La base de datos RAG está vacía")
+    except Exception as rag_error:
+        print(f"Error al buscar en la base RAG: {str(rag_error)}")
+        # No bloqueamos la ejecución, simplemente continuamos sin contexto RAG
+    return relevant_context, search_results, context_tokens
+
+
+def add_rag_context(system_message, relevant_context):
+    """
+    Agrega el contexto RAG y la instrucción de usarlo al mensaje del sistema
+    """
+    if relevant_context:
+        system_message += f"\n\n{relevant_context}"
+        system_message += RAG_INSTRUCTIONS
+    return system_message
+
+
+def report_prompt_tokens(system_message, context_tokens, user_message):
+    """
+    Calcula y registra los tokens de entrada de una petición al modelo
+
+    Los tokens del mensaje de sistema y de los fragmentos RAG ya están
+    calculados, así que solo se tokeniza el mensaje del usuario.
+
+    Returns:
+        int: Tokens del prompt
+    """
+    extra_tokens = 0
+    if context_tokens:
+        extra_tokens = context_tokens + count_static_tokens("\n\n") + count_static_tokens(RAG_INSTRUCTIONS)
+    prompt_tokens = count_prompt_tokens(system_message, extra_tokens, user_message)
+    observe_prompt_tokens(prompt_tokens)
+    print(f"Prompt de {prompt_tokens} tokens ({context_tokens} de contexto RAG)")
+    return prompt_tokens
+
+
+def get_sources(search_results):
+    """
+    Devuelve los documentos citados en los resultados, sin repetir
+    """
+    sources = []
+    seen = set()
+    for result in search_results:
+        document = result['document']
+        if document['id'] not in seen:
+            seen.add(document['id'])
+            sources.append({"title": document['title'], "source": document['source']})
+    return sources
+
+
+def wants_event_stream(data):
+    """
+    Indica si el cliente pidió la respuesta en streaming (SSE)
+    """
+    return data.get('stream') is True or 'text/event-stream' in request.headers.get('Accept', '')
+
+
+def build_messages(system_message, user_message, fast_results=None):
+    """
+    Arma los mensajes para el modelo, con el contexto RAG si lo hay
+
+    Returns:
+        Tuple[list, bool, list]: Mensajes, si se usó contexto RAG y resultados de la búsqueda
+    """
+    relevant_context, search_results, context_tokens = build_rag_context(user_message, fast_results)
+    with stage_timer("context_assembly"):
+        messages = [
+            {"role": "system", "content": add_rag_context(system_message, relevant_context)},
+            {"role": "user", "content": user_message}
+        ]
+    report_prompt_tokens(system_message, context_tokens, user_message)
+    return messages, relevant_context != "", search_results
+
+
+def complete_chat(messages):
+    """
+    Pide la respuesta completa al modelo
+    """
+    with stage_timer("completion"):
         response = openai_client.chat.completions.create(
             model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
+            messages=messages,
             temperature=0.2,
             max_tokens=1000
         )
+    add_usage(getattr(response, "usage", None))
+    return response.choices[0].message.content
+
+
+def stream_chat_text(messages):
+    """
+    Pide la respuesta al modelo en streaming y devuelve sus fragmentos de texto
+
+    Registra el tiempo hasta el primer token, el tiempo total y los tokens
+    (que la API envía en el último fragmento).
+    """
+    start = time.perf_counter()
+    first_token = True
+    stream = openai_client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=messages,
+        temperature=0.2,
+        max_tokens=1000,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    for chunk in stream:
+        add_usage(getattr(chunk, "usage", None))
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token:
+                observe_stage("completion_first_token", time.perf_counter() - start)
+                first_token = False
+            yield chunk.choices[0].delta.content
+    observe_stage("completion", time.perf_counter() - start)
+
+
+def lookup_answer(kind, user_message):
+    """
+    Busca en la caché semántica la respuesta a una pregunta casi idéntica
+
+    Reutiliza el embedding de la consulta que también usa la búsqueda RAG,
+    así que no agrega llamadas a la API. Si la búsqueda léxica basta, no se
+    pide el embedding y la respuesta no pasa por la caché.
+
+    Returns:
+        Tuple[Optional[dict], Optional[tuple], Optional[list]]: Respuesta
+        guardada (o None), la clave con la que guardar la respuesta nueva y
+        los resultados de la búsqueda léxica, si bastaron
+    """
+    if not answer_cache.enabled:
+        return None, None, None
+    try:
+        if embeddings_manager.get_chunk_count() > 0:
+            fast_results = embeddings_manager.fast_path_search(user_message, RAG_TOP_K)
+            if fast_results is not None:
+                return None, None, fast_results
+    except Exception as rag_error:
+        print(f"Error al buscar en la base RAG: {str(rag_error)}")
+    try:
+        embedding = embeddings_manager.get_query_embedding(user_message)
+        generation = embeddings_manager.get_generation()
+    except Exception as e:
+        print(f"No se pudo consultar la caché de respuestas: {str(e)}")
+        return None, None, None
+    cached_answer = answer_cache.get(kind, embedding, generation)
+    if cached_answer is not None:
+        print(f"Respuesta encontrada en la caché (similitud {cached_answer['similarity']})")
+    return cached_answer, (kind, embedding, generation), None
+
+
+def remember_answer(cache_key, response, rag_used, sources, request_start):
+    """
+    Guarda una respuesta en la caché semántica
+    """
+    if cache_key is None or not response:
+        return
+    kind, embedding, generation = cache_key
+    answer_cache.put(kind, embedding, generation, {
+        "response": response,
+        "rag_used": rag_used,
+        "sources": sources
+    }, time.perf_counter() - request_start)
+
+
+def stream_chat_completion(messages, rag_used, search_results, request_start,
+                           cache_key=None, cached_answer=None):
+    """
+    Genera eventos SSE con los tokens de la respuesta a medida que llegan
+
+    Emite un evento "token" por fragmento y un evento final "done" con la
+    respuesta completa, `rag_used` y las fuentes. Si algo falla después de
+    empezar a transmitir, se emite un evento "error". Una respuesta de la
+    caché se envía en un solo evento "token".
+    """
+    parts = []
+    ttft_ms = None
+    try:
+        if cached_answer is not None:
+            fragments = iter([cached_answer["response"]])
+            rag_used, sources = cached_answer["rag_used"], cached_answer["sources"]
+        else:
+            fragments = stream_chat_text(messages)
+            sources = get_sources(search_results)
+        for content in fragments:
+            if ttft_ms is None:
+                ttft_ms = (time.perf_counter() - request_start) * 1000
+                print(f"Time to first token: {ttft_ms:.0f} ms")
+            parts.append(content)
+            yield sse_event("token", {"content": content})
+        
+        ai_response = "".join(parts)
+        total_ms = (time.perf_counter() - request_start) * 1000
+        print(f"Streamed response from OpenAI in {total_ms:.0f} ms: {ai_response[:100]}...")
+        if cached_answer is None:
+            remember_answer(cache_key, ai_response, rag_used, sources, request_start)
+        yield sse_event("done", {
+            "response": ai_response,
+            "rag_used": rag_used,
+            "sources": sources,
+            "cached": cached_answer is not None,
+            "ttft_ms": round(ttft_ms, 1) if ttft_ms is not None else None,
+            "total_ms": round(total_ms, 1)
+        })
+    except Exception as e:
+        print(f"Error streaming from OpenAI API: {str(e)}")
+        yield sse_event("error", {
+            "error": "Failed to get response from AI service",
+            "details": str(e)
+        })
+
+
+def get_audio_options(data):
+    """
+    Lee el formato y la forma de entrega del audio pedidos por el cliente
+
+    Returns:
+        Tuple[str, str]: Formato (mp3, opus, aac...) y entrega (base64, url o multipart)
+    """
+    audio_format = data.get('audio_format', 'mp3')
+    audio_delivery = data.get('audio_delivery', 'base64')
+    if audio_format not in AUDIO_FORMATS:
+        raise APIException(f"Unsupported audio_format, use one of: {', '.join(AUDIO_FORMATS)}")
+    if audio_delivery not in AUDIO_DELIVERY_MODES:
+        raise APIException(f"Unsupported audio_delivery, use one of: {', '.join(AUDIO_DELIVERY_MODES)}")
+    return audio_format, audio_delivery
+
+
+def synthesize_speech(text, audio_format="mp3"):
+    """
+    Convierte un texto en audio con la API de TTS de OpenAI, pasando por la caché
+    """
+    audio = tts_cache.get(text, TTS_VOICE, TTS_MODEL, audio_format)
+    if audio is not None:
+        add_audio_bytes("tts_cache", len(audio))
+        return audio
+    with stage_timer("tts"):
+        audio_response = openai_client.audio.speech.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
+            input=text,
+            response_format=audio_format
+        )
+    tts_cache.put(text, TTS_VOICE, TTS_MODEL, audio_format, audio_response.content)
+    add_audio_bytes("tts", len(audio_response.content))
+    return audio_response.content
+
+
+def audio_payload(audio, audio_format, audio_delivery):
+    """
+    Campos de la respuesta JSON con el audio, incrustado en base64 o como URL
+
+    La URL es absoluta: la app móvil no se sirve desde el mismo origen que la API.
+    """
+    with stage_timer("audio_encoding"):
+        if audio_delivery == "url":
+            name = audio_store.save(audio, audio_format)
+            url = AUDIO_PUBLIC_URL + url_for('api.get_audio', name=name, _external=not AUDIO_PUBLIC_URL)
+            return {"audio_url": url, "audio_format": audio_format}
+        return {"audio": base64.b64encode(audio).decode("utf-8"), "audio_format": audio_format}
+
+
+def multipart_speech_response(payload, text, audio_format):
+    """
+    Respuesta multipart/mixed: primero el JSON y después el audio en binario
+
+    Los bytes del audio se reenvían al cliente a medida que llegan de la API
+    de TTS, sin pasar por disco ni por base64; si el audio está en la caché se
+    envía directamente. Si la síntesis falla, se agrega una parte JSON con
+    `tts_error`.
+    """
+    boundary = secrets.token_hex(16)
+
+    def generate():
+        yield (f"--{boundary}\r\nContent-Type: application/json; charset=utf-8\r\n\r\n"
+               f"{json.dumps(payload, ensure_ascii=False)}\r\n").encode("utf-8")
+        audio_header = f"--{boundary}\r\nContent-Type: {AUDIO_FORMATS[audio_format]}\r\n\r\n".encode("utf-8")
+        cached = tts_cache.get(text, TTS_VOICE, TTS_MODEL, audio_format)
+        if cached is not None:
+            add_audio_bytes("tts_cache", len(cached))
+            yield audio_header + cached + b"\r\n"
+            yield f"--{boundary}--\r\n".encode("utf-8")
+            return
+        try:
+            start = time.perf_counter()
+            with openai_client.audio.speech.with_streaming_response.create(
+                model=TTS_MODEL,
+                voice=TTS_VOICE,
+                input=text,
+                response_format=audio_format
+            ) as audio_response:
+                yield audio_header
+                chunks = []
+                for chunk in audio_response.iter_bytes(AUDIO_CHUNK_SIZE):
+                    chunks.append(chunk)
+                    yield chunk
+                yield b"\r\n"
+            observe_stage("tts", time.perf_counter() - start)
+            audio = b"".join(chunks)
+            add_audio_bytes("tts", len(audio))
+            tts_cache.put(text, TTS_VOICE, TTS_MODEL, audio_format, audio)
+        except Exception as tts_error:
+            print(f"Error in TTS conversion: {str(tts_error)}")
+            yield (f"--{boundary}\r\nContent-Type: application/json; charset=utf-8\r\n\r\n"
+                   f"{json.dumps({'tts_error': str(tts_error)})}\r\n").encode("utf-8")
+        yield f"--{boundary}--\r\n".encode("utf-8")
+
+    return Response(stream_with_context(generate()), mimetype=f"multipart/mixed; boundary={boundary}")
+
+
+def stream_realtime_speech(messages, rag_used, search_results, request_start,
+                           audio_format="mp3", audio_delivery="base64",
+                           cache_key=None, cached_answer=None):
+    """
+    Genera eventos SSE con el audio de la respuesta, oración por oración
+
+    La respuesta se pide en streaming y cada oración se sintetiza en cuanto
+    está completa, mientras el modelo sigue generando las siguientes. Emite un
+    evento "audio" por oración (en orden, con su índice, texto y audio en
+    base64 o su URL) y un evento final "done" con la respuesta completa. Una
+    respuesta de la caché se divide y sintetiza igual, sin llamar al modelo.
+    """
+    pipeline = SpeechPipeline(
+        lambda sentence: synthesize_speech(sentence, audio_format),
+        max_workers=TTS_MAX_WORKERS
+    )
+    first_audio_ms = None
+    tts_errors = 0
+    try:
+        if cached_answer is not None:
+            fragments = iter([cached_answer["response"]])
+            rag_used, sources = cached_answer["rag_used"], cached_answer["sources"]
+        else:
+            fragments = stream_chat_text(messages)
+            sources = get_sources(search_results)
+        for index, sentence, audio, tts_error in pipeline.run(fragments):
+            if tts_error is not None:
+                tts_errors += 1
+                print(f"Error in TTS conversion of sentence {index}: {str(tts_error)}")
+                yield sse_event("audio", {
+                    "index": index,
+                    "text": sentence,
+                    "audio": None,
+                    "tts_error": str(tts_error)
+                })
+                continue
+            if first_audio_ms is None:
+                first_audio_ms = (time.perf_counter() - request_start) * 1000
+                print(f"Time to first audio: {first_audio_ms:.0f} ms")
+            yield sse_event("audio", {
+                "index": index,
+                "text": sentence,
+                **audio_payload(audio, audio_format, audio_delivery)
+            })
+        
+        total_ms = (time.perf_counter() - request_start) * 1000
+        print(f"Streamed real-time response in {total_ms:.0f} ms ({tts_errors} TTS errors)")
+        if cached_answer is None:
+            remember_answer(cache_key, pipeline.text, rag_used, sources, request_start)
+        yield sse_event("done", {
+            "response": pipeline.text,
+            "rag_used": rag_used,
+            "sources": sources,
+            "cached": cached_answer is not None,
+            "first_audio_ms": round(first_audio_ms, 1) if first_audio_ms is not None else None,
+            "total_ms": round(total_ms, 1)
+        })
+    except Exception as e:
+        print(f"Error streaming real-time response: {str(e)}")
+        yield sse_event("error", {
+            "error": "Failed to process real-time request",
+            "details": str(e)
+        })
+
+
+@api.route('/hello', methods=['POST', 'GET'])
+def handle_hello():
+
+    response_body = {
+        "message": "Hello! I'm a message that came from the backend, check the network tab on the google inspector and you will see the GET request"
+    }
+
+    return jsonify(response_body), 200
+
+
+@api.route('/chat', methods=['POST'])
+def handle_chat():
+    data = request.json
+    
+    if not data or not data.get('message'):
+        return jsonify({"error": "No message provided"}), 400
+    
+    user_message = data.get('message')
+    request_start = time.perf_counter()
+    
+    try:
+        print(f"Sending message to OpenAI: {user_message}")
+        print(f"API Key used: {openai_client.api_key[:6]}...{openai_client.api_key[-4:]}")
         
-        # Extract assistant's response
-        ai_response = response.choices[0].message.content
+        # Una pregunta casi idéntica, respondida con los mismos datos RAG, se sirve desde la caché
+        cached_answer, cache_key, fast_results = lookup_answer("chat", user_message)
+        messages, rag_used, search_results = [], False, []
+        if cached_answer is None:
+            # Buscar contexto relevante en la base RAG y armar el mensaje de sistema para emergencias médicas
+            messages, rag_used, search_results = build_messages(SYSTEM_MESSAGE, user_message, fast_results)
+        
+        # Los clientes que lo piden reciben los tokens por SSE; el resto sigue con JSON
+        if wants_event_stream(data):
+            return Response(
+                stream_with_context(stream_chat_completion(
+                    messages, rag_used, search_results, request_start, cache_key, cached_answer
+                )),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+        
+        if cached_answer is not None:
+            return jsonify({
+                "response": cached_answer["response"],
+                "rag_used": cached_answer["rag_used"],
+                "cached": True
+            }), 200
+            
+        # Send message to OpenAI API
+        ai_response = complete_chat(messages)
         print(f"Received response from OpenAI: {ai_response[:100]}...")
+        remember_answer(cache_key, ai_response, rag_used, get_sources(search_results), request_start)
         
         return jsonify({
             "response": ai_response,
-            "rag_used": relevant_context != ""
+            "rag_used": rag_used
         }), 200
         
     except Exception as e:
@@ -140,60 +599,18 @@ def handle_realtime_chat():
         return jsonify({"error": "No message provided"}), 400
     
     user_message = data.get('message')
+    audio_format, audio_delivery = get_audio_options(data)
+    request_start = time.perf_counter()
     
     try:
         print(f"Processing real-time message: {user_message}")
         
-        # Buscar contexto relevante en la base de datos RAG
-        relevant_context = ""
-        try:
-            if embeddings_manager.get_chunk_count() > 0:
-                print(f"Buscando contexto relevante para: {user_message}")
-                search_results = embeddings_manager.search(user_message, top_k=3)
-                
-                if search_results:
-                    relevant_context = "Información relevante de nuestra base de conocimiento médico:\n\n"
-                    for i, result in enumerate(search_results):
-                        relevant_context += f"DOCUMENTO {i+1}: {result['document']['title']}\n"
-                        relevant_context += f"FUENTE: {result['document']['source']}\n"
-                        relevant_context += f"CONTENIDO: {result['text']}\n\n"
-                    print(f"Se encontraron {len(search_results)} fragmentos relevantes")
-                else:
-                    print("No se encontró contexto relevante en la base RAG")
-            else:
-                print("La base de datos RAG está vacía")
-        except Exception as rag_error:
-            print(f"Error al buscar en la base RAG: {str(rag_error)}")
-            # No bloqueamos la ejecución, simplemente continuamos sin contexto RAG
-        
-        # Construcción del sistema de mensaje para emergencias médicas con RAG
-        system_message = """Eres un asistente de IA especializado en soporte a operadores médicos de campo para emergencias. Tu función es responder consultas con precisión, usando una base de datos RAG con manuales de emergencia, protocolos médicos y guías actualizadas.
-
-Directivas:
-Precisión: Extrae información únicamente de la base RAG. Si no hay datos relevantes, indica que se consulte a un supervisor médico. Siempre entrega los pasos de la base de RAG exactos sin modificaciones además asegúrate que siempre indicas que llame al 911.
-Contexto de emergencia: Usa lenguaje claro, conciso y profesional, optimizado para entornos de alta presión.
-Estructura: Presenta respuestas en pasos numerados o listas cuando sea aplicable.
-Seguridad: Prioriza protocolos que protejan al paciente. Advierte sobre procedimientos de alto riesgo que requieran supervisión.
-Limitaciones: No diagnostiques ni decidas clínicamente. Limítate a información de apoyo. Indica si la consulta excede el alcance de la base RAG.
-Tono: Profesional, empático, directo.
-Consulta RAG: Busca datos actuales y relevantes en la base. Selecciona la fuente alineada con protocolos médicos estándar.
-
-Ejemplo:
-Consulta: "Pasos RCP adulto."
-Respuesta: Per manuales RAG:
-1. Verificar seguridad.
-2. Confirmar inconsciencia y ausencia de respiración normal.
-3. Llamar emergencia (911).
-4. Compresiones torácicas: 100-120/min, 5-6 cm profundidad, centro pecho.
-5. Ventilaciones (si capacitado): 2 cada 30 compresiones.
-Nota: Continuar hasta llegada de ayuda o respuesta del paciente."""
-        
-        # Si tenemos contexto relevante, lo agregamos al mensaje del sistema
-        if relevant_context:
-            system_message += f"\n\n{relevant_context}"
-            
-            # Y pedimos específicamente que use la información RAG
-            system_message += "\n\nIMPORTANTE: Utiliza específicamente la información proporcionada en los documentos anteriores para responder a la consulta del usuario. Cita la fuente de la información. Si la información no es suficiente para responder completamente, indica qué información falta y sugiere consultar con un supervisor médico."
+        # Comparte las respuestas en caché con /chat, que usa el mismo mensaje de sistema
+        cached_answer, cache_key, fast_results = lookup_answer("chat", user_message)
+        messages, rag_used, search_results = [], False, []
+        if cached_answer is None:
+            # Buscar contexto relevante en la base RAG y armar el mensaje de sistema para emergencias médicas
+            messages, rag_used, search_results = build_messages(SYSTEM_MESSAGE, user_message, fast_results)
         
 # ////
        # system_message = "Eres un asistente de IA especializado en porteria, atiendes un comunicador donde se comunican personas que llegan al edificio, te llamas portero. Tu función es responder consultas con precisió.\nDirectivas:\nContexto: Usa lenguaje claro, conciso y profesional, optimizado para entornos de alta presión.\nEstructura: Presenta respuestas claras y siempre di gracias y un segundo por favor\nTono: Profesional, empático, directo."
@@ -242,20 +659,23 @@ Nota: Continuar hasta llegada de ayuda o respuesta del paciente."""
 
 # Tono:
 # Profesional, empático, directo. Siempre responde de forma clara. Incluí "Gracias" y "Un segundo por favor" en cada interacción donde corresponda. Nunca inventes respuestas ni salgas del protocolo. Si el visitante no colabora, decí: 'Disculpe, no puedo continuar sin esa información. Gracias.'"""
-        # Using OpenAI text-to-speech API to convert the response to audio
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
-            temperature=0.2,
-            max_tokens=1000
-        )
+        # En streaming, cada oración se sintetiza y se envía en cuanto está completa
+        if wants_event_stream(data):
+            return Response(
+                stream_with_context(stream_realtime_speech(
+                    messages, rag_used, search_results, request_start,
+                    audio_format, audio_delivery, cache_key, cached_answer
+                )),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
         
-        # Extract assistant's response text
-        ai_response_text = response.choices[0].message.content
-        print(f"Received text response from OpenAI: {ai_response_text[:100]}...")
+        if cached_answer is not None:
+            ai_response_text, rag_used = cached_answer["response"], cached_answer["rag_used"]
+        else:
+            ai_response_text = complete_chat(messages)
+            print(f"Received text response from OpenAI: {ai_response_text[:100]}...")
+            remember_answer(cache_key, ai_response_text, rag_used, get_sources(search_results), request_start)
         print(f"Response length: {len(ai_response_text)} characters")
         
         # Truncate response for TTS if too long (OpenAI TTS has a 4096 character limit)
@@ -265,41 +685,23 @@ Nota: Continuar hasta llegada de ayuda o respuesta del paciente."""
             tts_text = ai_response_text[:3900] + "... Consulta la respuesta completa en pantalla."
             print(f"Response truncated for TTS: {len(tts_text)} characters")
         
+        # En multipart el audio se reenvía en binario a medida que se sintetiza
+        if audio_delivery == "multipart":
+            return multipart_speech_response({
+                "response": ai_response_text,
+                "rag_used": rag_used
+            }, tts_text, audio_format)
+        
         # Convert the text response to speech using OpenAI TTS API
         try:
             print("Starting TTS conversion...")
-            audio_response = openai_client.audio.speech.create(
-                model="tts-1", # Using the standard TTS model
-                voice="alloy", # You can choose from "alloy", "echo", "fable", "onyx", "nova", "shimmer"
-                input=tts_text
-            )
-            print("TTS conversion completed successfully")
-            
-            # Save the audio response as a temporary file
-            from tempfile import NamedTemporaryFile
-            import base64
-            
-            with NamedTemporaryFile(delete=False, suffix=".mp3") as temp_file:
-                temp_filename = temp_file.name
-                # Get the audio content as bytes
-                audio_content = audio_response.content
-                # Write the audio content to the temp file
-                temp_file.write(audio_content)
-                print(f"Audio file saved: {len(audio_content)} bytes")
-            
-            # Read the audio file and encode it as base64
-            with open(temp_filename, "rb") as audio_file:
-                encoded_audio = base64.b64encode(audio_file.read()).decode("utf-8")
-                print(f"Audio encoded to base64: {len(encoded_audio)} characters")
-            
-            # Delete the temporary file
-            import os
-            os.unlink(temp_filename)
+            audio_content = synthesize_speech(tts_text, audio_format)
+            print(f"TTS conversion completed successfully: {len(audio_content)} bytes")
             
             return jsonify({
                 "response": ai_response_text,
-                "audio": encoded_audio,
-                "rag_used": relevant_context != ""
+                **audio_payload(audio_content, audio_format, audio_delivery),
+                "rag_used": rag_used
             }), 200
             
         except Exception as tts_error:
@@ -308,7 +710,7 @@ Nota: Continuar hasta llegada de ayuda o respuesta del paciente."""
             return jsonify({
                 "response": ai_response_text,
                 "audio": None,
-                "rag_used": relevant_context != "",
+                "rag_used": rag_used,
                 "tts_error": str(tts_error)
             }), 200
         
@@ -333,86 +735,36 @@ def handle_voice_chat():
         return jsonify({"error": "No message provided"}), 400
     
     user_message = data.get('message')
+    audio_format, audio_delivery = get_audio_options(data)
+    request_start = time.perf_counter()
     
     try:
         print(f"Processing voice message: {user_message}")
         
-        # Similar RAG search as in handle_chat
-        relevant_context = ""
-        try:
-            if embeddings_manager.get_chunk_count() > 0:
-                print(f"Buscando contexto relevante para: {user_message}")
-                search_results = embeddings_manager.search(user_message, top_k=3)
-                
-                if search_results:
-                    relevant_context = "Información relevante de nuestra base de conocimiento médico:\n\n"
-                    for i, result in enumerate(search_results):
-                        relevant_context += f"DOCUMENTO {i+1}: {result['document']['title']}\n"
-                        relevant_context += f"FUENTE: {result['document']['source']}\n"
-                        relevant_context += f"CONTENIDO: {result['text']}\n\n"
-                    print(f"Se encontraron {len(search_results)} fragmentos relevantes")
-                else:
-                    print("No se encontró contexto relevante en la base RAG")
-            else:
-                print("La base de datos RAG está vacía")
-        except Exception as rag_error:
-            print(f"Error al buscar en la base RAG: {str(rag_error)}")
-        
-        # Construcción del sistema de mensaje
-        system_message = "Eres un asistente de IA especializado en soporte a operadores médicos de campo para emergencias. Tu función es responder consultas con precisión, usando una base de datos RAG con manuales de emergencia, protocolos médicos y guías actualizadas.\nDirectivas:\nPrecisión: Extrae información únicamente de la base RAG. Si no hay datos relevantes, indica que se consulte a un supervisor médico. Siempre entrega los pasos de la base de RAG exactos sin modificaciones ademas asegurate que siempre indicas que llame al 911.\nContexto de emergencia: Usa lenguaje claro, conciso y profesional, optimizado para entornos de alta presión.\nEstructura: Presenta respuestas en pasos numerados o listas cuando sea aplicable.\nSeguridad: Prioriza protocolos que protejan al paciente. Advierte sobre procedimientos de alto riesgo que requieran supervisión.\nLimitaciones: No diagnostiques ni decidas clínicamente. Limítate a información de apoyo. Indica si la consulta excede el alcance de la base RAG.\nTono: Profesional, empático, directo.\nConsulta RAG: Busca datos actuales y relevantes en la base. Selecciona la fuente alineada con protocolos médicos estándar."
-        
-        # Si tenemos contexto relevante, lo agregamos al mensaje del sistema
-        if relevant_context:
-            system_message += f"\n\n{relevant_context}"
-            
-            # Y pedimos específicamente que use la información RAG
-            system_message += "\n\nIMPORTANTE: Utiliza específicamente la información proporcionada en los documentos anteriores para responder a la consulta del usuario. Cita la fuente de la información. Si la información no es suficiente para responder completamente, indica qué información falta y sugiere consultar con un supervisor médico."
-        
-        # Using OpenAI text-to-speech API to convert the response to audio
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
-            temperature=0.2,
-            max_tokens=1000
-        )
-        
-        # Extract assistant's response text
-        ai_response_text = response.choices[0].message.content
-        print(f"Received text response from OpenAI: {ai_response_text[:100]}...")
+        cached_answer, cache_key, fast_results = lookup_answer("voice", user_message)
+        if cached_answer is not None:
+            ai_response_text, rag_used = cached_answer["response"], cached_answer["rag_used"]
+        else:
+            # Similar RAG search as in handle_chat
+            messages, rag_used, search_results = build_messages(VOICE_SYSTEM_MESSAGE, user_message, fast_results)
+            ai_response_text = complete_chat(messages)
+            print(f"Received text response from OpenAI: {ai_response_text[:100]}...")
+            remember_answer(cache_key, ai_response_text, rag_used, get_sources(search_results), request_start)
+        
+        # En multipart el audio se reenvía en binario a medida que se sintetiza
+        if audio_delivery == "multipart":
+            return multipart_speech_response({
+                "response": ai_response_text,
+                "rag_used": rag_used
+            }, ai_response_text, audio_format)
         
         # Convert the text response to speech using OpenAI TTS API
-        audio_response = openai_client.audio.speech.create(
-            model="tts-1", # Using the standard TTS model
-            voice="alloy", # You can choose from "alloy", "echo", "fable", "onyx", "nova", "shimmer"
-            input=ai_response_text
-        )
-        
-        # Save the audio response as a temporary file
-        from tempfile import NamedTemporaryFile
-        import base64
-        
-        with NamedTemporaryFile(delete=False, suffix=".mp3") as temp_file:
-            temp_filename = temp_file.name
-            # Get the audio content as bytes
-            audio_content = audio_response.content
-            # Write the audio content to the temp file
-            temp_file.write(audio_content)
-        
-        # Read the audio file and encode it as base64
-        with open(temp_filename, "rb") as audio_file:
-            encoded_audio = base64.b64encode(audio_file.read()).decode('utf-8')
-        
-        # Delete the temporary file
-        import os
-        os.unlink(temp_filename)
+        audio_content = synthesize_speech(ai_response_text, audio_format)
         
         return jsonify({
             "response": ai_response_text,
-            "audio": encoded_audio,
-            "rag_used": relevant_context != ""
+            **audio_payload(audio_content, audio_format, audio_delivery),
+            "rag_used": rag_used
         }), 200
         
     except Exception as e:
@@ -427,3 +779,39 @@ def handle_voice_chat():
             "error": "Failed to process voice request", 
             "details": error_message
         }), 500
+
+
+@api.route('/audio/<name>', methods=['GET'])
+def get_audio(name):
+    """
+    Sirve un audio de respuesta guardado con audio_delivery="url"
+    """
+    clip = audio_store.get_path(name)
+    if clip is None:
+        return jsonify({"error": "Audio not found or expired"}), 404
+    path, audio_format = clip
+    return send_file(path, mimetype=AUDIO_FORMATS[audio_format], max_age=audio_store.ttl)
+
+
+@api.route('/tts-cache/stats', methods=['GET'])
+def get_tts_cache_stats():
+    """
+    Devuelve las estadísticas de la caché de audio de este worker
+    """
+    return jsonify(tts_cache.stats()), 200
+
+
+@api.route('/answer-cache/stats', methods=['GET'])
+def get_answer_cache_stats():
+    """
+    Devuelve las estadísticas de la caché de respuestas de este worker
+    """
+    return jsonify(answer_cache.stats()), 200
+
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Métricas de todos los workers en formato de texto de Prometheus
+    """
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
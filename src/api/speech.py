@@ -0,0 +1,381 @@
+"""
+Síntesis de voz por oraciones en paralelo con la generación de la respuesta.
+"""
+import os
+import re
+import time
+import queue
+import hashlib
+import secrets
+import unicodedata
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Tuple, Optional, Dict, Any
+
+# Límite de caracteres por petición de la API de TTS de OpenAI (4096)
+MAX_TTS_CHARS = 4000
+
+# Formatos de audio de la API de TTS y su tipo MIME (opus viene en un contenedor Ogg)
+AUDIO_FORMATS = {
+    "mp3": "audio/mpeg",
+    "opus": "audio/ogg; codecs=opus",
+    "aac": "audio/aac",
+    "flac": "audio/flac",
+    "wav": "audio/wav",
+    "pcm": "audio/L16; rate=24000; channels=1",
+}
+
+# Carpeta de los audios servidos por URL; /dev/shm es memoria compartida por todos los workers
+AUDIO_DIR = os.getenv(
+    "AUDIO_DIR",
+    "/dev/shm/api-audio" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "api-audio")
+)
+# Segundos que un audio sigue disponible en su URL
+AUDIO_TTL = int(os.getenv("AUDIO_TTL", "300"))
+# URL pública del servidor para los enlaces de audio (por ejemplo detrás de un proxy);
+# sin definir se usa el host de cada request
+AUDIO_PUBLIC_URL = os.getenv("AUDIO_PUBLIC_URL", "").rstrip("/")
+
+CLIP_ID = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+# Caché de audios sintetizados, compartida por los workers (0 bytes la desactiva)
+TTS_CACHE_DIR = os.getenv(
+    "TTS_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tts_cache")
+)
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Una oración termina en . ! ? … o salto de línea seguidos de espacio
+SENTENCE_END = re.compile(r"([.!?…]+[\"')\]]*\s+|\n+)")
+
+# "1." o "b)" son marcadores de lista, no el final de una oración
+LIST_MARKER = re.compile(r"(^|\s)(\d{1,2}|[a-zA-Z])[.)]\s*$")
+
+
+class SentenceSplitter:
+    """
+    Divide en oraciones un texto que llega por fragmentos
+    """
+    def __init__(self, min_chars: int = 12):
+        """
+        Args:
+            min_chars: Longitud mínima de una oración; las más cortas se unen a la siguiente
+        """
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Agrega un fragmento y devuelve las oraciones que quedaron completas
+        """
+        self.buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            candidate = self.buffer[start:match.end()]
+            if len(candidate.strip()) < self.min_chars or LIST_MARKER.search(candidate):
+                continue
+            sentences.append(candidate.strip())
+            start = match.end()
+        self.buffer = self.buffer[start:]
+
+        # Cortar oraciones que no caben en una sola petición de TTS
+        while len(self.buffer) > MAX_TTS_CHARS:
+            cut = self.buffer.rfind(" ", 0, MAX_TTS_CHARS)
+            cut = cut if cut > 0 else MAX_TTS_CHARS
+            sentences.append(self.buffer[:cut].strip())
+            self.buffer = self.buffer[cut:]
+        return sentences
+
+    def flush(self) -> List[str]:
+        """
+        Devuelve el texto pendiente al terminar la respuesta
+        """
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+
+class SpeechPipeline:
+    """
+    Sintetiza cada oración en cuanto está completa, mientras el modelo sigue generando
+
+    Un hilo consume los fragmentos de la respuesta y encola la síntesis de
+    cada oración en un pool de hilos. `run()` entrega los audios en orden, de
+    modo que el primero puede reproducirse mientras se generan los siguientes.
+    """
+    def __init__(self, synthesize: Callable[[str], bytes], max_workers: int = 3):
+        """
+        Args:
+            synthesize: Función que convierte una oración en audio
+            max_workers: Número máximo de síntesis simultáneas
+        """
+        self.synthesize = synthesize
+        self.max_workers = max_workers
+        self.parts: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """
+        Texto completo recibido hasta el momento
+        """
+        return "".join(self.parts)
+
+    def run(self, fragments: Iterator[str]) -> Iterator[Tuple[int, str, bytes, Exception]]:
+        """
+        Consume los fragmentos de texto y entrega (índice, oración, audio, error) en orden
+
+        Si la síntesis de una oración falla, su audio es None y se entrega el
+        error. Un error al leer los fragmentos se propaga al consumidor.
+        """
+        pending = queue.Queue()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        done = object()
+
+        def produce():
+            splitter = SentenceSplitter()
+            index = 0
+            try:
+                for fragment in fragments:
+                    self.parts.append(fragment)
+                    for sentence in splitter.feed(fragment):
+                        pending.put((index, sentence, executor.submit(self.synthesize, sentence)))
+                        index += 1
+                for sentence in splitter.flush():
+                    pending.put((index, sentence, executor.submit(self.synthesize, sentence)))
+                    index += 1
+                pending.put(done)
+            except Exception as e:
+                pending.put(e)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                index, sentence, future = item
+                try:
+                    yield index, sentence, future.result(), None
+                except Exception as e:
+                    yield index, sentence, None, e
+        finally:
+            # Si el cliente se desconectó, no se pagan las síntesis que aún no empezaron
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AudioStore:
+    """
+    Audios de respuesta servidos por URL en lugar de incrustarlos en base64
+
+    Cada audio se guarda una sola vez como archivo en AUDIO_DIR (tmpfs cuando
+    existe /dev/shm), de modo que cualquier worker puede servirlo con
+    `send_file`. Los audios caducan a los AUDIO_TTL segundos.
+    """
+    def __init__(self, directory: str = AUDIO_DIR, ttl: int = AUDIO_TTL):
+        """
+        Args:
+            directory: Carpeta donde se guardan los audios
+            ttl: Segundos que un audio sigue disponible
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.last_purge = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, audio: bytes, audio_format: str) -> str:
+        """
+        Guarda un audio y devuelve su identificador
+        """
+        self.purge_expired()
+        clip_id = secrets.token_urlsafe(16)
+        path = os.path.join(self.directory, f"{clip_id}.{audio_format}")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(audio)
+        os.replace(tmp_path, path)
+        return f"{clip_id}.{audio_format}"
+
+    def get_path(self, name: str) -> Optional[Tuple[str, str]]:
+        """
+        Devuelve la ruta y el formato de un audio vigente, o None si no existe o caducó
+        """
+        clip_id, _, audio_format = name.partition(".")
+        if not CLIP_ID.match(clip_id) or audio_format not in AUDIO_FORMATS:
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+        except OSError:
+            return None
+        return path, audio_format
+
+    def purge_expired(self):
+        """
+        Borra los audios caducados, como mucho una vez por minuto
+        """
+        now = time.time()
+        if now - self.last_purge < 60:
+            return
+        self.last_purge = now
+        for entry in os.scandir(self.directory):
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    os.unlink(entry.path)
+            except OSError:
+                # Otro worker pudo haberlo borrado antes
+                pass
+
+
+def normalize_speech_text(text: str) -> str:
+    """
+    Normaliza un texto para usarlo como clave de la caché de audio
+
+    Solo unifica la forma Unicode y los espacios: mayúsculas, acentos y
+    puntuación cambian la pronunciación, así que se conservan.
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+class TTSCache:
+    """
+    Caché en disco de audios sintetizados, direccionada por contenido
+
+    Cada audio es un archivo cuyo nombre es el hash del texto normalizado, la
+    voz, el modelo y el formato. Todos los workers comparten la carpeta; la
+    fecha de modificación hace de marca de último uso y, cuando la carpeta
+    supera `max_bytes`, se borran primero los audios menos usados.
+    """
+    def __init__(self, directory: str = TTS_CACHE_DIR, max_bytes: int = TTS_CACHE_MAX_BYTES):
+        """
+        Args:
+            directory: Carpeta de la caché
+            max_bytes: Tamaño máximo de la carpeta; 0 desactiva la caché
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.errors = 0
+        self.writes = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(text: str, voice: str, model: str, audio_format: str) -> str:
+        """
+        Genera la clave de un audio
+        """
+        raw = f"{model}\x00{voice}\x00{audio_format}\x00{normalize_speech_text(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, text: str, voice: str, model: str, audio_format: str) -> Optional[bytes]:
+        """
+        Busca un audio en la caché
+
+        Returns:
+            Optional[bytes]: Audio o None si no está
+        """
+        if not self.enabled:
+            return None
+        path = self.get_path(self.make_key(text, voice, model, audio_format))
+        try:
+            with open(path, 'rb') as f:
+                audio = f.read()
+            # Marcar el audio como usado recientemente
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        except OSError as e:
+            with self.lock:
+                self.errors += 1
+                self.misses += 1
+            print(f"Error al leer la caché de audio: {str(e)}")
+            return None
+
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += len(audio)
+        return audio
+
+    def put(self, text: str, voice: str, model: str, audio_format: str, audio: bytes):
+        """
+        Guarda un audio en la caché
+        """
+        if not self.enabled or not audio:
+            return
+        path = self.get_path(self.make_key(text, voice, model, audio_format))
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            with self.lock:
+                self.errors += 1
+            print(f"Error al escribir la caché de audio: {str(e)}")
+            return
+
+        with self.lock:
+            self.writes += 1
+            prune = self.writes % 50 == 0
+        # Recortar la caché de vez en cuando
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """
+        Borra los audios menos usados hasta quedar por debajo de `max_bytes`
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                # Otro worker pudo haberlo borrado antes
+                pass
+            total -= size
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Devuelve los contadores de aciertos, fallos y bytes ahorrados de este proceso
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "max_bytes": self.max_bytes,
+                "errors": self.errors
+            }
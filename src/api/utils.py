@@ -1,3 +1,4 @@
+import json
 from flask import jsonify, url_for
 
 class APIException(Exception):
@@ -15,6 +16,12 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def sse_event(event, data):
+    """
+    Formatea un evento Server-Sent Events con datos JSON
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
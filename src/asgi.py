@@ -0,0 +1,70 @@
+"""
+Punto de entrada ASGI. Las rutas que esperan a OpenAI (chat, voz y RAG) se
+atienden con asyncio (ver api/async_routes.py); el resto de la aplicación
+Flask se sirve igual que con wsgi.py, en un pool de hilos.
+
+    gunicorn asgi:application --chdir ./src/ -k uvicorn_worker.UvicornWorker
+"""
+import os
+
+from quart import Quart, jsonify
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from werkzeug.exceptions import HTTPException
+
+from app import app as flask_app
+from api.utils import APIException
+from api.async_routes import async_api, close_async_client
+
+async_app = Quart(__name__, static_folder=None)
+async_app.register_blueprint(async_api, url_prefix='/api')
+
+# Tamaño máximo del cuerpo de las peticiones que pasan a Flask
+WSGI_MAX_BODY_SIZE = int(os.getenv("WSGI_MAX_BODY_SIZE", str(16 * 1024 * 1024)))
+wsgi_app = AsyncioWSGIMiddleware(flask_app, max_body_size=WSGI_MAX_BODY_SIZE)
+
+# Con RAG_PRELOAD=1 el índice RAG se carga antes de crear los workers, igual que en wsgi.py
+if os.getenv("RAG_PRELOAD") == "1":
+    from api.rag import embeddings_manager
+    embeddings_manager.initialize()
+
+
+@async_app.errorhandler(APIException)
+def handle_invalid_usage(error):
+    return jsonify(error.to_dict()), error.status_code
+
+
+@async_app.after_request
+def add_cors_headers(response):
+    # Mismo comportamiento que CORS(api) en las rutas de Flask
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    return response
+
+
+@async_app.after_serving
+async def shutdown():
+    await close_async_client()
+
+
+def is_async_route(path, method):
+    """
+    Indica si una petición la atiende la aplicación asíncrona
+    """
+    try:
+        async_app.url_map.bind("").match(path, method=method)
+        return True
+    except HTTPException:
+        return False
+
+
+async def application(scope, receive, send):
+    """
+    Reparte cada petición entre la aplicación asíncrona y la aplicación Flask
+    """
+    if scope["type"] == "lifespan" or (
+        scope["type"] == "http" and is_async_route(scope["path"], scope["method"])
+    ):
+        await async_app(scope, receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
@@ -0,0 +1,3 @@
+"""
+Benchmarks reproducibles de la aplicación, con las llamadas a OpenAI simuladas
+"""
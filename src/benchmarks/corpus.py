@@ -0,0 +1,100 @@
+"""
+Corpus sintético de protocolos de emergencia y consultas sobre él.
+
+Los documentos tienen el formato que acepta /api/rag/upload y un vocabulario
+médico reducido, para que la búsqueda léxica y la vectorial (con los
+embeddings simulados de benchmarks.stubs) encuentren resultados con sentido.
+"""
+import random
+from typing import List, Dict, Iterator
+
+CONDITIONS = [
+    "anafilaxia", "paro cardiorrespiratorio", "hemorragia externa", "quemadura térmica",
+    "obstrucción de la vía aérea", "crisis convulsiva", "hipoglucemia", "accidente cerebrovascular",
+    "infarto agudo de miocardio", "intoxicación por monóxido", "golpe de calor", "hipotermia",
+    "fractura expuesta", "traumatismo craneoencefálico", "crisis asmática", "parto inminente",
+    "shock hipovolémico", "ahogamiento", "electrocución", "mordedura de serpiente",
+]
+DRUGS = [
+    "adrenalina", "salbutamol", "glucosa", "ácido acetilsalicílico", "nitroglicerina", "diazepam",
+    "midazolam", "naloxona", "oxígeno", "amiodarona", "atropina", "suero fisiológico", "paracetamol",
+    "hidrocortisona", "clorfenamina", "morfina",
+]
+PROCEDURES = [
+    "compresiones torácicas", "ventilación con bolsa", "desfibrilación", "presión directa",
+    "torniquete", "posición lateral de seguridad", "inmovilización cervical", "enfriamiento activo",
+    "calentamiento pasivo", "maniobra de Heimlich", "acceso venoso", "monitorización cardíaca",
+    "control de la vía aérea", "irrigación con agua",
+]
+FINDINGS = [
+    "dificultad respiratoria", "pulso débil", "piel pálida", "sudoración profusa", "pérdida de conciencia",
+    "dolor torácico opresivo", "urticaria generalizada", "cianosis", "taquicardia", "hipotensión",
+    "confusión", "rigidez", "sangrado abundante", "edema facial",
+]
+TEMPLATES = [
+    "En caso de {condition}, administrar {drug} según indicación médica y vigilar {finding}.",
+    "Si el paciente presenta {finding}, iniciar {procedure} y llamar al 911.",
+    "La dosis habitual de {drug} en {condition} debe confirmarse con el supervisor médico.",
+    "Antes de aplicar {procedure}, verificar la seguridad de la escena y el estado de conciencia.",
+    "Reevaluar cada cinco minutos la presencia de {finding} durante el traslado.",
+    "No retrasar {procedure} mientras se prepara {drug}.",
+    "Registrar la hora de inicio de {procedure} y la respuesta del paciente a {drug}.",
+    "Ante {finding} persistente en {condition}, considerar {procedure} y repetir {drug}.",
+]
+QUERY_TEMPLATES = [
+    "¿Qué dosis de {drug} se usa en {condition}?",
+    "Paciente con {finding}, ¿cuándo hago {procedure}?",
+    "Protocolo de {condition}",
+    "{drug} en {condition}",
+    "¿Cómo aplico {procedure} en un paciente con {condition}?",
+]
+
+# Oraciones por chunk de 500 tokens, aproximadamente
+SENTENCES_PER_CHUNK = 22
+
+
+def generate_documents(chunks: int, chunks_per_doc: int = 20, seed: int = 42) -> Iterator[Dict[str, str]]:
+    """
+    Genera documentos hasta sumar aproximadamente `chunks` chunks
+
+    Args:
+        chunks: Número aproximado de chunks del corpus
+        chunks_per_doc: Chunks aproximados por documento
+        seed: Semilla, para que el corpus sea el mismo en cada ejecución
+
+    Yields:
+        Dict[str, str]: Documento con title, content y source
+    """
+    rng = random.Random(seed)
+    documents = max(1, round(chunks / chunks_per_doc))
+    for number in range(documents):
+        condition = CONDITIONS[number % len(CONDITIONS)]
+        sentences = []
+        for _ in range(chunks_per_doc * SENTENCES_PER_CHUNK):
+            sentences.append(rng.choice(TEMPLATES).format(
+                condition=condition if rng.random() < 0.7 else rng.choice(CONDITIONS),
+                drug=rng.choice(DRUGS),
+                procedure=rng.choice(PROCEDURES),
+                finding=rng.choice(FINDINGS),
+            ))
+        yield {
+            "title": f"Protocolo {number + 1}: {condition}",
+            "source": f"protocolos/{number + 1:07d}.pdf",
+            "content": " ".join(sentences),
+        }
+
+
+def generate_queries(count: int, seed: int = 7) -> List[str]:
+    """
+    Genera consultas de operadores sobre el vocabulario del corpus
+    """
+    rng = random.Random(seed)
+    return [
+        rng.choice(QUERY_TEMPLATES).format(
+            condition=rng.choice(CONDITIONS),
+            drug=rng.choice(DRUGS),
+            procedure=rng.choice(PROCEDURES),
+            finding=rng.choice(FINDINGS),
+        )
+        for _ in range(count)
+    ]
@@ -0,0 +1,264 @@
+"""
+Servidor local que imita la API de OpenAI: embeddings, chat (con o sin
+streaming) y síntesis de voz, con latencias aleatorias y errores inyectados.
+
+La aplicación se conecta a él con OPENAI_BASE_URL, así que las pruebas de
+carga ejercitan los clientes HTTP, los reintentos y el streaming reales sin
+gastar cuota ni depender de la red.
+
+Uso (desde la carpeta src/):
+    python -m benchmarks.mock_openai --port 8100 --chat-first-token lognormal:0.4,0.5 --error-rate 0.01
+    OPENAI_BASE_URL=http://localhost:8100/v1 OPENAI_API_KEY=sk-mock gunicorn wsgi -b :3001 -w 4
+
+Las latencias se indican como distribuciones, en segundos:
+    0.2 o fixed:0.2           siempre el mismo valor
+    uniform:0.1,0.5           uniforme entre dos valores
+    normal:0.3,0.05           media y desviación (nunca negativa)
+    lognormal:0.3,0.5         mediana y sigma, con la cola larga de una API real
+"""
+import time
+import uuid
+import json
+import base64
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass, field
+from typing import List, Dict, Any
+
+import numpy as np
+from quart import Quart, request, jsonify, Response
+
+from .stubs import ANSWER, StubEmbedder
+
+DISTRIBUTIONS = ("fixed", "uniform", "normal", "lognormal")
+
+
+class Latency:
+    """
+    Distribución de latencia a partir de su especificación en texto
+    """
+    def __init__(self, spec: str):
+        kind, _, values = str(spec).partition(":")
+        if not values:
+            kind, values = "fixed", kind
+        if kind not in DISTRIBUTIONS:
+            raise ValueError(f"Distribución de latencia desconocida: {kind}. Opciones: {', '.join(DISTRIBUTIONS)}")
+        self.kind = kind
+        self.params = [float(value) for value in values.split(",")]
+        expected = 1 if kind == "fixed" else 2
+        if len(self.params) != expected:
+            raise ValueError(f"La distribución {kind} necesita {expected} valor(es): '{spec}'")
+        self.spec = spec
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            value = self.params[0]
+        elif self.kind == "uniform":
+            value = rng.uniform(*self.params)
+        elif self.kind == "normal":
+            value = rng.gauss(*self.params)
+        else:
+            median, sigma = self.params
+            value = median * rng.lognormvariate(0.0, sigma) if median > 0 else 0.0
+        return max(0.0, value)
+
+
+@dataclass
+class MockConfig:
+    """
+    Comportamiento del servidor simulado
+    """
+    embedding: Latency = field(default_factory=lambda: Latency("0.05"))
+    embedding_per_input: float = 0.0005
+    chat_first_token: Latency = field(default_factory=lambda: Latency("0.4"))
+    chat_token_interval: Latency = field(default_factory=lambda: Latency("0.01"))
+    tts: Latency = field(default_factory=lambda: Latency("0.3"))
+    # Bytes de audio por carácter y tamaño de cada trozo enviado
+    tts_bytes_per_char: int = 16
+    tts_chunk_size: int = 4096
+    # Fracción de peticiones que fallan y los códigos HTTP que se eligen al azar
+    error_rate: float = 0.0
+    error_statuses: List[int] = field(default_factory=lambda: [429, 500])
+    seed: int = 1234
+
+
+def create_app(config: MockConfig) -> Quart:
+    """
+    Crea la aplicación Quart del servidor simulado
+    """
+    app = Quart(__name__)
+    rng = random.Random(config.seed)
+    embedder = StubEmbedder()
+    calls: Dict[str, int] = {"embeddings": 0, "chat": 0, "chat_stream": 0, "speech": 0, "errors": 0}
+    words = [word + " " for word in ANSWER.split(" ")]
+
+    def estimate_tokens(text: str) -> int:
+        return max(1, len(text) // 4)
+
+    def injected_error():
+        if config.error_rate <= 0 or rng.random() >= config.error_rate:
+            return None
+        calls["errors"] += 1
+        status = rng.choice(config.error_statuses)
+        kind = "rate_limit_exceeded" if status == 429 else "server_error"
+        body = {"error": {"message": f"Error simulado ({status})", "type": kind, "param": None, "code": kind}}
+        return jsonify(body), status
+
+    @app.route('/v1/embeddings', methods=['POST'])
+    async def embeddings():
+        data = await request.get_json()
+        error = injected_error()
+        if error:
+            return error
+        calls["embeddings"] += 1
+        texts = data.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+        await asyncio.sleep(config.embedding.sample(rng) + config.embedding_per_input * len(texts))
+
+        vectors = embedder.embed(texts).astype(np.float32)
+        dimension = data.get("dimensions")
+        if dimension and dimension < vectors.shape[1]:
+            vectors = vectors[:, :dimension]
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        # El cliente de Python pide base64 por defecto; el resto de clientes, listas de floats
+        if data.get("encoding_format") == "base64":
+            encoded = [base64.b64encode(vector.astype('<f4').tobytes()).decode('ascii') for vector in vectors]
+        else:
+            encoded = vectors.tolist()
+
+        tokens = sum(estimate_tokens(text) for text in texts)
+        return jsonify({
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": vector} for i, vector in enumerate(encoded)],
+            "model": data.get("model", "text-embedding-3-small"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    @app.route('/v1/chat/completions', methods=['POST'])
+    async def chat_completions():
+        data = await request.get_json()
+        error = injected_error()
+        if error:
+            return error
+        stream = bool(data.get("stream"))
+        calls["chat_stream" if stream else "chat"] += 1
+        model = data.get("model", "gpt-4o-mini")
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        prompt_tokens = sum(estimate_tokens(str(message.get("content", ""))) for message in data.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+
+        await asyncio.sleep(config.chat_first_token.sample(rng))
+        if not stream:
+            await asyncio.sleep(sum(config.chat_token_interval.sample(rng) for _ in words[1:]))
+            return jsonify({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": ANSWER},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        include_usage = bool((data.get("stream_options") or {}).get("include_usage"))
+
+        def chunk(choices: List[Dict[str, Any]], chunk_usage=None) -> str:
+            body = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                    "model": model, "choices": choices}
+            if include_usage:
+                body["usage"] = chunk_usage
+            return f"data: {json.dumps(body)}\n\n"
+
+        async def events():
+            yield chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(config.chat_token_interval.sample(rng))
+                yield chunk([{"index": 0, "delta": {"content": word}, "finish_reason": None}])
+            yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if include_usage:
+                yield chunk([], usage)
+            yield "data: [DONE]\n\n"
+
+        response = Response(events(), mimetype='text/event-stream')
+        response.timeout = None
+        return response
+
+    @app.route('/v1/audio/speech', methods=['POST'])
+    async def speech():
+        data = await request.get_json()
+        error = injected_error()
+        if error:
+            return error
+        calls["speech"] += 1
+        audio = bytes(config.tts_bytes_per_char * len(data.get("input", "")))
+        mimetypes = {"mp3": "audio/mpeg", "opus": "audio/ogg", "aac": "audio/aac", "wav": "audio/wav",
+                     "pcm": "audio/pcm", "flac": "audio/flac"}
+
+        async def body():
+            # El primer trozo llega tras la latencia de síntesis; el resto, seguido
+            await asyncio.sleep(config.tts.sample(rng))
+            for start in range(0, len(audio), config.tts_chunk_size):
+                yield audio[start:start + config.tts_chunk_size]
+
+        response = Response(body(), mimetype=mimetypes.get(data.get("response_format", "mp3"), "audio/mpeg"))
+        response.timeout = None
+        return response
+
+    @app.route('/mock/stats', methods=['GET'])
+    async def stats():
+        """
+        Llamadas recibidas por endpoint, para contrastar con lo que mide la prueba de carga
+        """
+        return jsonify(calls)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor local que imita la API de OpenAI")
+    parser.add_argument("--host", default="127.0.0.1", help="Dirección en la que escuchar")
+    parser.add_argument("--port", type=int, default=8100, help="Puerto en el que escuchar")
+    parser.add_argument("--embedding-latency", default="0.05", help="Latencia por petición de embeddings")
+    parser.add_argument("--embedding-per-input", type=float, default=0.0005,
+                        help="Segundos adicionales por texto de la petición de embeddings")
+    parser.add_argument("--chat-first-token", default="0.4", help="Latencia hasta el primer token del chat")
+    parser.add_argument("--token-interval", default="0.01", help="Latencia entre tokens del chat")
+    parser.add_argument("--tts-latency", default="0.3", help="Latencia hasta el primer byte de audio")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de peticiones que fallan (0-1)")
+    parser.add_argument("--error-status", default="429,500", help="Códigos HTTP de los errores, separados por comas")
+    parser.add_argument("--seed", type=int, default=1234, help="Semilla de las latencias y los errores")
+    args = parser.parse_args()
+
+    try:
+        config = MockConfig(
+            embedding=Latency(args.embedding_latency),
+            embedding_per_input=args.embedding_per_input,
+            chat_first_token=Latency(args.chat_first_token),
+            chat_token_interval=Latency(args.token_interval),
+            tts=Latency(args.tts_latency),
+            error_rate=args.error_rate,
+            error_statuses=[int(status) for status in args.error_status.split(",")],
+            seed=args.seed,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    server_config = Config()
+    server_config.bind = [f"{args.host}:{args.port}"]
+    server_config.accesslog = None
+    print(f"OpenAI simulado en http://{args.host}:{args.port}/v1 "
+          f"(chat {config.chat_first_token.spec}, embeddings {config.embedding.spec}, "
+          f"tts {config.tts.spec}, errores {config.error_rate:.1%})")
+    asyncio.run(serve(create_app(config), server_config))
+
+
+if __name__ == "__main__":
+    main()
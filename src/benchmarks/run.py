@@ -0,0 +1,380 @@
+"""
+Suite de benchmarks: ingesta, búsqueda RAG y chat de punta a punta.
+
+Genera un corpus sintético de protocolos por cada tamaño pedido, simula
+OpenAI (embeddings, chat y TTS) con latencia configurable y mide:
+- ingest: throughput de process_json_file
+- search: p50/p99 de EmbeddingsManager.search (embedding en caché o no) y memoria
+- chat: latencia de /api/chat y /api/voice-chat con el cliente de pruebas de Flask
+
+Cada tamaño se ejecuta en un proceso aparte, con sus datos en una carpeta
+temporal, para que la memoria medida sea solo la suya. Los resultados se
+guardan en JSON para comparar versiones.
+
+Uso (desde la carpeta src/):
+    python -m benchmarks.run --chunks 1000,10000,100000 --json resultados.json
+    python -m benchmarks.run --chunks 1000000 --index-type ivfpq --suites ingest,search
+    python -m benchmarks.run --compare base.json resultados.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+SUITES = ("ingest", "search", "chat")
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Devuelve p50 y p99 en milisegundos
+    """
+    if not values:
+        return {"p50_ms": None, "p99_ms": None}
+    return {
+        "p50_ms": round(float(np.percentile(values, 50)) * 1000, 3),
+        "p99_ms": round(float(np.percentile(values, 99)) * 1000, 3),
+    }
+
+
+def memory_mb() -> Dict[str, float]:
+    """
+    Memoria residente actual y máxima del proceso, en MB
+    """
+    usage = {}
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, value = line.split(":", 1)
+                    usage["rss_mb" if name == "VmRSS" else "peak_rss_mb"] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        import resource
+        usage["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return usage
+
+
+def directory_mb(path: str) -> float:
+    """
+    Tamaño en disco de una carpeta, en MB
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return round(total / 1e6, 2)
+
+
+def bench_ingest(manager, chunks: int, chunks_per_doc: int, calls: Dict[str, int]) -> Dict[str, Any]:
+    """
+    Procesa el corpus sintético documento por documento
+    """
+    from .corpus import generate_documents
+
+    seconds = []
+    started = time.perf_counter()
+    for document in generate_documents(chunks, chunks_per_doc):
+        start = time.perf_counter()
+        manager.process_json_file(document)
+        seconds.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+    indexed = manager.get_chunk_count()
+    return {
+        "documents": len(seconds),
+        "chunks": indexed,
+        "seconds": round(elapsed, 3),
+        "chunks_per_second": round(indexed / elapsed, 1) if elapsed else None,
+        "document": percentiles(seconds),
+        "embedding_calls": calls["embedding"],
+        **memory_mb(),
+    }
+
+
+def bench_search(manager, queries: int, top_k: int, calls: Dict[str, int]) -> Dict[str, Any]:
+    """
+    Mide la búsqueda con consultas nuevas (embedding sin caché) y repetidas
+    """
+    from .corpus import generate_queries
+
+    texts = generate_queries(queries)
+    calls_before = calls["embedding"]
+    cold = []
+    for query in texts:
+        start = time.perf_counter()
+        manager.search(query, top_k)
+        cold.append(time.perf_counter() - start)
+    cold_calls = calls["embedding"] - calls_before
+    warm = []
+    for query in texts:
+        start = time.perf_counter()
+        manager.search(query, top_k)
+        warm.append(time.perf_counter() - start)
+    return {
+        "queries": len(texts),
+        "top_k": top_k,
+        "cold": percentiles(cold),
+        "warm": percentiles(warm),
+        # Consultas nuevas que se respondieron sin pedir el embedding (búsqueda léxica)
+        "embedding_skipped": round(1 - cold_calls / len(texts), 4) if texts else None,
+        **memory_mb(),
+    }
+
+
+def bench_chat(app, requests: int) -> Dict[str, Any]:
+    """
+    Mide /api/chat (completo y en streaming) y /api/voice-chat de punta a punta
+    """
+    from .corpus import generate_queries
+
+    client = app.test_client()
+    texts = generate_queries(requests, seed=11)
+    results = {}
+    for name, path, payload in (("chat", "/api/chat", {}),
+                                ("chat_stream", "/api/chat", {"stream": True}),
+                                ("voice", "/api/voice-chat", {"audio_delivery": "url"})):
+        totals, first_bytes, errors = [], [], 0
+        for text in texts:
+            start = time.perf_counter()
+            response = client.post(path, json=dict(payload, message=text), buffered=False)
+            first = None
+            for _ in response.response:
+                if first is None:
+                    first = time.perf_counter() - start
+            response.close()
+            if response.status_code != 200:
+                errors += 1
+                continue
+            totals.append(time.perf_counter() - start)
+            first_bytes.append(first if first is not None else totals[-1])
+        results[name] = {
+            "requests": len(texts),
+            "errors": errors,
+            **percentiles(totals),
+            "first_byte_p50_ms": percentiles(first_bytes)["p50_ms"],
+        }
+    return results
+
+
+def run_single(args) -> Dict[str, Any]:
+    """
+    Ejecuta las suites para un tamaño de corpus, en este proceso
+
+    Las variables de entorno (RAG_DATA_DIR, etc.) ya deben apuntar a una
+    carpeta temporal antes de importar la aplicación.
+    """
+    from .stubs import StubLatency, install_stubs
+    from app import app
+    from api.rag import embeddings_manager
+
+    latency = StubLatency(
+        embedding=args.embedding_latency,
+        chat_first_token=args.chat_latency,
+        chat_token_interval=args.token_interval,
+        tts=args.tts_latency,
+    )
+    calls = install_stubs(latency)
+    suites = args.suites.split(",")
+    result: Dict[str, Any] = {"chunks_requested": args.single}
+
+    start = time.perf_counter()
+    manager = embeddings_manager.initialize()
+    result["startup_seconds"] = round(time.perf_counter() - start, 3)
+
+    if "ingest" in suites:
+        print(f"[{args.single} chunks] ingesta...")
+        result["ingest"] = bench_ingest(manager, args.single, args.chunks_per_doc, calls)
+        result["data_mb"] = directory_mb(os.environ["RAG_DATA_DIR"])
+    if "search" in suites:
+        print(f"[{args.single} chunks] búsqueda...")
+        result["search"] = bench_search(manager, args.queries, args.top_k, calls)
+    if "chat" in suites:
+        print(f"[{args.single} chunks] chat...")
+        result["chat"] = bench_chat(app, args.chat_requests)
+    result["index"] = manager.get_index_info()
+    return result
+
+
+def isolated_env(workdir: str, index_type: Optional[str]) -> Dict[str, str]:
+    """
+    Variables de entorno para que el proceso hijo no toque los datos reales
+    """
+    env = dict(os.environ)
+    env.update({
+        "RAG_DATA_DIR": os.path.join(workdir, "rag"),
+        "RAG_CACHE_DIR": os.path.join(workdir, "rag", "cache"),
+        "TTS_CACHE_DIR": os.path.join(workdir, "tts_cache"),
+        "AUDIO_DIR": os.path.join(workdir, "audio"),
+        "METRICS_DIR": os.path.join(workdir, "metrics"),
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'app.db')}",
+        "RAG_EMBEDDING_PROVIDER": "openai",
+        # Medir siempre el camino completo, sin respuestas en caché
+        "ANSWER_CACHE_MAX_ENTRIES": "0",
+        "OPENAI_API_KEY": env.get("OPENAI_API_KEY") or "sk-benchmark",
+    })
+    if index_type:
+        env["RAG_INDEX_TYPE"] = index_type
+    return env
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_sizes(args) -> Dict[str, Any]:
+    """
+    Ejecuta cada tamaño de corpus en un proceso hijo y junta los resultados
+    """
+    results = []
+    for chunks in [int(value) for value in args.chunks.split(",")]:
+        workdir = tempfile.mkdtemp(prefix="api-bench-")
+        result_path = os.path.join(workdir, "result.json")
+        command = [sys.executable, "-m", "benchmarks.run", "--single", str(chunks), "--result-file", result_path]
+        for name in ("suites", "chunks_per_doc", "queries", "top_k", "chat_requests", "embedding_latency",
+                     "chat_latency", "token_interval", "tts_latency"):
+            command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+        try:
+            subprocess.run(command, env=isolated_env(workdir, args.index_type), check=True)
+            with open(result_path, 'r', encoding='utf-8') as f:
+                results.append(json.load(f))
+        except subprocess.CalledProcessError as e:
+            print(f"El benchmark de {chunks} chunks falló (código {e.returncode})")
+            results.append({"chunks_requested": chunks, "error": f"exit code {e.returncode}"})
+        finally:
+            if not args.keep_data:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "index_type": args.index_type or os.getenv("RAG_INDEX_TYPE", "flat"),
+            "stub_latency": {
+                "embedding": args.embedding_latency,
+                "chat_first_token": args.chat_latency,
+                "chat_token_interval": args.token_interval,
+                "tts": args.tts_latency,
+            },
+        },
+        "results": results,
+    }
+
+
+# Métricas que se muestran en el informe y en la comparación
+REPORT_METRICS = [
+    ("ingest chunks/s", ("ingest", "chunks_per_second")),
+    ("search cold p50 ms", ("search", "cold", "p50_ms")),
+    ("search cold p99 ms", ("search", "cold", "p99_ms")),
+    ("search warm p50 ms", ("search", "warm", "p50_ms")),
+    ("search warm p99 ms", ("search", "warm", "p99_ms")),
+    ("search RSS MB", ("search", "rss_mb")),
+    ("chat p50 ms", ("chat", "chat", "p50_ms")),
+    ("chat p99 ms", ("chat", "chat", "p99_ms")),
+    ("chat stream 1er byte ms", ("chat", "chat_stream", "first_byte_p50_ms")),
+    ("voice p50 ms", ("chat", "voice", "p50_ms")),
+]
+
+
+def lookup(result: Dict[str, Any], path) -> Optional[float]:
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+def print_report(report: Dict[str, Any]):
+    """
+    Muestra los resultados como tabla, una columna por tamaño de corpus
+    """
+    results = report["results"]
+    print(f"{'métrica':<26}" + "".join(f"{result.get('ingest', {}).get('chunks', result['chunks_requested']):>14}"
+                                       for result in results))
+    for label, path in REPORT_METRICS:
+        values = [lookup(result, path) for result in results]
+        if all(value is None for value in values):
+            continue
+        print(f"{label:<26}" + "".join(f"{value:>14}" if value is not None else f"{'-':>14}" for value in values))
+
+
+def compare(base_path: str, new_path: str):
+    """
+    Compara dos archivos de resultados por tamaño de corpus
+    """
+    with open(base_path, 'r', encoding='utf-8') as f:
+        base = json.load(f)
+    with open(new_path, 'r', encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"base: {base['meta'].get('commit')} ({base['meta']['timestamp']})  "
+          f"nuevo: {new['meta'].get('commit')} ({new['meta']['timestamp']})")
+    base_by_size = {result["chunks_requested"]: result for result in base["results"]}
+    for result in new["results"]:
+        reference = base_by_size.get(result["chunks_requested"])
+        if reference is None:
+            continue
+        print(f"\n{result['chunks_requested']} chunks")
+        print(f"{'métrica':<26} {'base':>12} {'nuevo':>12} {'cambio':>9}")
+        for label, path in REPORT_METRICS:
+            before, after = lookup(reference, path), lookup(result, path)
+            if before is None or after is None:
+                continue
+            change = f"{(after - before) / before * 100:+.1f}%" if before else "-"
+            print(f"{label:<26} {before:>12} {after:>12} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de ingesta, búsqueda y chat con OpenAI simulado")
+    parser.add_argument("--chunks", default="1000,10000", help="Tamaños de corpus en chunks, separados por comas")
+    parser.add_argument("--suites", default=",".join(SUITES), help="Suites a ejecutar (ingest,search,chat)")
+    parser.add_argument("--chunks-per-doc", type=int, default=20, help="Chunks aproximados por documento")
+    parser.add_argument("--queries", type=int, default=500, help="Consultas de la suite de búsqueda")
+    parser.add_argument("--top-k", type=int, default=3, help="Resultados por búsqueda")
+    parser.add_argument("--chat-requests", type=int, default=50, help="Peticiones por endpoint en la suite de chat")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="Latencia simulada de embeddings (s)")
+    parser.add_argument("--chat-latency", type=float, default=0.4, help="Latencia simulada hasta el primer token (s)")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="Segundos simulados entre tokens")
+    parser.add_argument("--tts-latency", type=float, default=0.3, help="Latencia simulada de TTS (s)")
+    parser.add_argument("--index-type", default=None, help="Tipo de índice FAISS (RAG_INDEX_TYPE)")
+    parser.add_argument("--keep-data", action="store_true", help="No borrar las carpetas temporales de datos")
+    parser.add_argument("--json", dest="json_path", default=None, help="Guardar los resultados en un archivo JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NUEVO"), help="Comparar dos archivos de resultados")
+    parser.add_argument("--single", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.single is not None:
+        if not os.getenv("RAG_DATA_DIR"):
+            parser.error("--single solo se usa en los procesos hijos, con RAG_DATA_DIR en una carpeta temporal")
+        result = run_single(args)
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+        return
+
+    report = run_sizes(args)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Resultados guardados en {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
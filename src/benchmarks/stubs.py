@@ -0,0 +1,171 @@
+"""
+Sustitutos de las llamadas a OpenAI (embeddings, chat y TTS) con latencia configurable.
+
+Se instalan sobre los clientes que usa la aplicación, así que el resto del
+código (lotes, cachés, streaming, SSE) se ejecuta igual que en producción.
+"""
+import re
+import time
+import zlib
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import List, Dict
+
+import numpy as np
+
+from .corpus import CONDITIONS, DRUGS, PROCEDURES, FINDINGS
+
+WORD = re.compile(r"\w+")
+
+ANSWER = ("Según los protocolos: 1. Verificar la seguridad de la escena. 2. Llamar al 911. "
+          "3. Evaluar la vía aérea, la respiración y la circulación. 4. Administrar el tratamiento "
+          "indicado en el protocolo y registrar la hora. 5. Reevaluar cada cinco minutos hasta la "
+          "llegada de ayuda. Consulte a un supervisor médico ante cualquier duda.")
+
+
+@dataclass
+class StubLatency:
+    """
+    Latencias simuladas de la API, en segundos
+    """
+    embedding: float = 0.05           # Por petición de embeddings
+    embedding_per_input: float = 0.0005  # Adicional por texto de la petición
+    chat_first_token: float = 0.4     # Hasta el primer token (o la respuesta completa)
+    chat_token_interval: float = 0.01  # Entre tokens en streaming
+    tts: float = 0.3                  # Por petición de síntesis de voz
+
+
+class StubEmbedder:
+    """
+    Embeddings deterministas: cada palabra del vocabulario médico aporta un
+    vector fijo y cada texto suma un ruido propio, así que textos que
+    comparten términos quedan cerca
+    """
+    def __init__(self, dimension: int = 1536, noise: float = 0.3, seed: int = 1234):
+        vocabulary = sorted({word for term in CONDITIONS + DRUGS + PROCEDURES + FINDINGS
+                             for word in WORD.findall(term.lower()) if len(word) > 3})
+        self.vocabulary = {word: i for i, word in enumerate(vocabulary)}
+        rng = np.random.default_rng(seed)
+        self.vectors = rng.standard_normal((len(vocabulary), dimension)).astype(np.float32)
+        self.dimension = dimension
+        self.noise = noise
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        counts = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        noise = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in WORD.findall(text.lower()):
+                column = self.vocabulary.get(word)
+                if column is not None:
+                    counts[i, column] += 1
+            rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+            noise[i] = rng.standard_normal(self.dimension, dtype=np.float32)
+        counts /= np.maximum(np.linalg.norm(counts, axis=1, keepdims=True), 1.0)
+        vectors = counts @ self.vectors + self.noise * noise
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+
+class StubEmbeddings:
+    """
+    Reemplazo de client.embeddings
+    """
+    def __init__(self, latency: StubLatency, embedder: StubEmbedder, calls: Dict[str, int]):
+        self.latency = latency
+        self.embedder = embedder
+        self.calls = calls
+
+    def create(self, model, input, dimensions=None, **kwargs):
+        self.calls["embedding"] += 1
+        time.sleep(self.latency.embedding + self.latency.embedding_per_input * len(input))
+        vectors = self.embedder.embed(input)
+        if dimensions and dimensions < vectors.shape[1]:
+            vectors = vectors[:, :dimensions]
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        data = [SimpleNamespace(index=i, embedding=vector) for i, vector in enumerate(vectors)]
+        tokens = sum(len(text) // 4 for text in input)
+        return SimpleNamespace(data=data, usage=SimpleNamespace(prompt_tokens=tokens, total_tokens=tokens))
+
+
+class StubCompletions:
+    """
+    Reemplazo de client.chat.completions
+    """
+    def __init__(self, latency: StubLatency, calls: Dict[str, int]):
+        self.latency = latency
+        self.calls = calls
+
+    def create(self, model, messages, stream=False, **kwargs):
+        self.calls["chat"] += 1
+        prompt_tokens = sum(len(message["content"]) // 4 for message in messages)
+        words = [word + " " for word in ANSWER.split(" ")]
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(words),
+                                total_tokens=prompt_tokens + len(words))
+        time.sleep(self.latency.chat_first_token)
+        if not stream:
+            time.sleep(self.latency.chat_token_interval * len(words))
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=ANSWER))],
+                usage=usage
+            )
+
+        def chunks():
+            for i, word in enumerate(words):
+                if i:
+                    time.sleep(self.latency.chat_token_interval)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))], usage=None)
+            yield SimpleNamespace(choices=[], usage=usage)
+        return chunks()
+
+
+class StubAudioStream:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_bytes(self, chunk_size: int = 1024):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+
+class StubSpeech:
+    """
+    Reemplazo de client.audio.speech (audio de 16 bytes por carácter)
+    """
+    def __init__(self, latency: StubLatency, calls: Dict[str, int]):
+        self.latency = latency
+        self.calls = calls
+        self.with_streaming_response = SimpleNamespace(create=self.create_streaming)
+
+    def synthesize(self, text: str) -> bytes:
+        self.calls["tts"] += 1
+        time.sleep(self.latency.tts)
+        return bytes(16 * len(text))
+
+    def create(self, model, voice, input, response_format="mp3", **kwargs):
+        return SimpleNamespace(content=self.synthesize(input))
+
+    def create_streaming(self, model, voice, input, response_format="mp3", **kwargs):
+        return StubAudioStream(self.synthesize(input))
+
+
+def install_stubs(latency: StubLatency) -> Dict[str, int]:
+    """
+    Sustituye las llamadas a OpenAI de la aplicación por los stubs
+
+    Returns:
+        Dict[str, int]: Contadores de llamadas por tipo (se actualizan en vivo)
+    """
+    from api import routes
+    from api.rag import embedding_providers
+
+    calls = {"embedding": 0, "chat": 0, "tts": 0}
+    embedding_providers.client.embeddings = StubEmbeddings(latency, StubEmbedder(), calls)
+    routes.openai_client.chat = SimpleNamespace(completions=StubCompletions(latency, calls))
+    routes.openai_client.audio = SimpleNamespace(speech=StubSpeech(latency, calls))
+    return calls
@@ -1,9 +1,19 @@
 import React, { useState, useEffect } from "react";
 
+// Intervalo de consulta del estado de un trabajo de ingesta (ms)
+const JOB_POLL_INTERVAL = 1500;
+
+const formatEta = (seconds) => {
+  if (seconds === null || seconds === undefined) return "calculando...";
+  if (seconds < 60) return `${Math.ceil(seconds)} s`;
+  return `${Math.floor(seconds / 60)} min ${Math.ceil(seconds % 60)} s`;
+};
+
 export const RagUploader = () => {
   const [file, setFile] = useState(null);
   const [isUploading, setIsUploading] = useState(false);
   const [uploadResult, setUploadResult] = useState(null);
+  const [job, setJob] = useState(null);
   const [ragStats, setRagStats] = useState(null);
   const [error, setError] = useState(null);
 
@@ -12,6 +22,33 @@ export const RagUploader = () => {
     fetchRagStats();
   }, []);
 
+  // Consultar el progreso del trabajo de ingesta hasta que termine
+  useEffect(() => {
+    if (!job || job.status === "done" || job.status === "failed") return;
+    const timer = setTimeout(async () => {
+      try {
+        const backendUrl = import.meta.env.VITE_BACKEND_URL;
+        const response = await fetch(`${backendUrl}/api/rag/jobs/${job.id}`);
+        const data = await response.json();
+        if (!response.ok) {
+          throw new Error(data.error || "Error fetching job status");
+        }
+        setJob(data);
+        if (data.status === "done") {
+          setUploadResult(data);
+          fetchRagStats();
+        } else if (data.status === "failed") {
+          setError(`No se pudo procesar el documento: ${data.error}`);
+        }
+      } catch (err) {
+        console.error("Error fetching job status:", err);
+        setError("No se pudo consultar el estado del procesamiento");
+        setJob(null);
+      }
+    }, JOB_POLL_INTERVAL);
+    return () => clearTimeout(timer);
+  }, [job]);
+
   // Obtener estadísticas de la base RAG
   const fetchRagStats = async () => {
     try {
@@ -39,6 +76,7 @@ export const RagUploader = () => {
     const selectedFile = e.target.files[0];
     setFile(selectedFile);
     setUploadResult(null);
+    setJob(null);
     setError(null);
   };
 
@@ -73,12 +111,10 @@ export const RagUploader = () => {
         throw new Error(data.error || "Error uploading file");
       }
       
-      setUploadResult(data);
+      // El documento se procesa en segundo plano: se sigue su trabajo
+      setJob(data.job);
       setFile(null);
       
-      // Recargar estadísticas
-      fetchRagStats();
-      
       // Limpiar el input de archivo
       document.getElementById('ragFileInput').value = '';
     } catch (err) {
@@ -201,6 +237,27 @@ export const RagUploader = () => {
           </div>
         </form>
         
+        {job && (job.status === "queued" || job.status === "running") && (
+          <div className="alert alert-info mt-3" role="status">
+            <strong>Procesando "{job.title}"...</strong><br />
+            {job.status === "queued" ? "En cola" : (
+              <>
+                Fragmentos: {job.chunks_embedded} de {job.chunks_total ?? "?"} · Tiempo restante: {formatEta(job.eta_seconds)}
+              </>
+            )}
+            <div className="progress mt-2">
+              <div
+                className="progress-bar progress-bar-striped progress-bar-animated bg-danger"
+                role="progressbar"
+                style={{ width: `${Math.round(job.progress * 100)}%` }}
+                aria-valuenow={Math.round(job.progress * 100)}
+                aria-valuemin="0"
+                aria-valuemax="100"
+              ></div>
+            </div>
+          </div>
+        )}
+
         {uploadResult && (
           <div className="alert alert-success mt-3" role="alert">
             <strong>¡Documento procesado correctamente!</strong><br />
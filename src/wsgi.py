@@ -1,7 +1,14 @@
 # This file was created to run the application on heroku using gunicorn.
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
 
+import os
 from app import app as application
 
+# Con RAG_PRELOAD=1 (y preload_app en gunicorn.conf.py) el índice RAG se carga
+# una sola vez en el proceso maestro y los workers lo heredan al hacer fork
+if os.getenv("RAG_PRELOAD") == "1":
+    from api.rag import embeddings_manager
+    embeddings_manager.initialize()
+
 if __name__ == "__main__":
     application.run()